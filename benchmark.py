@@ -0,0 +1,341 @@
+"""
+Benchmarks of the core user and artist operations.
+
+Run as:
+`benchmark.py run [database.db ...] [--iterations N] [--output results.json]`
+`benchmark.py compare <baseline.json> <results.json> [--threshold 0.2] [--min-delta MS]`
+
+run calls search, listen, info, add_song_to_playlist, find_top and
+startSession non-interactively against a copy of each database and reports
+the p50/p95/p99 latency and throughput of each operation. Without databases
+it generates the --sizes databases with generateDatabase, small and medium
+by default (large is also available), kept in --data-dir for later runs.
+
+compare prints the change of every operation between two saved runs and
+fails (exit status 1) if an operation's p50 or p95 got slower by more than
+the threshold.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime
+import config
+import generateDatabase
+import search
+import session
+import songFunctions
+import toolHelpers
+from toolHelpers import percentile
+
+ITERATIONS = 200
+WARMUP = 20
+SEED = 0
+THRESHOLD = 0.2
+
+# Slowdowns smaller than this are timer noise, not regressions
+MIN_DELTA_MS = 0.05
+DATA_DIR = "benchmarkData"
+
+# Generated databases, by name: number of users, artists, songs, playlists and listens
+SIZES = {
+    "small": (100, 50, 2000, 200, 10000),
+    "medium": (1000, 500, 20000, 2000, 200000),
+    "large": (10000, 5000, 200000, 20000, 2000000),
+}
+
+# Percentiles reported for every operation
+PERCENTILES = (50, 95, 99)
+
+
+def measure(operation, iterations: int, warmup: int) -> dict:
+    """Time repeated calls of an operation. If the operation returns a
+    function, e.g. one that ends what it started, it is called untimed.
+
+    Args:
+        operation (function): takes the iteration number
+        iterations (int): number of timed calls
+        warmup (int): number of untimed calls before them
+
+    Returns:
+        dict: latency percentiles and mean in milliseconds, and ops/sec
+    """
+    latencies = []
+    for i in range(warmup + iterations):
+        startTime = time.perf_counter()
+        cleanup = operation(i)
+        elapsed = time.perf_counter() - startTime
+        if callable(cleanup):
+            cleanup()
+        if i >= warmup:
+            latencies.append(elapsed)
+
+    latencies.sort()
+    result = {f"p{p}_ms": percentile(latencies, p) * 1000 for p in PERCENTILES}
+    result["mean_ms"] = sum(latencies) / len(latencies) * 1000
+    result["ops_per_sec"] = len(latencies) / sum(latencies)
+    result["iterations"] = len(latencies)
+
+    return result
+
+
+def sampleInputs(rng: random.Random, count: int) -> dict[str, list]:
+    """Pick the ids and search terms the operations are called with
+
+    Args:
+        rng (random.Random): random number generator
+        count (int): number of values of each kind
+
+    Returns:
+        dict[str, list]: uids, sids, aids, playlist titles and search terms
+    """
+    cursor = config.getCursor()
+    columns = {
+        "uids": "select uid from users",
+        "sids": "select sid from songs",
+        "aids": "select aid from artists",
+        "titles": "select title from playlists",
+    }
+
+    inputs = {}
+    for name, sql in columns.items():
+        cursor.execute(sql)
+        values = [row[0] for row in cursor.fetchall()]
+        inputs[name] = [rng.choice(values) for _ in range(count)]
+
+    inputs["terms"] = toolHelpers.searchTerms(rng, count)
+
+    return inputs
+
+
+def operations(inputs: dict[str, list]) -> tuple[dict, dict]:
+    """Build the benchmarked operations
+
+    Args:
+        inputs (dict[str, list]): values from sampleInputs
+
+    Returns:
+        tuple[dict, dict]: operation by name, each taking the iteration
+            number, and the session managers the listens are recorded in
+    """
+    uids, sids, aids, titles, terms = (
+        inputs["uids"], inputs["sids"], inputs["aids"], inputs["titles"], inputs["terms"]
+    )
+    managers = {}
+
+    def sessionManager(uid):
+        if uid not in managers:
+            managers[uid] = session.SessionManager(uid, verbose=False)
+        return managers[uid]
+
+    def searchPage(queryFunc, i):
+        # Results the user sees first, without the result cache
+        search.resultCache.clear()
+        search.pageResults(queryFunc, terms[i % len(terms)]).page(0)
+
+    def searchCached(i):
+        # A few repeated searches, served from the result cache like the server's
+        search.rankResults(search.querySongsAndPlaylists, terms[i % 10])
+
+    def listen(i):
+        uid = uids[i % len(uids)]
+        songFunctions.listen(uid, sids[i % len(sids)], sessionManager(uid))
+
+    def startSession(i):
+        manager = session.SessionManager(uids[i % len(uids)], verbose=False)
+        manager.startSession()
+        return manager.endSession
+
+    return {
+        "search songs": lambda i: searchPage(search.querySongsAndPlaylists, i),
+        "search songs cached": searchCached,
+        "search artists": lambda i: searchPage(search.queryArtists, i),
+        "listen": listen,
+        "info": lambda i: songFunctions.get_info(sids[i % len(sids)]),
+        "add_song_to_playlist": lambda i: songFunctions.add_song_to_playlist(
+            titles[i % len(titles)], sids[(i * 7) % len(sids)], uids[i % len(uids)]
+        ),
+        "find_top": lambda i: songFunctions.find_top(aids[i % len(aids)]),
+        "startSession": startSession,
+    }, managers
+
+
+def benchmarkDatabase(path: str, iterations: int, warmup: int, seed: int) -> dict:
+    """Run every operation against a copy of a database
+
+    Args:
+        path (str): database file, left unchanged
+        iterations (int): timed calls per operation
+        warmup (int): untimed calls per operation
+        seed (int): random seed of the inputs
+
+    Returns:
+        dict: results by operation name
+    """
+    results = {}
+    with toolHelpers.databaseCopy(path, "benchmark.db") as copy:
+        config.connect(copy)
+        try:
+            inputs = sampleInputs(random.Random(seed), iterations + warmup)
+            benchmarks, managers = operations(inputs)
+
+            # find_top prints its results
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                for name, operation in benchmarks.items():
+                    results[name] = measure(operation, iterations, warmup)
+                    print(formatResult(name, results[name]), file=sys.__stdout__)
+
+            for manager in managers.values():
+                manager.endSession()
+        finally:
+            config.close()
+
+    return results
+
+
+def formatResult(name: str, result: dict) -> str:
+    """Format one operation's results as a line of the report
+
+    Args:
+        name (str): operation name
+        result (dict): results from measure
+
+    Returns:
+        str: report line
+    """
+    percentiles = "  ".join(f"p{p} {result[f'p{p}_ms']:8.3f}ms" for p in PERCENTILES)
+    return f"  {name:<22}{percentiles}  {result['ops_per_sec']:10.1f} ops/s"
+
+
+def generatedDatabases(dataDir: str, names: list[str], seed: int) -> dict[str, str]:
+    """Get the generated benchmark databases, generating missing ones
+
+    Args:
+        dataDir (str): directory holding the databases
+        names (list[str]): sizes from SIZES
+        seed (int): generator seed
+
+    Returns:
+        dict[str, str]: database file by size name
+    """
+    os.makedirs(dataDir, exist_ok=True)
+    paths = {}
+    for name in names:
+        path = os.path.join(dataDir, f"{name}-{seed}.db")
+        if not os.path.exists(path):
+            print(f"Generating {name} database")
+            generateDatabase.generateDatabase(path, *SIZES[name], seed, generateDatabase.ZIPF_EXPONENT)
+        paths[name] = path
+
+    return paths
+
+
+def runBenchmarks(args) -> int:
+    if args.databases:
+        databases = {os.path.basename(path): path for path in args.databases}
+    else:
+        databases = generatedDatabases(args.data_dir, args.sizes.split(","), args.seed)
+
+    report = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+    for name, path in databases.items():
+        print(f"{name}:")
+        report["results"][name] = benchmarkDatabase(path, args.iterations, args.warmup, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved results to {args.output}")
+
+    return 0
+
+
+def compareResults(baseline: dict, current: dict, threshold: float, minDelta: float = MIN_DELTA_MS) -> list[str]:
+    """Print the change of every operation measured in both runs
+
+    Args:
+        baseline (dict): earlier run
+        current (dict): later run
+        threshold (float): relative slowdown of p50 or p95 that counts as a regression
+        minDelta (float): smallest slowdown in milliseconds that counts as a regression
+
+    Returns:
+        list[str]: the regressions found
+    """
+    regressions = []
+    for database, results in current["results"].items():
+        baselineResults = baseline["results"].get(database)
+        if baselineResults is None:
+            continue
+
+        print(f"{database}:")
+        for name, result in results.items():
+            if name not in baselineResults:
+                continue
+
+            changes = []
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                before, after = baselineResults[name][key], result[key]
+                change = (after - before) / before if before else 0.0
+                changes.append(f"{key[:-3]} {before:8.3f} -> {after:8.3f}ms ({change:+6.1%})")
+                if key != "p99_ms" and change > threshold and after - before > minDelta:
+                    regressions.append(f"{database} {name}: {key[:-3]} {change:+.1%}")
+            print(f"  {name:<22}" + "  ".join(changes))
+
+    return regressions
+
+
+def compareRuns(args) -> int:
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.results) as file:
+        current = json.load(file)
+
+    regressions = compareResults(baseline, current, args.threshold, args.min_delta)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    return 1 if regressions else 0
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the core user and artist operations")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="benchmark databases and optionally save the results")
+    run.add_argument("databases", nargs="*", help="sqlite database files, copied and left unchanged")
+    run.add_argument("--iterations", type=int, default=ITERATIONS, help="timed calls per operation")
+    run.add_argument("--warmup", type=int, default=WARMUP, help="untimed calls per operation")
+    run.add_argument("--seed", type=int, default=SEED)
+    run.add_argument("--sizes", default="small,medium", help=f"generated databases to use, from {', '.join(SIZES)}")
+    run.add_argument("--data-dir", default=DATA_DIR, help="where generated databases are kept")
+    run.add_argument("--output", help="json file to save the results to")
+    run.set_defaults(func=runBenchmarks)
+
+    compare = commands.add_parser("compare", help="compare two saved runs")
+    compare.add_argument("baseline", help="json results of the earlier run")
+    compare.add_argument("results", help="json results of the later run")
+    compare.add_argument("--threshold", type=float, default=THRESHOLD, help="relative slowdown that fails the comparison")
+    compare.add_argument("--min-delta", type=float, default=MIN_DELTA_MS, help="smallest slowdown in ms that fails the comparison")
+    compare.set_defaults(func=compareRuns)
+
+    args = parser.parse_args(argv[1:])
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
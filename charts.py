@@ -0,0 +1,249 @@
+"""
+Trending charts: the most played songs and artists over a time window.
+
+Run as:
+`charts.py <database.db> [--window 7d] [--top N] [--artists] [--end "YYYY-MM-DD HH:MM:SS"] [--prune]`
+
+Plays are counted in hourly and daily buckets per song (see
+schema.CHART_TABLES), kept up to date by triggers on listen, and an artist's
+plays are the plays of their songs. A play belongs to the hour and day its
+session started. A window ends at the end of the
+current hour (or of the hour of --end) and is made of whole hours: its
+whole days are read from the daily buckets and the partial days at either
+end from the hourly ones, so a chart reads at most 48 hourly buckets plus
+one daily bucket per day of the window per song played, however long the
+history.
+
+Hourly buckets older than HOURLY_RETENTION_DAYS can be pruned with --prune,
+which records up to where they were pruned in chart_pruned. The parts of a
+window before that are read from the daily buckets, rounded out to whole
+days, the rest of the window keeps its hours.
+"""
+import argparse
+import re
+import sys
+from datetime import datetime, timedelta
+import config
+
+TOP_N = 10
+WINDOW = "7d"
+HOURLY_RETENTION_DAYS = 35
+
+# Windows offered by the menu
+WINDOWS = ["24h", "7d", "30d"]
+
+HOUR_FORMAT = "%Y-%m-%d %H:00:00"
+DAY_FORMAT = "%Y-%m-%d"
+
+# Charts by kind: what the song buckets are grouped by and the join it
+# needs, and the table and column naming the grouped ids. The cross join
+# keeps the window's buckets as the outer loop, looking up each song's
+# artists, instead of scanning perform.
+CHART_KINDS = {
+    "songs": ("b.sid", "", "songs", "sid", "title"),
+    "artists": ("p.aid", "cross join perform p on p.sid = b.sid", "artists", "aid", "name"),
+}
+
+
+def parseWindow(window: str) -> timedelta:
+    """Parse a window length like '24h', '7d' or '2w'
+
+    Args:
+        window (str): number followed by h (hours), d (days) or w (weeks)
+
+    Raises:
+        ValueError: the window isn't in that form
+
+    Returns:
+        timedelta: the window length, in whole hours
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*([hdw])\s*", window.lower())
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid window '{window}', expected e.g. 24h, 7d or 2w")
+
+    hours = int(match.group(1)) * {"h": 1, "d": 24, "w": 24 * 7}[match.group(2)]
+    return timedelta(hours=hours)
+
+
+def floorDay(time: datetime) -> datetime:
+    return time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceilDay(time: datetime) -> datetime:
+    day = floorDay(time)
+    return day if day == time else day + timedelta(days=1)
+
+
+def windowRanges(length: timedelta, end: datetime = None, prunedBefore: datetime = None) -> dict[str, str]:
+    """Split a window into a leading and a trailing range of hourly buckets
+    and a range of daily buckets in between
+
+    Args:
+        length (timedelta): window length
+        end (datetime): time in the last hour of the window, now by default
+        prunedBefore (datetime): start of the day before which hourly
+            buckets were pruned, None if they never were
+
+    Returns:
+        dict[str, str]: start and end (exclusive) of each range, as bucket keys
+    """
+    end = (end or datetime.now()).replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    start = end - length
+    pruned = prunedBefore or datetime.min
+
+    # Hours that were pruned are read from their whole day
+    firstDay = floorDay(start) if start < pruned else ceilDay(start)
+    lastDay = ceilDay(end) if end <= pruned else floorDay(end)
+    if firstDay >= lastDay:
+        # A window within one day that wasn't pruned only reads hours
+        firstDay = lastDay = end
+
+    return {
+        "leadingStart": start.strftime(HOUR_FORMAT),
+        "leadingEnd": min(firstDay, end).strftime(HOUR_FORMAT),
+        "dayStart": firstDay.strftime(DAY_FORMAT),
+        "dayEnd": lastDay.strftime(DAY_FORMAT),
+        "trailingStart": max(lastDay, start).strftime(HOUR_FORMAT),
+        "trailingEnd": end.strftime(HOUR_FORMAT),
+    }
+
+
+def prunedBefore(cursor) -> datetime | None:
+    """Get up to where the hourly buckets were pruned
+
+    Args:
+        cursor (sqlite3.Cursor): cursor on the database
+
+    Returns:
+        datetime | None: start of the first day that still has its hourly
+            buckets, None if they were never pruned
+    """
+    cursor.execute("select hourly_before from chart_pruned where id = 1")
+    row = cursor.fetchone()
+
+    return None if row is None else datetime.fromisoformat(row[0])
+
+
+def topPlayed(kind: str, window: str = WINDOW, limit: int = TOP_N, end: datetime = None) -> list[tuple]:
+    """Get the most played songs or artists of a time window
+
+    Args:
+        kind (str): 'songs' or 'artists'
+        window (str): window length, see parseWindow
+        limit (int): number of songs or artists
+        end (datetime): time in the last hour of the window, now by default
+
+    Returns:
+        list[tuple]: (sid, title, plays) or (aid, name, plays) rows, most
+            played first
+    """
+    groupColumn, join, namesTable, idColumn, nameColumn = CHART_KINDS[kind]
+    length = parseWindow(window)
+    cursor = config.getConnection().cursor()
+    parameters = windowRanges(length, end, prunedBefore(cursor))
+    parameters["limit"] = limit
+
+    cursor.execute(
+        f"""
+            select t.id, n.{nameColumn}, t.plays
+            from (
+                select {groupColumn} as id, sum(b.plays) as plays
+                from (
+                    select sid, plays
+                    from song_plays_hourly
+                    where hour >= :leadingStart and hour < :leadingEnd
+                    union all
+                    select sid, plays
+                    from song_plays_daily
+                    where day >= :dayStart and day < :dayEnd
+                    union all
+                    select sid, plays
+                    from song_plays_hourly
+                    where hour >= :trailingStart and hour < :trailingEnd
+                ) b
+                {join}
+                group by id
+                having sum(b.plays) > 0
+                order by plays desc, id
+                limit :limit
+            ) t
+            inner join {namesTable} n on n.{idColumn} = t.id
+            order by t.plays desc, t.id
+        """,
+        parameters
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+
+    return rows
+
+
+def prune(connection, retentionDays: int = HOURLY_RETENTION_DAYS) -> int:
+    """Delete the hourly buckets older than the retention, their plays stay
+    in the daily buckets. Where they were pruned up to is recorded, in the
+    same transaction, so charts know which hours to read from the days.
+
+    Args:
+        connection (sqlite3.Connection): database connection
+        retentionDays (int): days of hourly buckets kept before today
+
+    Returns:
+        int: number of buckets deleted
+    """
+    cutoff = (floorDay(datetime.now()) - timedelta(days=retentionDays)).strftime(HOUR_FORMAT)
+    with connection:
+        deleted = connection.execute("delete from song_plays_hourly where hour < ?", (cutoff,)).rowcount
+        connection.execute(
+            """
+                insert into chart_pruned (id, hourly_before)
+                values (1, ?)
+                on conflict (id) do update
+                set hourly_before = max(hourly_before, excluded.hourly_before)
+            """,
+            (cutoff,)
+        )
+
+    return deleted
+
+
+def printChart(kind: str, window: str, limit: int = TOP_N, end: datetime = None) -> None:
+    """Print the most played songs or artists of a time window
+
+    Args:
+        kind (str): 'songs' or 'artists'
+        window (str): window length, see parseWindow
+        limit (int): number of songs or artists
+        end (datetime): time in the last hour of the window, now by default
+    """
+    rows = topPlayed(kind, window, limit, end)
+    config.dispHeader(f"Top {kind} of the last {window}")
+    if not rows:
+        print("No plays in this window")
+    for rank, (key, name, plays) in enumerate(rows, start=1):
+        print(f"{rank:3d} | {key} | {name} | {plays:g} plays")
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Show the most played songs or artists of a time window")
+    parser.add_argument("database", help="sqlite database file")
+    parser.add_argument("--window", default=WINDOW, help="window length, e.g. 24h, 7d, 30d")
+    parser.add_argument("--top", type=int, default=TOP_N, help="number of songs or artists")
+    parser.add_argument("--artists", action="store_true", help="chart artists instead of songs")
+    parser.add_argument("--end", help="end the window in this hour instead of now, 'YYYY-MM-DD HH:MM:SS'")
+    parser.add_argument("--prune", action="store_true", help=f"delete hourly buckets older than {HOURLY_RETENTION_DAYS} days first")
+    args = parser.parse_args(argv[1:])
+
+    config.connect(args.database, verbose=True)
+    try:
+        if args.prune:
+            print(f"Pruned {prune(config.getConnection())} hourly buckets")
+        end = datetime.fromisoformat(args.end) if args.end else None
+        printChart("artists" if args.artists else "songs", args.window, args.top, end)
+    finally:
+        config.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,7 +1,11 @@
 import sqlite3
+import database
+import migrations
+import queryMetrics
+import slowQueryLog
 
-connection = None
-cursor = None
+# Connection manager of the open database, see connect
+manager = None
 
 def dispMessage(msg: str):
     print()
@@ -14,9 +18,64 @@ def dispHeader(content: str):
     print(content)
     print("-" * 120)
 
-def connect(path: str) -> None:
-    global connection, cursor
-    connection = sqlite3.connect(path)
-    cursor = connection.cursor()
-    cursor.execute(' PRAGMA foreign_keys=ON; ')
-    connection.commit()
\ No newline at end of file
+def canonicalId(id: str) -> str:
+    """Convert a user or artist id to the form it is stored in the database
+
+    Args:
+        id (str): user or artist id as entered
+
+    Returns:
+        str: trimmed, lowercase id
+    """
+    return id.strip().lower()
+
+def connect(path: str, verbose: bool = False, **options) -> list[tuple[int, str, float]]:
+    """Open the database and bring its schema up to date. Connections are
+    then obtained per thread through getConnection/getCursor.
+
+    Args:
+        path (str): path of the sqlite database file
+        verbose (bool): print the schema migrations applied and their times
+        options: connection settings passed to database.ConnectionManager
+
+    Returns:
+        list[tuple[int, str, float]]: migrations applied, see migrations.migrate
+    """
+    global manager
+    queryMetrics.enableFromEnvironment()
+    slowQueryLog.enableFromEnvironment()
+    manager = database.ConnectionManager(path, **options)
+    return migrations.migrate(manager.getConnection(), verbose)
+
+def getConnection() -> sqlite3.Connection:
+    """Get the calling thread's database connection
+
+    Returns:
+        sqlite3.Connection: database connection
+    """
+    return manager.getConnection()
+
+def getCursor() -> sqlite3.Cursor:
+    """Get the calling thread's shared database cursor
+
+    Returns:
+        sqlite3.Cursor: database cursor
+    """
+    return manager.getCursor()
+
+def releaseConnection() -> None:
+    """
+    Close the calling thread's database connection, for threads that stop
+    while the others keep using the database
+    """
+    if manager is not None:
+        manager.releaseConnection()
+
+def close() -> None:
+    """
+    Close all database connections
+    """
+    global manager
+    if manager is not None:
+        manager.closeAll()
+        manager = None
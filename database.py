@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import queryMetrics
+
+# Default connection settings, see ConnectionManager
+BUSY_TIMEOUT = 5.0
+SYNCHRONOUS = "NORMAL"
+CACHE_SIZE = -20000         # negative values are in KiB, so ~20MB of page cache
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+class ConnectionManager():
+    """
+    Hands out sqlite3 connections to a database file, one per thread, all
+    configured the same way: WAL journal mode so readers don't block the
+    writer, a busy timeout so concurrent writers wait instead of failing,
+    and tunable synchronous/cache_size/mmap_size pragmas.
+    """
+    def __init__(
+        self,
+        path: str,
+        busyTimeout: float = BUSY_TIMEOUT,
+        synchronous: str = SYNCHRONOUS,
+        cacheSize: int = CACHE_SIZE,
+        mmapSize: int = MMAP_SIZE
+    ) -> None:
+        self.path = path
+        self.busyTimeout = busyTimeout
+        self.synchronous = synchronous
+        self.cacheSize = cacheSize
+        self.mmapSize = mmapSize
+
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def openConnection(self) -> sqlite3.Connection:
+        """Open and configure a new connection
+
+        Returns:
+            sqlite3.Connection: new connection
+        """
+        # Connections are only used by the thread that opened them, but are
+        # closed from whichever thread calls closeAll. They time their
+        # statements if queryMetrics is enabled.
+        connection = sqlite3.connect(
+            self.path,
+            timeout=self.busyTimeout,
+            check_same_thread=False,
+            factory=queryMetrics.connectionFactory()
+        )
+        cursor = connection.cursor()
+        cursor.execute(' PRAGMA foreign_keys=ON; ')
+        cursor.execute(' PRAGMA journal_mode=WAL; ')
+        cursor.execute(f' PRAGMA synchronous={self.synchronous}; ')
+        cursor.execute(f' PRAGMA cache_size={int(self.cacheSize)}; ')
+        cursor.execute(f' PRAGMA mmap_size={int(self.mmapSize)}; ')
+        connection.commit()
+
+        return connection
+
+    def getConnection(self) -> sqlite3.Connection:
+        """Get the calling thread's connection, opening it on first use
+
+        Returns:
+            sqlite3.Connection: connection owned by the calling thread
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.openConnection()
+            self.local.connection = connection
+            self.local.cursor = connection.cursor()
+            with self.lock:
+                self.connections.append(connection)
+
+        return connection
+
+    def getCursor(self) -> sqlite3.Cursor:
+        """Get the calling thread's shared cursor
+
+        Returns:
+            sqlite3.Cursor: cursor on the calling thread's connection
+        """
+        self.getConnection()
+        return self.local.cursor
+
+    def releaseConnection(self) -> None:
+        """
+        Commit and close the calling thread's connection, if it has one. For
+        threads that stop before the manager is closed.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            return
+
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        self.local.connection = None
+        self.local.cursor = None
+
+        connection.commit()
+        connection.close()
+
+    def closeAll(self) -> None:
+        """
+        Commit and close every connection handed out by this manager
+        """
+        with self.lock:
+            connections, self.connections = self.connections, []
+
+        for connection in connections:
+            connection.commit()
+            connection.close()
+
+        self.local = threading.local()
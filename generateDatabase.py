@@ -0,0 +1,319 @@
+"""
+Synthetic database generator.
+
+Run as:
+`generateDatabase.py <output.db> [--users N] [--artists N] [--songs N]
+    [--playlists N] [--listens N] [--seed N] [--zipf S] [--force]`
+
+Writes a new database with the mp1.db schema filled with generated data.
+The same seed and sizes always give the same database. Song popularity
+follows a Zipf distribution (exponent --zipf), both for listens and for
+playlist contents, and so do the number of songs per artist and the number
+of sessions per user. Playlist lengths have a long tail: most playlists are
+short, a few have hundreds of songs.
+
+Rows are inserted in bulk with journaling and syncing off, and the derived
+tables and indexes from schema are built once at the end.
+"""
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+import migrations
+import schema
+
+USERS = 1000
+ARTISTS = 500
+SONGS = 20000
+PLAYLISTS = 2000
+LISTENS = 200000
+SEED = 0
+ZIPF_EXPONENT = 1.1
+
+# Average number of distinct songs played in a session
+SONGS_PER_SESSION = 8
+
+# Playlist lengths: pareto shape, and the longest playlist
+PLAYLIST_LENGTH_SHAPE = 1.2
+MAX_PLAYLIST_LENGTH = 500
+
+# Share of songs performed by a second, featured artist
+FEATURED_SHARE = 0.1
+
+# Sessions are spread over this period
+FIRST_SESSION = datetime(2020, 1, 1)
+SESSION_PERIOD = timedelta(days=3 * 365)
+
+WORDS = [
+    "love", "night", "heart", "fire", "dream", "summer", "rain", "dance", "light", "blue",
+    "wild", "gold", "home", "river", "stars", "money", "young", "forever", "baby", "city",
+    "ocean", "shadow", "thunder", "sugar", "ghost", "paradise", "broken", "midnight", "echo", "road",
+    "sky", "wave", "storm", "diamond", "angel", "tonight", "freedom", "memory", "stranger", "sunset",
+]
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Casey", "Riley", "Morgan", "Jamie", "Avery", "Quinn"]
+LAST_NAMES = ["Smith", "Lee", "Garcia", "Khan", "Nguyen", "Brown", "Silva", "Cohen", "Ito", "Okafor"]
+NATIONALITIES = ["American", "Canadian", "British", "Australian", "Brazilian", "Korean", "Nigerian", "Swedish", "French", "Mexican"]
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Rows are buffered and inserted this many at a time
+CHUNK_SIZE = 50000
+
+
+class ZipfSampler():
+    """
+    Draws items with probability proportional to 1 / rank ** exponent. Ranks
+    are assigned to the items in a random order, so the popular items are
+    spread over the id range.
+    """
+    def __init__(self, rng: random.Random, items: list, exponent: float) -> None:
+        self.rng = rng
+        self.items = list(items)
+        rng.shuffle(self.items)
+        self.cumulativeWeights = list(itertools.accumulate(
+            1 / rank ** exponent for rank in range(1, len(self.items) + 1)
+        ))
+        self.total = self.cumulativeWeights[-1]
+
+    def sample(self):
+        """Draw one item
+
+        Returns:
+            Any: the item
+        """
+        index = bisect.bisect(self.cumulativeWeights, self.rng.random() * self.total)
+        return self.items[min(index, len(self.items) - 1)]
+
+    def sampleDistinct(self, count: int) -> list:
+        """Draw 'count' different items, or every item if there are fewer
+
+        Args:
+            count (int): number of items
+
+        Returns:
+            list: the items, in the order they were drawn
+        """
+        count = min(count, len(self.items))
+        drawn = {}
+        for _ in range(count * 20):
+            if len(drawn) >= count:
+                break
+            drawn.setdefault(self.sample(), None)
+
+        # Rare items may take too long to draw, fill up with the most popular ones not drawn yet
+        for item in self.items:
+            if len(drawn) >= count:
+                break
+            drawn.setdefault(item, None)
+
+        return list(drawn)
+
+
+def insertRows(connection: sqlite3.Connection, sql: str, rows) -> int:
+    """Insert rows in chunks of CHUNK_SIZE, each chunk in one transaction
+
+    Args:
+        connection (sqlite3.Connection): connection to the new database
+        sql (str): insert statement
+        rows (Iterable[tuple]): rows to insert
+
+    Returns:
+        int: number of rows inserted
+    """
+    total = 0
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, CHUNK_SIZE)):
+        connection.executemany(sql, chunk)
+        connection.commit()
+        total += len(chunk)
+
+    return total
+
+
+def generateUsers(rng: random.Random, count: int):
+    for i in range(1, count + 1):
+        yield (f"u{i}", f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}", f"pw{rng.randrange(10 ** 6)}")
+
+
+def generateArtists(rng: random.Random, count: int):
+    for i in range(1, count + 1):
+        name = " ".join(rng.sample(WORDS, rng.randint(1, 2))).title()
+        yield (f"a{i}", name, rng.choice(NATIONALITIES), f"pw{rng.randrange(10 ** 6)}")
+
+
+def generateSongs(rng: random.Random, count: int):
+    for sid in range(1, count + 1):
+        title = " ".join(rng.sample(WORDS, rng.randint(1, 4))).capitalize()
+        yield (sid, title, max(60, int(rng.gauss(215, 45))))
+
+
+def generatePerform(rng: random.Random, artistSampler: ZipfSampler, songs: int):
+    for sid in range(1, songs + 1):
+        aids = artistSampler.sampleDistinct(2 if rng.random() < FEATURED_SHARE else 1)
+        for aid in aids:
+            yield (aid, sid)
+
+
+def generatePlaylists(rng: random.Random, count: int, users: int):
+    for pid in range(1, count + 1):
+        title = " ".join(rng.sample(WORDS, rng.randint(1, 3))).title()
+        yield (pid, title, f"u{rng.randint(1, users)}")
+
+
+def generatePlinclude(rng: random.Random, songSampler: ZipfSampler, playlists: int):
+    for pid in range(1, playlists + 1):
+        length = min(MAX_PLAYLIST_LENGTH, int(rng.paretovariate(PLAYLIST_LENGTH_SHAPE)) * 3)
+        for sorder, sid in enumerate(songSampler.sampleDistinct(length), start=1):
+            yield (pid, sid, sorder)
+
+
+def planSessions(rng: random.Random, userSampler: ZipfSampler, listens: int) -> dict[str, int]:
+    """Decide how many sessions each user has, heavy users having many more
+
+    Args:
+        rng (random.Random): random number generator
+        userSampler (ZipfSampler): draws users by activity
+        listens (int): target number of listen rows
+
+    Returns:
+        dict[str, int]: number of sessions by uid
+    """
+    sessions = {}
+    for _ in range(max(1, listens // SONGS_PER_SESSION)):
+        uid = userSampler.sample()
+        sessions[uid] = sessions.get(uid, 0) + 1
+
+    return dict(sorted(sessions.items(), key=lambda item: int(item[0][1:])))
+
+
+def generateSessions(rng: random.Random, sessionCounts: dict[str, int]):
+    for uid, count in sessionCounts.items():
+        # Sessions of a user are numbered in the order they started
+        starts = sorted(rng.random() for _ in range(count))
+        for sno, position in enumerate(starts, start=1):
+            start = FIRST_SESSION + SESSION_PERIOD * position
+            end = start + timedelta(minutes=rng.randint(5, 240))
+            yield (uid, sno, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT))
+
+
+def generateListens(rng: random.Random, songSampler: ZipfSampler, sessionCounts: dict[str, int], listens: int):
+    sessions = sum(sessionCounts.values())
+    remaining = listens
+    for uid, count in sessionCounts.items():
+        for sno in range(1, count + 1):
+            # Spread the remaining listen rows evenly over the remaining
+            # sessions, the last one takes whatever the rounding left over
+            # (as many as there are songs to play in one session)
+            length = max(1, round(remaining / sessions * rng.uniform(0.25, 1.75)))
+            length = remaining if sessions == 1 else min(length, remaining)
+            sids = songSampler.sampleDistinct(length)
+            for sid in sids:
+                yield (uid, sno, sid, float(rng.randint(1, 5)))
+            remaining -= len(sids)
+            sessions -= 1
+
+
+def generateDatabase(path: str, users: int, artists: int, songs: int, playlists: int,
+                     listens: int, seed: int, exponent: float) -> dict[str, int]:
+    """Create and fill a new database at 'path'
+
+    Args:
+        path (str): database file, must not exist yet
+        users (int): number of users
+        artists (int): number of artists
+        songs (int): number of songs
+        playlists (int): number of playlists
+        listens (int): number of listen rows
+        seed (int): random seed
+        exponent (float): Zipf exponent of song, artist and user popularity
+
+    Returns:
+        dict[str, int]: number of rows in each table
+    """
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    connection.executescript(
+        """
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            PRAGMA cache_size = -200000;
+        """
+    )
+    connection.executescript(schema.BASE_TABLES)
+
+    songSampler = ZipfSampler(rng, range(1, songs + 1), exponent)
+    artistSampler = ZipfSampler(rng, [f"a{i}" for i in range(1, artists + 1)], exponent)
+    userSampler = ZipfSampler(rng, [f"u{i}" for i in range(1, users + 1)], exponent)
+
+    counts = {}
+    steps = [
+        ("users", "insert into users values (?, ?, ?)", lambda: generateUsers(rng, users)),
+        ("artists", "insert into artists values (?, ?, ?, ?)", lambda: generateArtists(rng, artists)),
+        ("songs", "insert into songs values (?, ?, ?)", lambda: generateSongs(rng, songs)),
+        ("perform", "insert into perform values (?, ?)", lambda: generatePerform(rng, artistSampler, songs)),
+        ("playlists", "insert into playlists values (?, ?, ?)", lambda: generatePlaylists(rng, playlists, users)),
+        ("plinclude", "insert into plinclude values (?, ?, ?)", lambda: generatePlinclude(rng, songSampler, playlists)),
+    ]
+
+    sessionCounts = planSessions(rng, userSampler, listens)
+    steps += [
+        ("sessions", "insert into sessions values (?, ?, ?, ?)", lambda: generateSessions(rng, sessionCounts)),
+        ("listen", "insert into listen values (?, ?, ?, ?)", lambda: generateListens(rng, songSampler, sessionCounts, listens)),
+    ]
+
+    for table, sql, rows in steps:
+        startTime = time.perf_counter()
+        counts[table] = insertRows(connection, sql, rows())
+        elapsed = time.perf_counter() - startTime
+        print(f"{table}: {counts[table]} rows in {elapsed:.2f}s ({counts[table] / max(elapsed, 1e-9):.0f} rows/s)")
+
+    # Build the derived tables once over the loaded data, rather than
+    # maintaining them row by row with triggers during the load
+    startTime = time.perf_counter()
+    migrations.migrate(connection)
+    connection.execute("analyze")
+    connection.commit()
+    print(f"derived tables and indexes: {time.perf_counter() - startTime:.2f}s")
+
+    connection.close()
+    return counts
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Generate a database with synthetic data")
+    parser.add_argument("database", help="sqlite database file to create")
+    parser.add_argument("--users", type=int, default=USERS)
+    parser.add_argument("--artists", type=int, default=ARTISTS)
+    parser.add_argument("--songs", type=int, default=SONGS)
+    parser.add_argument("--playlists", type=int, default=PLAYLISTS)
+    parser.add_argument("--listens", type=int, default=LISTENS, help="number of listen rows")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--zipf", type=float, default=ZIPF_EXPONENT, help="Zipf exponent of popularity")
+    parser.add_argument("--force", action="store_true", help="replace the database file if it exists")
+    args = parser.parse_args(argv[1:])
+
+    if os.path.exists(args.database):
+        if not args.force:
+            print(f"{args.database} already exists, use --force to replace it")
+            return 1
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(args.database + suffix):
+                os.remove(args.database + suffix)
+
+    startTime = time.perf_counter()
+    generateDatabase(
+        args.database, args.users, args.artists, args.songs, args.playlists,
+        args.listens, args.seed, args.zipf
+    )
+    print(f"Done: generated {args.database} in {time.perf_counter() - startTime:.2f}s")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,248 @@
+'''
+Bulk import of historical listen records.
+
+Run as:
+`importListens.py <database.db> <listens.csv | listens.jsonl> [--batch-size N] [--defer-foreign-keys]`
+
+Each record has the fields uid, sno, sid and optionally cnt, start and end.
+A record stands for cnt plays of the song in that session (default 1), like
+the one record per play of the edge logs. The records are first staged in a
+temporary table, then the plays of every (uid, sno, sid) across the whole
+file are added up and the listen row is set to that total, so importing the
+same file twice leaves the database unchanged. Sessions that don't exist
+yet are created from the start/end fields of their first record.
+'''
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+import config
+import songProfile
+
+BATCH_SIZE = 50000
+
+# records of the file being imported, in file order
+create_staging_query = '''
+                    CREATE TEMP TABLE IF NOT EXISTS listen_import (
+                        uid     char(4),
+                        sno     int,
+                        sid     int,
+                        cnt     real,
+                        start   date,
+                        end     date
+                    );
+                    '''
+
+stage_record_query = '''
+                    INSERT INTO temp.listen_import (uid, sno, sid, cnt, start, end)
+                    VALUES (:uid, :sno, :sid, :cnt, :start, :end);
+                    '''
+
+# total plays of each listen row of the file, numbered for batching
+create_totals_query = '''
+                    CREATE TEMP TABLE listen_import_totals AS
+                    SELECT uid, sno, sid, sum(cnt) AS cnt
+                    FROM temp.listen_import
+                    GROUP BY uid, sno, sid;
+                    '''
+
+# create the sessions the users don't have yet, from their first record
+add_sessions_query = '''
+                    INSERT OR IGNORE INTO sessions (uid, sno, start, end)
+                    SELECT uid, sno, start, end
+                    FROM temp.listen_import
+                    WHERE rowid IN
+                            (SELECT min(rowid)
+                            FROM temp.listen_import
+                            GROUP BY uid, sno);
+                    '''
+
+# set the listen counts of a batch of totals, so re-importing is a no-op
+upsert_listens_query = '''
+                    INSERT INTO listen (uid, sno, sid, cnt)
+                    SELECT uid, sno, sid, cnt
+                    FROM temp.listen_import_totals
+                    WHERE rowid > :after AND rowid <= :last
+                    ORDER BY rowid
+                    ON CONFLICT (uid, sno, sid) DO UPDATE
+                    SET cnt = excluded.cnt
+                    WHERE cnt IS NOT excluded.cnt;
+                    '''
+
+# the songs of a batch of totals
+batch_sids_query = '''
+                    SELECT DISTINCT sid
+                    FROM temp.listen_import_totals
+                    WHERE rowid > :after AND rowid <= :last;
+                    '''
+
+
+def read_records(path):
+    '''
+    stream listen records from a csv (with header row) or jsonl file.
+
+    takes in the path of the file, yields each record as a dict.
+    '''
+    with open(path, newline='') as file:
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+
+def to_row(record):
+    '''
+    convert a raw record into the parameters of the import queries.
+
+    takes in a record dict, returns a dict with canonical uid and typed values.
+    '''
+    return {
+        "uid": config.canonicalId(str(record["uid"])),
+        "sno": int(record["sno"]),
+        "sid": int(record["sid"]),
+        "cnt": float(record.get("cnt") or 1),
+        "start": record.get("start") or None,
+        "end": record.get("end") or None,
+    }
+
+
+def stage_records(connection, path, batch_size):
+    '''
+    copy the records of a file into the staging table, batch_size records
+    per insert. The staging table is temporary, so this takes no lock on the
+    database.
+
+    takes in the connection, the path of the csv/jsonl file and the batch
+    size. Returns the number of records read.
+    '''
+    cursor = connection.cursor()
+    cursor.execute('DROP TABLE IF EXISTS temp.listen_import;')
+    cursor.execute('DROP TABLE IF EXISTS temp.listen_import_totals;')
+    cursor.execute(create_staging_query)
+
+    total = 0
+    batch = []
+    for record in read_records(path):
+        batch.append(to_row(record))
+        if len(batch) >= batch_size:
+            cursor.executemany(stage_record_query, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(stage_record_query, batch)
+        total += len(batch)
+    connection.commit()
+
+    cursor.execute(create_totals_query)
+    connection.commit()
+
+    return total
+
+
+def write_batch(connection, after, last, defer_foreign_keys):
+    '''
+    set the listen rows of one batch of totals in a single transaction.
+
+    takes in the connection, the rowid range (after, last] of the totals to
+    write and whether foreign key checks are deferred to the end of the
+    transaction.
+    '''
+    cursor = connection.cursor()
+    batch = {"after": after, "last": last}
+
+    try:
+        cursor.execute('BEGIN;')
+        if defer_foreign_keys:
+            cursor.execute('PRAGMA defer_foreign_keys = ON;')
+        cursor.execute(upsert_listens_query, batch)
+        cursor.execute('COMMIT;')
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+
+    # cached song profiles show the old play counts
+    cursor.execute(batch_sids_query, batch)
+    songProfile.invalidate({row[0] for row in cursor.fetchall()})
+
+
+def add_sessions(connection, defer_foreign_keys):
+    '''
+    create the sessions of the staged records that don't exist yet, in a
+    single transaction.
+
+    takes in the connection and whether foreign key checks are deferred.
+    '''
+    cursor = connection.cursor()
+    try:
+        cursor.execute('BEGIN;')
+        if defer_foreign_keys:
+            cursor.execute('PRAGMA defer_foreign_keys = ON;')
+        cursor.execute(add_sessions_query)
+        cursor.execute('COMMIT;')
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+
+
+def import_listens(connection, path, batch_size=BATCH_SIZE, defer_foreign_keys=False):
+    '''
+    import all listen records of a file: stage them, create the missing
+    sessions, then write the summed listen rows batch_size rows per
+    transaction, printing progress and throughput after each batch.
+
+    takes in the connection, the path of the csv/jsonl file, the batch size and
+    whether foreign key checks are deferred. Returns the number of records read.
+    '''
+    start_time = time.perf_counter()
+    total = stage_records(connection, path, batch_size)
+    elapsed = time.perf_counter() - start_time
+    print(f"Staged {total} records in {elapsed:.2f}s")
+
+    cursor = connection.cursor()
+    try:
+        add_sessions(connection, defer_foreign_keys)
+
+        cursor.execute('SELECT count(*) FROM temp.listen_import_totals;')
+        rows = cursor.fetchone()[0]
+        for after in range(0, rows, batch_size):
+            last = min(after + batch_size, rows)
+            write_batch(connection, after, last, defer_foreign_keys)
+            elapsed = time.perf_counter() - start_time
+            print(f"Imported {last}/{rows} listen rows ({last / elapsed:.0f} rows/s)")
+    finally:
+        cursor.execute('DROP TABLE IF EXISTS temp.listen_import;')
+        cursor.execute('DROP TABLE IF EXISTS temp.listen_import_totals;')
+        connection.commit()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Done: imported {total} records in {elapsed:.2f}s ({total / max(elapsed, 1e-9):.0f} records/s)")
+
+    return total
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Bulk import listen records into the database")
+    parser.add_argument("database", help="sqlite database file")
+    parser.add_argument("file", help="csv or jsonl file of listen records")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="records per transaction")
+    parser.add_argument(
+        "--defer-foreign-keys",
+        action="store_true",
+        help="check foreign keys at the end of each transaction instead of per row"
+    )
+    args = parser.parse_args(argv[1:])
+
+    config.connect(args.database)
+
+    import_listens(config.getConnection(), args.file, args.batch_size, args.defer_foreign_keys)
+
+    config.close()
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,188 @@
+'''
+Bulk ingest of an artist catalog.
+
+Run as:
+`ingestCatalog.py <database.db> <catalog.csv> [--batch-size N]`
+
+The csv has a header row with the fields title, duration and aid. A song
+that is already in the catalog (same title, ignoring case, and duration) is
+reused, otherwise it gets a new sid. Every record adds the artist as a
+performer of the song, so ingesting the same file twice leaves the database
+unchanged.
+'''
+import argparse
+import csv
+import sqlite3
+import sys
+import time
+import config
+import searchCache
+import songProfile
+
+BATCH_SIZE = 10000
+
+# sqlite's NOCASE collation only folds ascii letters, keys of songs in a batch are folded the same way
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+# return the sid of a song already in the database with the given title and duration (uses songs_title_nocase_duration)
+existing_sid_query = '''
+                    SELECT songs.sid
+                    FROM songs
+                    WHERE songs.title =:title COLLATE NOCASE
+                    AND songs.duration =:duration
+                    LIMIT 1;
+                    '''
+
+# return the song sid of the last song sid
+sid_query = '''
+            SELECT coalesce(max(songs.sid), 0)
+            FROM songs;
+            '''
+
+add_song_query = '''
+                INSERT INTO songs (sid, title, duration)
+                VALUES (:sid, :title, :duration);
+                '''
+
+# add the song and artist to the performed table, unless already there
+add_perform_query = '''
+                    INSERT OR IGNORE INTO perform (aid, sid)
+                    VALUES (:aid, :sid);
+                    '''
+
+
+def read_records(path):
+    '''
+    stream catalog records from a csv file with a header row.
+
+    takes in the path of the file, yields each record as a dict.
+    '''
+    with open(path, newline='') as file:
+        yield from csv.DictReader(file)
+
+
+def to_row(record):
+    '''
+    convert a raw record into the parameters of the ingest queries.
+
+    takes in a record dict, returns a dict with canonical aid and typed values.
+    '''
+    return {
+        "title": record["title"].strip(),
+        "duration": int(record["duration"]),
+        "aid": config.canonicalId(str(record["aid"])),
+    }
+
+
+def song_key(row):
+    '''
+    takes in a row dict, returns the key two rows of the same song share.
+    '''
+    return (row["title"].translate(ASCII_LOWER), row["duration"])
+
+
+def write_batch(connection, rows):
+    '''
+    write one batch of catalog rows in a single transaction. songs already in
+    the database keep their sid, new songs get a block of sids after the
+    current largest one.
+
+    takes in the connection and a list of row dicts. returns the number of
+    songs added.
+    '''
+    cursor = connection.cursor()
+
+    # one entry per distinct song of the batch, the first title spelling wins
+    songs = {}
+    for row in rows:
+        songs.setdefault(song_key(row), row)
+
+    try:
+        # take the write lock up front so the sid block can't be taken by another writer
+        cursor.execute('BEGIN IMMEDIATE;')
+
+        sids = {}
+        new_songs = []
+        for key, row in songs.items():
+            cursor.execute(existing_sid_query, row)
+            existing_sid = cursor.fetchone()
+            if existing_sid is not None:
+                sids[key] = existing_sid[0]
+            else:
+                new_songs.append((key, row))
+
+        cursor.execute(sid_query)
+        last_sid = cursor.fetchone()[0]
+        new_rows = []
+        for i, (key, row) in enumerate(new_songs, start=1):
+            sids[key] = last_sid + i
+            new_rows.append({"sid":last_sid + i, "title":row["title"], "duration":row["duration"]})
+
+        cursor.executemany(add_song_query, new_rows)
+        cursor.executemany(add_perform_query, (
+            {"aid":row["aid"], "sid":sids[song_key(row)]} for row in rows
+        ))
+        cursor.execute('COMMIT;')
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+
+    # cached search results may be missing the new songs, and cached song profiles the artists
+    searchCache.bumpWriteGeneration()
+    songProfile.invalidate(sids.values())
+
+    return len(new_rows)
+
+
+def ingest_catalog(connection, path, batch_size=BATCH_SIZE):
+    '''
+    ingest all records of a catalog file, batch_size records per transaction,
+    printing progress and throughput after each batch.
+
+    takes in the connection, the path of the csv file and the batch size.
+    returns the number of records read and the number of songs added.
+    '''
+    start_time = time.perf_counter()
+    total = 0
+    added = 0
+    batch = []
+
+    for record in read_records(path):
+        batch.append(to_row(record))
+        if len(batch) >= batch_size:
+            added += write_batch(connection, batch)
+            total += len(batch)
+            batch = []
+            elapsed = time.perf_counter() - start_time
+            print(f"Ingested {total} records, {added} new songs ({total / elapsed:.0f} rows/s)")
+
+    if batch:
+        added += write_batch(connection, batch)
+        total += len(batch)
+
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"Done: ingested {total} records, {added} new songs in {elapsed:.2f}s "
+        f"({total / max(elapsed, 1e-9):.0f} rows/s)"
+    )
+
+    return total, added
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Bulk ingest an artist catalog into the database")
+    parser.add_argument("database", help="sqlite database file")
+    parser.add_argument("file", help="csv file of catalog records (title, duration, aid)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="records per transaction")
+    args = parser.parse_args(argv[1:])
+
+    config.connect(args.database)
+
+    ingest_catalog(config.getConnection(), args.file, args.batch_size)
+
+    config.close()
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv)
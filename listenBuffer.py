@@ -0,0 +1,184 @@
+import json
+import sqlite3
+import threading
+import time
+import config
+import songProfile
+
+# Default flush thresholds: number of buffered plays, and age in seconds of
+# the oldest buffered play
+MAX_PENDING_EVENTS = 50
+MAX_PENDING_SECONDS = 30.0
+
+# Seconds between checks of the time threshold when no plays come in
+FLUSH_CHECK_SECONDS = 1.0
+
+# Add the buffered plays to the listen table, creating rows as needed
+FLUSH_QUERY = '''
+            INSERT INTO listen (uid, sno, sid, cnt)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (uid, sno, sid) DO UPDATE
+            SET cnt = cnt + excluded.cnt;
+            '''
+
+
+# The sids of a flush that are songs, given as a JSON list, so the whole
+# batch is checked in one statement
+KNOWN_SONGS_QUERY = '''
+            SELECT songs.sid
+            FROM json_each(?) AS ids
+            INNER JOIN songs ON songs.sid = ids.value;
+            '''
+
+
+class ListenBuffer():
+    """
+    Write-behind buffer for listen events. Plays are coalesced in memory per
+    (uid, sno, sid) and written to the listen table in a single transaction
+    once enough plays are buffered or the oldest one is old enough. Rows the
+    database refuses when flushed are reported and dropped instead of being
+    retried forever.
+    """
+    def __init__(
+        self,
+        maxEvents: int = MAX_PENDING_EVENTS,
+        maxSeconds: float = MAX_PENDING_SECONDS
+    ) -> None:
+        self.maxEvents = maxEvents
+        self.maxSeconds = maxSeconds
+
+        self.pending = {}
+        self.pendingEvents = 0
+        self.oldestEventTime = None
+        self.lock = threading.Lock()
+
+    def add(self, uid: str, sno: int, sid: int, cnt: float = 1) -> None:
+        """Buffer a listen event, flushing if a threshold is reached
+
+        Args:
+            uid (str): user id
+            sno (int): session number the song was played in
+            sid (int): song id
+            cnt (float): number of plays
+        """
+        with self.lock:
+            key = (uid, sno, sid)
+            self.pending[key] = self.pending.get(key, 0) + cnt
+            self.pendingEvents += 1
+            if self.oldestEventTime is None:
+                self.oldestEventTime = time.monotonic()
+
+        self.flushIfDue()
+
+    def isFlushDue(self) -> bool:
+        """Check if the buffered events have reached the size or time threshold
+
+        Returns:
+            bool: should the buffer be flushed
+        """
+        if self.oldestEventTime is None:
+            return False
+
+        return (
+            self.pendingEvents >= self.maxEvents
+            or time.monotonic() - self.oldestEventTime >= self.maxSeconds
+        )
+
+    def flushIfDue(self) -> tuple[int, int]:
+        """Flush the buffer if a threshold is reached
+
+        Returns:
+            tuple[int, int]: number of listen rows written and refused
+        """
+        if self.isFlushDue():
+            return self.flush()
+
+        return 0, 0
+
+    def flush(self) -> tuple[int, int]:
+        """Write all buffered events to the listen table in one transaction.
+        Plays of songs that don't exist are reported and dropped up front. If
+        another row fails a constraint, the rows are written one at a time
+        instead and the failing ones are reported and dropped too, so one bad
+        row can't hold back the others.
+
+        Returns:
+            tuple[int, int]: number of listen rows written and refused
+        """
+        with self.lock:
+            if not self.pending:
+                return 0, 0
+
+            rows = [(uid, sno, sid, cnt) for (uid, sno, sid), cnt in self.pending.items()]
+            connection = config.getConnection()
+            try:
+                sids = sorted({sid for (_, _, sid, _) in rows})
+                songs = {row[0] for row in connection.execute(KNOWN_SONGS_QUERY, (json.dumps(sids),))}
+                rejected = [row for row in rows if row[2] not in songs]
+                rows = [row for row in rows if row[2] in songs]
+
+                try:
+                    connection.executemany(FLUSH_QUERY, rows)
+                except sqlite3.IntegrityError:
+                    connection.rollback()
+                    for row in rows:
+                        try:
+                            connection.execute(FLUSH_QUERY, row)
+                        except sqlite3.IntegrityError:
+                            # only the failing statement is undone, the
+                            # rows written before it stay in the transaction
+                            rejected.append(row)
+                connection.commit()
+            except sqlite3.Error:
+                connection.rollback()
+                raise
+
+            for uid, sno, sid, cnt in rejected:
+                config.dispMessage(f"Dropped {cnt:g} plays of song '{sid}' in session '{sno}' of user '{uid}': refused by the database")
+            refused = set(rejected)
+            written = [row for row in rows if row not in refused]
+
+            # cached song profiles show the old play counts
+            songProfile.invalidate({sid for (_, _, sid, _) in written})
+
+            self.pending = {}
+            self.pendingEvents = 0
+            self.oldestEventTime = None
+
+        return len(written), len(rejected)
+
+
+class FlushTimer():
+    """
+    Background thread flushing a listen buffer once its time threshold is
+    reached, so the last plays before an idle stretch are written without
+    waiting for the next play. The thread uses its own connection, closed
+    when the timer stops.
+    """
+    def __init__(self, buffer: ListenBuffer, interval: float = FLUSH_CHECK_SECONDS) -> None:
+        self.buffer = buffer
+        self.interval = interval
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the thread and wait for a flush in progress to finish
+        """
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self) -> None:
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.buffer.flushIfDue()
+                except sqlite3.Error:
+                    # the plays stay buffered and the next check retries
+                    pass
+        finally:
+            config.releaseConnection()
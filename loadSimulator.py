@@ -0,0 +1,312 @@
+"""
+Concurrent workload simulator.
+
+Run as:
+`loadSimulator.py <database.db> [--threads 1,4,16,64] [--stage-seconds S]
+    [--mix login=2,session=3,search=25,artists=5,listen=55,info=8,playlist=2]
+    [--think-ms MS] [--busy-timeout S] [--seed N]`
+
+Copies the database to a temporary file and simulates users on it from
+worker threads. Each worker logs in as a user, starts a session and then
+repeatedly picks an action from the behavior mix (weights per action).
+The run is split into stages with a growing number of workers, so the
+report shows where throughput stops growing and where latency and
+`database is locked` errors start to climb: throughput, latency
+percentiles and lock errors per stage, per action and per second.
+"""
+import argparse
+import random
+import sqlite3
+import sys
+import threading
+import time
+import config
+import mini_project_1
+import search
+import session
+import songFunctions
+import toolHelpers
+from toolHelpers import percentile
+
+THREADS = "1,4,16,64"
+STAGE_SECONDS = 10.0
+MIX = "login=2,session=3,search=25,artists=5,listen=55,info=8,playlist=2"
+THINK_MS = 0.0
+BUSY_TIMEOUT = 5.0
+SEED = 0
+
+# Percentiles reported for every stage and action
+PERCENTILES = (50, 95, 99)
+
+
+def isLockError(error: Exception) -> bool:
+    """Check if an error is sqlite's 'database is locked' (or 'busy')
+
+    Args:
+        error (Exception): raised error
+
+    Returns:
+        bool: is it a lock error
+    """
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def parseMix(mix: str) -> dict[str, float]:
+    """Parse a behavior mix like 'search=25,listen=55'
+
+    Args:
+        mix (str): comma separated action=weight pairs
+
+    Returns:
+        dict[str, float]: weight by action
+    """
+    weights = {}
+    for part in mix.split(","):
+        action, weight = part.split("=")
+        if action.strip() not in ACTIONS:
+            raise ValueError(f"Unknown action '{action}', must be one of {', '.join(ACTIONS)}")
+        weights[action.strip()] = float(weight)
+
+    return weights
+
+
+class SimulatedUser():
+    """
+    State of one simulated user: who it is logged in as, its session, and
+    the ids and search terms it picks from
+    """
+    def __init__(self, rng: random.Random, users: list[tuple], inputs: dict[str, list]) -> None:
+        self.rng = rng
+        self.users = users
+        self.inputs = inputs
+        self.uid = None
+        self.sessionManager = None
+
+    def login(self) -> None:
+        if self.sessionManager is not None and self.sessionManager.isSessionStarted():
+            self.sessionManager.endSession()
+
+        uid, pwd = self.rng.choice(self.users)
+        mini_project_1.check_login(uid, pwd)
+        self.uid = uid
+        self.sessionManager = session.SessionManager(uid, verbose=False)
+        self.sessionManager.startSession()
+
+    def session(self) -> None:
+        if self.sessionManager.isSessionStarted():
+            self.sessionManager.endSession()
+        self.sessionManager.startSession()
+
+    def search(self) -> None:
+        search.rankResults(search.querySongsAndPlaylists, self.rng.choice(self.inputs["terms"]))
+
+    def artists(self) -> None:
+        search.rankResults(search.queryArtists, self.rng.choice(self.inputs["terms"]))
+
+    def listen(self) -> None:
+        songFunctions.listen(self.uid, self.rng.choice(self.inputs["sids"]), self.sessionManager)
+
+    def info(self) -> None:
+        songFunctions.get_info(self.rng.choice(self.inputs["sids"]))
+
+    def playlist(self) -> None:
+        songFunctions.add_song_to_playlist(
+            self.rng.choice(self.inputs["titles"]), self.rng.choice(self.inputs["sids"]), self.uid
+        )
+
+    def logout(self) -> None:
+        if self.sessionManager is not None and self.sessionManager.isSessionStarted():
+            self.sessionManager.endSession()
+
+
+# Actions of the behavior mix, by name
+ACTIONS = {
+    "login": SimulatedUser.login,
+    "session": SimulatedUser.session,
+    "search": SimulatedUser.search,
+    "artists": SimulatedUser.artists,
+    "listen": SimulatedUser.listen,
+    "info": SimulatedUser.info,
+    "playlist": SimulatedUser.playlist,
+}
+
+
+class LoadStats():
+    """
+    Outcome of every action run by the workers: (time since the start,
+    action, latency, error kind or None)
+    """
+    def __init__(self) -> None:
+        self.startTime = time.perf_counter()
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, action: str, startTime: float, latency: float, error: str | None) -> None:
+        with self.lock:
+            self.records.append((startTime - self.startTime, action, latency, error))
+
+
+def runWorker(user: SimulatedUser, weights: dict[str, float], thinkTime: float,
+              stats: LoadStats, stop: threading.Event) -> None:
+    """Run random actions of the mix as one user until stopped
+
+    Args:
+        user (SimulatedUser): the simulated user
+        weights (dict[str, float]): weight by action
+        thinkTime (float): pause between actions in seconds
+        stats (LoadStats): collects the outcomes
+        stop (threading.Event): set when the run is over
+    """
+    actions = list(weights)
+    actionWeights = [weights[action] for action in actions]
+    action = "login"
+    while not stop.is_set():
+        startTime = time.perf_counter()
+        error = None
+        try:
+            ACTIONS[action](user)
+        except sqlite3.Error as exception:
+            error = "locked" if isLockError(exception) else type(exception).__name__
+            config.getConnection().rollback()
+        stats.record(action, startTime, time.perf_counter() - startTime, error)
+
+        if thinkTime:
+            stop.wait(thinkTime)
+        action = user.rng.choices(actions, actionWeights)[0] if user.sessionManager is not None else "login"
+
+    try:
+        user.logout()
+    except sqlite3.Error:
+        config.getConnection().rollback()
+
+
+def sampleInputs(rng: random.Random) -> tuple[list[tuple], dict[str, list]]:
+    """Pick the users, songs, playlist titles and search terms of the simulation
+
+    Args:
+        rng (random.Random): random number generator
+
+    Returns:
+        tuple[list[tuple], dict[str, list]]: (uid, pwd) pairs, and sids,
+            titles and terms
+    """
+    cursor = config.getCursor()
+    cursor.execute("select uid, pwd from users")
+    users = cursor.fetchall()
+    cursor.execute("select sid from songs")
+    sids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("select title from playlists")
+    titles = [row[0] for row in cursor.fetchall()]
+
+    terms = toolHelpers.searchTerms(rng, 1000)
+
+    return users, {"sids": sids, "titles": titles or ["load simulation"], "terms": terms}
+
+
+def summarize(records: list[tuple]) -> str:
+    """Summarize a group of action outcomes as one report line
+
+    Args:
+        records (list[tuple]): outcomes from LoadStats
+
+    Returns:
+        str: number of actions, latency percentiles of the successful ones and error counts
+    """
+    latencies = sorted(record[2] for record in records if record[3] is None)
+    locked = sum(1 for record in records if record[3] == "locked")
+    other = sum(1 for record in records if record[3] not in (None, "locked"))
+    percentiles = "  ".join(f"p{p} {percentile(latencies, p) * 1000:8.2f}ms" for p in PERCENTILES)
+
+    return f"{len(records):8d} ops  {percentiles}  locked {locked:6d}  errors {other:4d}"
+
+
+def report(stats: LoadStats, stages: list[tuple[int, float, float]]) -> None:
+    """Print throughput, latency and lock errors per stage, per action and
+    per second
+
+    Args:
+        stats (LoadStats): outcomes of the run
+        stages (list[tuple[int, float, float]]): (workers, start, end) of each stage
+    """
+    # Actions started while the workers were being stopped are left out
+    records = [record for record in stats.records if record[0] < stages[-1][2]]
+
+    print("\nPer stage:")
+    for workers, start, end in stages:
+        stageRecords = [record for record in records if start <= record[0] < end]
+        rate = len(stageRecords) / max(end - start, 1e-9)
+        print(f"  {workers:4d} workers  {rate:10.1f} ops/s  {summarize(stageRecords)}")
+
+    print("\nPer action:")
+    for action in ACTIONS:
+        actionRecords = [record for record in records if record[1] == action]
+        if actionRecords:
+            print(f"  {action:<10}{summarize(actionRecords)}")
+
+    print("\nPer second:")
+    seconds = {}
+    for record in records:
+        seconds.setdefault(int(record[0]), []).append(record)
+    for second in sorted(seconds):
+        workers = next((stage[0] for stage in stages if second + 0.5 < stage[2]), stages[-1][0])
+        print(f"  {second:4d}s  {workers:4d} workers  {summarize(seconds[second])}")
+
+    total = len(records)
+    elapsed = stages[-1][2] - stages[0][1]
+    locked = sum(1 for record in records if record[3] == "locked")
+    print(f"\nDone: {total} actions in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.1f} ops/s), {locked} 'database is locked' errors")
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Simulate many concurrent users on a copy of the database")
+    parser.add_argument("database", help="sqlite database file, it is copied and left unchanged")
+    parser.add_argument("--threads", default=THREADS, help="comma separated worker counts of the stages")
+    parser.add_argument("--stage-seconds", type=float, default=STAGE_SECONDS, help="duration of each stage")
+    parser.add_argument("--mix", default=MIX, help=f"action weights, actions are {', '.join(ACTIONS)}")
+    parser.add_argument("--think-ms", type=float, default=THINK_MS, help="pause of a worker between actions")
+    parser.add_argument("--busy-timeout", type=float, default=BUSY_TIMEOUT, help="seconds a connection waits for a lock")
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args(argv[1:])
+
+    weights = parseMix(args.mix)
+    stageWorkers = [int(count) for count in args.threads.split(",")]
+
+    with toolHelpers.databaseCopy(args.database, "load.db") as path:
+        stop = threading.Event()
+        workers = []
+        stages = []
+        try:
+            config.connect(path, busyTimeout=args.busy_timeout)
+            rng = random.Random(args.seed)
+            users, inputs = sampleInputs(rng)
+
+            stats = LoadStats()
+            for count in stageWorkers:
+                stageStart = time.perf_counter() - stats.startTime
+                print(f"Stage with {count} workers")
+                while len(workers) < count:
+                    user = SimulatedUser(random.Random(rng.random()), users, inputs)
+                    worker = threading.Thread(
+                        target=runWorker, args=(user, weights, args.think_ms / 1000, stats, stop), daemon=True
+                    )
+                    worker.start()
+                    workers.append(worker)
+
+                time.sleep(args.stage_seconds)
+                stages.append((count, stageStart, time.perf_counter() - stats.startTime))
+
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+            report(stats, stages)
+        finally:
+            stop.set()
+            config.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
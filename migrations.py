@@ -0,0 +1,213 @@
+"""
+Versioned schema migrations.
+
+Run as:
+`migrations.py <database.db> [--status]`
+
+The schema version of a database is kept in `PRAGMA user_version`: version
+N means the first N migrations of MIGRATIONS have been applied. migrate
+applies the missing ones in order, each followed by its version bump, and
+is called by config.connect whenever a database is opened. Every migration
+is idempotent (IF NOT EXISTS, or a check of what it creates), so databases
+that already have some of the schema, like the ones built before versions
+were kept, are brought to the latest version without redoing any work.
+
+Building an index or populating a derived table reads the whole base table,
+which takes a while on large databases, so the time of each migration is
+returned and, when verbose, printed. The command line applies the pending
+migrations ahead of time, or with --status only lists them.
+"""
+import argparse
+import sqlite3
+import sys
+import time
+import schema
+
+
+def createDerivedTable(name: str, *scripts: str):
+    """Build a migration that creates and populates a derived table
+
+    Args:
+        name (str): table name
+        scripts (str): sql scripts creating, syncing and populating it
+
+    Returns:
+        function: the migration, taking the connection
+    """
+    def migration(connection: sqlite3.Connection) -> None:
+        if not schema.tableExists(connection.cursor(), name):
+            schema.createTable(connection, *scripts)
+
+    return migration
+
+
+def createIndexes(*scripts: str):
+    """Build a migration that creates indexes
+
+    Args:
+        scripts (str): CREATE INDEX IF NOT EXISTS statements
+
+    Returns:
+        function: the migration, taking the connection
+    """
+    def migration(connection: sqlite3.Connection) -> None:
+        schema.createTable(connection, *scripts)
+
+    return migration
+
+
+def createTriggers(*scripts: str):
+    """Build a migration that adds triggers to an existing derived table
+
+    Args:
+        scripts (str): CREATE TRIGGER IF NOT EXISTS statements
+
+    Returns:
+        function: the migration, taking the connection
+    """
+    def migration(connection: sqlite3.Connection) -> None:
+        schema.createTable(connection, *scripts)
+
+    return migration
+
+
+# Migrations in the order they are applied, a migration's version is its
+# position plus one. Only ever append to this list.
+MIGRATIONS = [
+    ("canonical uids and aids", schema.canonicalizeIds),
+    ("search index", schema.ensureSearchIndex),
+    ("playlist stats", createDerivedTable(
+        "playlist_stats",
+        schema.PLAYLIST_STATS_TABLE,
+        schema.PLAYLIST_STATS_TRIGGERS,
+        schema.PLAYLIST_STATS_POPULATE
+    )),
+    ("artist stats", createDerivedTable(
+        "artist_stats",
+        schema.ARTIST_STATS_TABLE,
+        schema.ARTIST_STATS_TRIGGERS,
+        schema.ARTIST_STATS_POPULATE
+    )),
+    ("title indexes", createIndexes(schema.PLAYLIST_TITLE_INDEX, schema.SONG_TITLE_INDEX)),
+    ("artist listeners", createDerivedTable(
+        "artist_listeners",
+        schema.ARTIST_LISTENERS_TABLE,
+        schema.ARTIST_LISTENERS_TRIGGERS,
+        schema.ARTIST_LISTENERS_POPULATE
+    )),
+    ("hot path indexes", createIndexes(schema.HOT_PATH_INDEXES)),
+    ("song neighbors", createDerivedTable(
+        "song_neighbors",
+        schema.SONG_NEIGHBORS_TABLE,
+        schema.RECOMMENDATION_DIRTY_TRIGGERS,
+        schema.RECOMMENDATION_DIRTY_POPULATE
+    )),
+    ("play charts", createDerivedTable(
+        "song_plays_hourly",
+        schema.CHART_TABLES,
+        schema.chartTriggers(),
+        schema.chartPopulate()
+    )),
+    ("chart prune watermark", createDerivedTable(
+        "chart_pruned",
+        schema.CHART_PRUNED_TABLE,
+        schema.CHART_PRUNED_POPULATE
+    )),
+    ("artist listeners perform update", createTriggers(schema.ARTIST_LISTENERS_TRIGGERS)),
+]
+
+
+def latestVersion() -> int:
+    """Get the version of a fully migrated database
+
+    Returns:
+        int: number of migrations
+    """
+    return len(MIGRATIONS)
+
+
+def currentVersion(connection: sqlite3.Connection) -> int:
+    """Get the schema version of a database
+
+    Args:
+        connection (sqlite3.Connection): database connection
+
+    Returns:
+        int: number of migrations applied to it
+    """
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+
+def migrate(connection: sqlite3.Connection, verbose: bool = False) -> list[tuple[int, str, float]]:
+    """Apply the migrations the database doesn't have yet
+
+    Args:
+        connection (sqlite3.Connection): database connection
+        verbose (bool): print each migration and how long it took
+
+    Raises:
+        sqlite3.DatabaseError: the database was migrated by a newer version
+        of the program
+
+    Returns:
+        list[tuple[int, str, float]]: version, name and time in seconds of
+            each migration applied
+    """
+    version = currentVersion(connection)
+    if version > latestVersion():
+        raise sqlite3.DatabaseError(
+            f"Database schema version {version} is newer than the latest known version {latestVersion()}"
+        )
+
+    applied = []
+    for number, (name, migration) in enumerate(MIGRATIONS[version:], start=version + 1):
+        if verbose:
+            print(f"Applying migration {number} ({name})...", end=" ", flush=True)
+
+        startTime = time.perf_counter()
+        migration(connection)
+        # The version is only bumped once the migration is committed, if it
+        # is interrupted it runs again, and skips what it already did
+        connection.execute(f"PRAGMA user_version = {number}")
+        connection.commit()
+        elapsed = time.perf_counter() - startTime
+
+        if verbose:
+            print(f"done in {elapsed:.2f}s")
+        applied.append((number, name, elapsed))
+
+    # Builds of sqlite without FTS5 fall back to LIKE searches, the index is
+    # retried every time in case the database is later opened by one with it
+    schema.ftsEnabled = schema.ensureSearchIndex(connection)
+
+    return applied
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Bring a database's schema up to date")
+    parser.add_argument("database", help="sqlite database file, migrated in place")
+    parser.add_argument("--status", action="store_true", help="only list the pending migrations")
+    args = parser.parse_args(argv[1:])
+
+    connection = sqlite3.connect(args.database)
+    try:
+        version = currentVersion(connection)
+        print(f"Schema version {version} of {latestVersion()}")
+        if args.status:
+            for number, (name, _) in enumerate(MIGRATIONS[version:], start=version + 1):
+                print(f"  pending: {number} ({name})")
+            return 0
+
+        startTime = time.perf_counter()
+        applied = migrate(connection, verbose=True)
+        print(f"Done: applied {len(applied)} migrations in {time.perf_counter() - startTime:.2f}s")
+    finally:
+        connection.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
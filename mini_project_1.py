@@ -1,43 +1,29 @@
 # Import functions
-import sqlite3
 import getpass
 import time
 import sys
 import songFunctions
 import session, config
 
-# Global variables
-connection = None
-cursor = None
-
 def connect(path):
     '''
     Connect to data base.
 
-    Takes in the path address of the database.
+    Takes in the path address of the database. Pending schema migrations
+    are applied first, printing how long each one takes.
     '''
-    global connection, cursor
-
-    connection = sqlite3.connect(path)
-    cursor = connection.cursor()
-    cursor.execute(' PRAGMA foreign_keys=ON; ')
-    connection.commit()
+    config.connect(path, verbose=True)
 
     return
 
-def login_screen():
+def check_login(id, pwd):
     '''
-    User or artist login, if id is valid for both users and artists then ask 
-    if they want to login as a user or artist.
+    Look up an id/password pair in the users and artists tables.
 
-    Unregistered users are able to sign up
+    Takes in the canonical id and the password, returns the matching
+    users row and artists row (None if there is no match).
     '''
-    global connection, cursor
-    # User Input
-    id = input('Please login using a valid id: ')
-    id = id.lower()
-    pwd = getpass.getpass('Please login using a valid password: ')
-    login_id = ''
+    cursor = config.getCursor()
     # Check if id is in user table
     cursor.execute(
                         'SELECT * FROM users WHERE uid = :uname AND pwd = :pw;',
@@ -50,6 +36,24 @@ def login_screen():
                         { 'uname': id, 'pw': pwd },
                     )
     artists_check = cursor.fetchone()
+
+    return users_check, artists_check
+
+def login_screen():
+    '''
+    User or artist login, if id is valid for both users and artists then ask 
+    if they want to login as a user or artist.
+
+    Unregistered users are able to sign up
+    '''
+    connection = config.getConnection()
+    cursor = config.getCursor()
+    # User Input
+    id = input('Please login using a valid id: ')
+    id = config.canonicalId(id)
+    pwd = getpass.getpass('Please login using a valid password: ')
+    login_id = ''
+    users_check, artists_check = check_login(id, pwd)
     # Check if query returns object
     if users_check is not None and artists_check is not None:
         # Check if user input correct option
@@ -78,7 +82,7 @@ def login_screen():
         print(" ")
         print("Unregistered user")
         while True:
-            unregistered_uid = input('Please provide a unique uid: ')
+            unregistered_uid = config.canonicalId(input('Please provide a unique uid: '))
             if len(unregistered_uid) <= 4:
                 break
             else:
@@ -86,8 +90,8 @@ def login_screen():
         unregistered_name = input('Please provide a name: ')
         unregistered_pwd = getpass.getpass('Please provide a password: ')
         # Insert registered data into user table
-        data = (unregistered_uid, unregistered_name, unregistered_pwd)
-        cursor.execute('INSERT INTO users (uid, name, pwd) VALUES (?,?,?);', data)
+        data = { 'uid': unregistered_uid, 'name': unregistered_name, 'pwd': unregistered_pwd }
+        cursor.execute('INSERT INTO users (uid, name, pwd) VALUES (:uid, :name, :pwd);', data)
         connection.commit()
         print("Signup Successful")
         login_class = 'user'
@@ -100,7 +104,6 @@ def handleFuctionality(login_class, login_id):
     return
 
 def main(argv):
-    global connection, cursor
     path = argv[1]
     connect(path)
     
@@ -115,12 +118,8 @@ def main(argv):
     while True:
         login_class, login_id = login_screen()
         if login_class == 'artist':
-            songFunctions.conn = connection
-            songFunctions.cursor = cursor
             status = songFunctions.artistActions(login_id)
         elif login_class == 'user':
-            config.connection = connection
-            config.cursor = cursor
             status = session.handleFunctionality(login_id)
 
         if status == 'quit':
@@ -128,8 +127,7 @@ def main(argv):
         if status == 'logout':
             pass
     
-    connection.commit()
-    connection.close()
+    config.close()
     return
 
 
@@ -0,0 +1,343 @@
+"""
+Per-statement timing of the sqlite3 statements the program runs.
+
+Metrics are off unless enabled, either with enable() before config.connect
+or by setting the QUERY_METRICS environment variable to the file they are
+exported to. When they and the slow query log (see slowQueryLog) are off,
+connections are plain sqlite3 connections and nothing is measured.
+
+When on, connections and their cursors are wrapped so that every execute,
+executemany and fetch is timed. Statements are named after the function
+that runs them and, if the SQL is held in a local variable, that variable,
+e.g. 'songFunctions.find_top.top_user_query'. For each name the number of
+calls, the total and largest time (execute plus fetching the rows) and the
+number of rows returned are kept, and exported at exit as Prometheus text
+(files ending in .prom or .txt) or JSON (anything else).
+"""
+import atexit
+import itertools
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import slowQueryLog
+
+# Environment variable naming the export file, which enables the metrics
+ENVIRONMENT_VARIABLE = "QUERY_METRICS"
+
+# Metrics of the current process, None while disabled
+metrics = None
+
+# Most statement names kept, the least recently used are dropped first
+MAX_STATEMENT_NAMES = 1024
+
+# Statement names by (code object of the calling function, sql), looking a
+# name up in the caller's locals is only done once per statement. Bounded,
+# as statements built at run time have a new sql string every time.
+statementNames = OrderedDict()
+statementNamesLock = threading.Lock()
+
+
+def statementName(sql: str) -> str:
+    """Name a statement after the function running it, and the local
+    variable holding its sql if there is one
+
+    Args:
+        sql (str): the statement
+
+    Returns:
+        str: 'module.function.variable' or 'module.function'
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get("__name__") == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+
+    key = (frame.f_code, sql)
+    with statementNamesLock:
+        name = statementNames.get(key)
+        if name is not None:
+            statementNames.move_to_end(key)
+            return name
+
+    name = f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}"
+    for variable, value in frame.f_locals.items():
+        if value is sql:
+            name += "." + variable
+            break
+
+    with statementNamesLock:
+        statementNames[key] = name
+        if len(statementNames) > MAX_STATEMENT_NAMES:
+            statementNames.popitem(last=False)
+
+    return name
+
+
+class QueryMetrics():
+    """
+    Call count, total and largest time, and rows returned of each named
+    statement
+    """
+    def __init__(self) -> None:
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def record(self, name: str, elapsed: float, executionTime: float, rows: int = 0, calls: int = 0) -> None:
+        """Add time and rows to a statement
+
+        Args:
+            name (str): statement name
+            elapsed (float): time in seconds
+            executionTime (float): time so far of the execution, including
+                its earlier fetches, in seconds
+            rows (int): rows returned
+            calls (int): number of executions, 0 for the fetches that follow one
+        """
+        with self.lock:
+            entry = self.statements.get(name)
+            if entry is None:
+                entry = self.statements[name] = {"calls": 0, "total": 0.0, "max": 0.0, "rows": 0}
+
+            entry["calls"] += calls
+            entry["total"] += elapsed
+            entry["rows"] += rows
+            entry["max"] = max(entry["max"], executionTime)
+
+    def snapshot(self) -> dict[str, dict]:
+        """Get the metrics of every statement
+
+        Returns:
+            dict[str, dict]: calls, total_seconds, avg_seconds, max_seconds
+                and rows by statement name
+        """
+        with self.lock:
+            return {
+                name: {
+                    "calls": entry["calls"],
+                    "total_seconds": entry["total"],
+                    "avg_seconds": entry["total"] / entry["calls"] if entry["calls"] else 0.0,
+                    "max_seconds": entry["max"],
+                    "rows": entry["rows"],
+                }
+                for name, entry in sorted(self.statements.items())
+            }
+
+    def toJson(self) -> str:
+        """Format the metrics as JSON
+
+        Returns:
+            str: the metrics, see snapshot
+        """
+        return json.dumps(self.snapshot(), indent=2)
+
+    def toPrometheus(self) -> str:
+        """Format the metrics in the Prometheus text exposition format
+
+        Returns:
+            str: the metrics
+        """
+        families = [
+            ("sqlite_statement_calls_total", "counter", "Executions of the statement", "calls"),
+            ("sqlite_statement_seconds_total", "counter", "Time spent executing the statement and fetching its rows", "total_seconds"),
+            ("sqlite_statement_seconds_max", "gauge", "Longest single execution of the statement", "max_seconds"),
+            ("sqlite_statement_rows_total", "counter", "Rows returned by the statement", "rows"),
+        ]
+
+        snapshot = self.snapshot()
+        lines = []
+        for family, kind, description, field in families:
+            lines.append(f"# HELP {family} {description}")
+            lines.append(f"# TYPE {family} {kind}")
+            for name, values in snapshot.items():
+                label = name.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'{family}{{statement="{label}"}} {values[field]}')
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str) -> None:
+        """Write the metrics to a file, as Prometheus text if it ends in
+        .prom or .txt, otherwise as JSON
+
+        Args:
+            path (str): file to write
+        """
+        text = self.toPrometheus() if path.endswith((".prom", ".txt")) else self.toJson()
+        with open(path, "w") as file:
+            file.write(text)
+
+
+class MetricsCursor(sqlite3.Cursor):
+    """
+    Cursor timing its statements for the metrics and the slow query log.
+    A statement is done when its rows run out, the cursor runs another
+    statement or is closed. The time of a cursor dropped before then is in
+    the metrics, but it isn't checked against the slow query log, whose
+    EXPLAIN must not run during garbage collection.
+    """
+    metricsName = None
+    executionTime = 0.0
+    executionRows = 0
+    executionDone = True
+
+    def execute(self, sql, parameters=()):
+        self.startExecution(sql, parameters)
+        startTime = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.recordTime(startTime, calls=1, done=self.description is None)
+
+    def executemany(self, sql, parameters):
+        # Only the first parameter set is kept for the slow query log
+        parameters = iter(parameters)
+        first = next(parameters, None)
+        self.startExecution(sql, () if first is None else first)
+        startTime = time.perf_counter()
+        try:
+            return super().executemany(sql, itertools.chain(() if first is None else (first,), parameters))
+        finally:
+            self.recordTime(startTime, calls=1, done=True)
+
+    def fetchone(self):
+        startTime = time.perf_counter()
+        row = super().fetchone()
+        self.recordTime(startTime, 0 if row is None else 1, done=row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        startTime = time.perf_counter()
+        rows = super().fetchmany(size)
+        self.recordTime(startTime, len(rows), done=len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        startTime = time.perf_counter()
+        rows = super().fetchall()
+        self.recordTime(startTime, len(rows), done=True)
+        return rows
+
+    def __next__(self):
+        startTime = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.recordTime(startTime, 0, done=True)
+            raise
+        self.recordTime(startTime, 1)
+        return row
+
+    def close(self):
+        self.finishExecution()
+        super().close()
+
+    def startExecution(self, sql: str, parameters) -> None:
+        """Finish the cursor's previous statement and start timing a new one
+
+        Args:
+            sql (str): the new statement
+            parameters (dict | Sequence): its bound parameters
+        """
+        self.finishExecution()
+        self.metricsName = statementName(sql)
+        self.executionSql = sql
+        self.executionParameters = parameters
+        self.executionTime = 0.0
+        self.executionRows = 0
+        self.executionDone = False
+
+    def recordTime(self, startTime: float, rows: int = 0, calls: int = 0, done: bool = False) -> None:
+        """Record the time since 'startTime' for the cursor's statement
+
+        Args:
+            startTime (float): perf_counter when the call started
+            rows (int): rows returned by the call
+            calls (int): 1 if the call executed the statement
+            done (bool): is the statement done
+        """
+        if self.executionDone:
+            return
+
+        elapsed = time.perf_counter() - startTime
+        self.executionTime += elapsed
+        self.executionRows += rows
+        if metrics is not None:
+            metrics.record(self.metricsName, elapsed, self.executionTime, rows, calls)
+
+        if done:
+            self.finishExecution()
+
+    def finishExecution(self) -> None:
+        """
+        Mark the cursor's statement as done, logging it if it was slow
+        """
+        if self.executionDone:
+            return
+
+        self.executionDone = True
+        slowQueryLog.logStatement(
+            self.connection, self.metricsName, self.executionSql, self.executionParameters,
+            self.executionTime, self.executionRows
+        )
+
+
+class MetricsConnection(sqlite3.Connection):
+    """
+    Connection whose cursors, including the ones behind its execute
+    shortcuts, are MetricsCursors
+    """
+    def cursor(self, factory=MetricsCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+def enable(exportPath: str = None) -> QueryMetrics:
+    """Turn metrics on for the connections opened from now on
+
+    Args:
+        exportPath (str): file the metrics are written to at exit, if any
+
+    Returns:
+        QueryMetrics: the process' metrics
+    """
+    global metrics
+
+    if metrics is None:
+        metrics = QueryMetrics()
+        if exportPath:
+            atexit.register(metrics.export, exportPath)
+
+    return metrics
+
+
+def enableFromEnvironment() -> None:
+    """
+    Turn metrics on if the QUERY_METRICS environment variable names an
+    export file
+    """
+    exportPath = os.environ.get(ENVIRONMENT_VARIABLE)
+    if exportPath:
+        enable(exportPath)
+
+
+def connectionFactory() -> type:
+    """Get the class of new connections
+
+    Returns:
+        type: MetricsConnection when the metrics or the slow query log are
+            on, otherwise sqlite3.Connection
+    """
+    if metrics is None and slowQueryLog.logger is None:
+        return sqlite3.Connection
+
+    return MetricsConnection
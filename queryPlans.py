@@ -0,0 +1,275 @@
+"""
+Query plan regression check.
+
+Run as:
+`queryPlans.py [database.db] [--verbose]`
+
+Copies the database (mp1.db by default) to a temporary file, drives the
+user and artist operations of search, session, songFunctions, songProfile,
+recommendations, charts and mini_project_1 against it while collecting every statement they issue,
+then runs EXPLAIN QUERY PLAN on each one. Fails (exit status 1) when a
+statement scans a table that its function is not expected to scan, i.e.
+a lookup that should be an index seek fell back to a full table scan.
+"""
+import argparse
+import builtins
+import os
+import re
+import sqlite3
+import sys
+import charts
+import config
+import mini_project_1
+import recommendations
+import search
+import session
+import songFunctions
+import toolHelpers
+
+# Modules whose statements are checked, statements are attributed to the
+# innermost function of one of them on the stack
+CHECKED_MODULES = {"search", "session", "songFunctions", "songProfile", "recommendations", "charts", "mini_project_1", "listenBuffer"}
+
+# Tables that a function may scan, with the reason. Any other scan of a table
+# is reported.
+EXPECTED_SCANS = {
+    # '%term%' substring matches can't use an index. Artists are also matched
+    # on the titles of their songs, every (artist, song) pair is checked.
+    "search.queryScannedSongsAndPlaylists": {"playlists", "songs"},
+    "search.queryArtists": {"artists", "songs", "perform"},
+    "search.rankSongsAndPlaylists": {"playlists", "songs"},
+    "search.rankArtists": {"artists", "songs", "perform"},
+}
+
+# Scans that are known and not fixed yet, reported without failing the check.
+KNOWN_SCANS = {}
+
+# Statements that don't have a query plan worth checking
+SKIPPED_STATEMENT = re.compile(r"^\s*(--|(begin|commit|rollback|end|pragma|create|drop|savepoint|release|analyze)\b)", re.I)
+
+# "from songs s", "join songs as s", ", songs s"
+TABLE_ALIAS = re.compile(r"\b(?:from|join)\s+(\w+)(?:\s+as)?(?:\s+(\w+))?|,\s*(\w+)(?:\s+as)?(?:\s+(\w+))?", re.I)
+
+# Words that can follow a table name but aren't aliases
+NOT_ALIASES = {
+    "on", "where", "inner", "left", "join", "cross", "natural", "group", "order",
+    "limit", "union", "using", "set", "values", "select", "as", "and", "or",
+}
+
+
+class StatementCollector():
+    """
+    Records the statements run on a connection along with the function
+    that ran them
+    """
+    def __init__(self) -> None:
+        self.statements = {}
+
+    def __call__(self, sql: str) -> None:
+        if SKIPPED_STATEMENT.match(sql):
+            return
+
+        caller = callerName(sys._getframe(1))
+        if caller is not None:
+            self.statements.setdefault((caller, sql.strip()), None)
+
+
+def callerName(frame) -> str:
+    """Get the name of the innermost checked function on the stack
+
+    Args:
+        frame (frame): frame to start from
+
+    Returns:
+        str: 'module.function', or None if no checked function is running
+    """
+    while frame is not None:
+        module = frame.f_globals.get("__name__")
+        if module in CHECKED_MODULES:
+            return f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
+
+    return None
+
+
+def tableNames(cursor: sqlite3.Cursor, sql: str) -> dict[str, str]:
+    """Map the names a statement uses for base tables (the table name itself
+    or its alias) to the table
+
+    Args:
+        cursor (sqlite3.Cursor): cursor of the checked database
+        sql (str): statement
+
+    Returns:
+        dict[str, str]: table by name or alias
+    """
+    cursor.execute("select name from sqlite_master where type = 'table'")
+    tables = {row[0].lower() for row in cursor.fetchall()}
+
+    names = {table: table for table in tables}
+    for match in TABLE_ALIAS.finditer(sql):
+        table, alias = (match.group(1), match.group(2)) if match.group(1) else (match.group(3), match.group(4))
+        if table.lower() in tables and alias and alias.lower() not in NOT_ALIASES:
+            names[alias.lower()] = table.lower()
+
+    return names
+
+
+def unexpectedScans(cursor: sqlite3.Cursor, caller: str, sql: str) -> tuple[list[str], list[str], list[str]]:
+    """Get the query plan of a statement and the base table scans in it that
+    the calling function is not expected to do
+
+    Args:
+        cursor (sqlite3.Cursor): cursor of the checked database
+        caller (str): function that ran the statement
+        sql (str): statement, with its parameters inlined
+
+    Returns:
+        tuple[list[str], list[str], list[str]]: plan lines, unexpected
+            scanned tables and known scanned tables
+    """
+    cursor.execute("explain query plan " + sql)
+    plan = [row[3] for row in cursor.fetchall()]
+
+    names = tableNames(cursor, sql)
+    expected = EXPECTED_SCANS.get(caller, set())
+    known = KNOWN_SCANS.get(caller, set())
+    scans = []
+    knownScans = []
+    for detail in plan:
+        match = re.match(r"SCAN (\w+)", detail)
+        if match is None or "VIRTUAL TABLE" in detail:
+            continue
+
+        table = names.get(match.group(1).lower())
+        if table is None or table in expected:
+            continue
+        elif table in known:
+            knownScans.append(table)
+        else:
+            scans.append(table)
+
+    return plan, scans, knownScans
+
+
+def driveOperations(connection: sqlite3.Connection) -> None:
+    """Run the user and artist operations non-interactively, using ids that
+    exist in the database
+
+    Args:
+        connection (sqlite3.Connection): connection of the checked database
+    """
+    cursor = connection.cursor()
+    uid, pwd = cursor.execute("select uid, pwd from users order by uid limit 1").fetchone()
+    aid = cursor.execute("select aid from perform order by aid limit 1").fetchone()[0]
+    sid = cursor.execute("select sid from plinclude order by pid, sorder limit 1").fetchone()[0]
+    pid, title = cursor.execute(
+        "select p.pid, p.title from playlists p inner join plinclude pl on pl.pid = p.pid limit 1"
+    ).fetchone()
+    song = cursor.execute("select title, duration from songs where sid = ?", (sid,)).fetchone()
+
+    # The selection menus are answered with "exit to menu"
+    builtins.input = lambda prompt="": "m"
+
+    mini_project_1.check_login(uid, pwd)
+
+    sessionManager = session.SessionManager(uid, verbose=False)
+    songFunctions.listen(uid, sid, sessionManager)
+    sessionManager.endSession()
+    sessionManager.startSession()
+
+    singleStatement = search.singleStatementSearch
+    for search.singleStatementSearch in (True, False):
+        for terms in (["love", "a"], ["e"], ["the", "music", "of"]):
+            search.resultCache.clear()
+            search.rankResults(search.querySongsAndPlaylists, terms)
+            search.rankResults(search.queryArtists, terms)
+    search.singleStatementSearch = singleStatement
+
+    search.resultCache.clear()
+    search.pageResults(search.querySongsAndPlaylists, ["love"]).hasIndex(20)
+    search.getPlaylistSongs(pid)
+    search.getArtistSongs(aid)
+
+    songFunctions.get_info(sid)
+    recommendations.getNeighbors(sid)
+    songFunctions.add_song_to_playlist(title, sid, uid)
+    songFunctions.add_songs_to_playlist("query plan check", [sid], uid)
+    songFunctions.add_song(song[0], song[1], aid)
+    songFunctions.add_song("query plan check", 123, aid)
+    songFunctions.find_top(aid)
+    charts.topPlayed("songs", "7d")
+    charts.topPlayed("artists", "30d")
+
+    sessionManager.endSession()
+
+
+def collectPlans(path: str) -> list[tuple[str, str, list[str], list[str], list[str]]]:
+    """Drive the operations against a database, collecting every statement
+    they issue, and get the query plan and scans of each one. The database
+    is modified, pass a copy.
+
+    Args:
+        path (str): sqlite database file
+
+    Returns:
+        list[tuple[str, str, list[str], list[str], list[str]]]: function,
+            statement, plan lines, unexpected scanned tables and known
+            scanned tables of each statement
+    """
+    collector = StatementCollector()
+    input = builtins.input
+    stdout = sys.stdout
+    try:
+        config.connect(path)
+        connection = config.getConnection()
+
+        connection.set_trace_callback(collector)
+        try:
+            sys.stdout = open(os.devnull, "w")
+            driveOperations(connection)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            builtins.input = input
+            connection.set_trace_callback(None)
+
+        cursor = connection.cursor()
+        return [
+            (caller, sql, *unexpectedScans(cursor, caller, sql))
+            for caller, sql in collector.statements
+        ]
+    finally:
+        config.close()
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Check the query plans of the statements the app runs")
+    parser.add_argument("database", nargs="?", default="mp1.db", help="sqlite database file, it is copied and left unchanged")
+    parser.add_argument("--verbose", action="store_true", help="print the plan of every statement")
+    args = parser.parse_args(argv[1:])
+
+    problems = 0
+    with toolHelpers.databaseCopy(args.database, "plans.db") as path:
+        plans = collectPlans(path)
+
+    for caller, sql, plan, scans, knownScans in plans:
+        if scans:
+            problems += 1
+            print(f"FAIL {caller}: unexpected scan of {', '.join(scans)}")
+        elif knownScans:
+            print(f"known {caller}: scan of {', '.join(knownScans)}")
+        elif args.verbose:
+            print(f"ok   {caller}")
+        if scans or args.verbose:
+            print("     " + " ".join(sql.split())[:200])
+            for detail in plan:
+                print(f"       {detail}")
+
+    print(f"Checked {len(plans)} statements, {problems} with unexpected scans")
+
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,271 @@
+"""
+Co-listening song recommendations, "users who played this also played".
+
+Run as:
+`recommendations.py <database.db> [--full] [--top-k K] [--batch-size N]`
+
+Songs are compared by who played them: listen is read into a sparse
+user x song matrix of play counts, weighted log(1 + plays) so heavy
+listeners don't drown everyone else, and the similarity of two songs is the
+cosine of their columns. Similarities are computed for a batch of songs at
+a time as one sparse matrix product, and the top K neighbors of each song
+are stored in song_neighbors, where the song menu reads them.
+
+Triggers on listen mark the songs whose plays changed in
+recommendation_dirty. Every refresh reads the whole listen table, as the
+similarities of a song depend on the column of every song sharing a listener
+with it, but only the neighbors of the marked songs are recomputed and
+rewritten, --full recomputes every song. A song's list picks up the changes
+of the songs in it the next time the song itself is refreshed.
+
+Reading neighbors only needs sqlite. Computing them needs numpy and scipy,
+which are imported when a refresh runs.
+"""
+import argparse
+import sqlite3
+import sys
+import time
+import config
+
+TOP_K = 20
+BATCH_SIZE = 512
+
+# Largest number of similarities computed at once, 128MB of float64
+MAX_BATCH_CELLS = 16 * 1024 * 1024
+
+# Neighbors of a song, most similar first
+NEIGHBORS_QUERY = """
+    select s.sid, s.title, s.duration, n.score
+    from song_neighbors n
+    inner join songs s on s.sid = n.neighbor
+    where n.sid = ?
+    order by n.rank
+    limit ?
+"""
+
+
+def importArrays():
+    """Import numpy and scipy.sparse
+
+    Raises:
+        ImportError: they aren't installed
+
+    Returns:
+        tuple: the numpy and scipy.sparse modules
+    """
+    try:
+        import numpy
+        from scipy import sparse
+    except ImportError as error:
+        raise ImportError("Computing recommendations needs numpy and scipy: pip install numpy scipy") from error
+
+    return numpy, sparse
+
+
+def getNeighbors(sid: int, limit: int = 10) -> list[tuple]:
+    """Get the songs most often played by the listeners of a song
+
+    Args:
+        sid (int): song id
+        limit (int): number of songs
+
+    Returns:
+        list[tuple]: (sid, title, duration, score) rows, most similar first
+    """
+    cursor = config.getConnection().cursor()
+    cursor.execute(NEIGHBORS_QUERY, (sid, limit))
+    rows = cursor.fetchall()
+    cursor.close()
+
+    return rows
+
+
+def loadListenMatrix(cursor: sqlite3.Cursor):
+    """Read listen into a sparse user x song matrix
+
+    Args:
+        cursor (sqlite3.Cursor): cursor on the database
+
+    Returns:
+        tuple: the csc matrix of log(1 + plays) and the sorted array of the
+            sids of its columns
+    """
+    numpy, sparse = importArrays()
+
+    cursor.execute(
+        """
+            select uid, sid, sum(cnt)
+            from listen
+            group by uid, sid
+        """
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return sparse.csc_matrix((0, 0)), numpy.zeros(0, dtype=numpy.int64)
+
+    uids, sids, plays = zip(*rows)
+    _, userIndex = numpy.unique(numpy.array(uids, dtype=object), return_inverse=True)
+    songIds, songIndex = numpy.unique(numpy.array(sids, dtype=numpy.int64), return_inverse=True)
+    weights = numpy.log1p(numpy.maximum(numpy.array(plays, dtype=numpy.float64), 0))
+
+    matrix = sparse.csc_matrix(
+        (weights, (userIndex, songIndex)),
+        shape=(userIndex.max() + 1, len(songIds))
+    )
+    matrix.eliminate_zeros()
+
+    return matrix, songIds
+
+
+def computeNeighbors(matrix, songIds, columns, topK: int = TOP_K, batchSize: int = BATCH_SIZE):
+    """Find the most similar songs of some of the matrix' songs
+
+    Args:
+        matrix (scipy.sparse.csc_matrix): user x song matrix from loadListenMatrix
+        songIds (numpy.ndarray): sids of the matrix' columns
+        columns (numpy.ndarray): columns of the songs to find neighbors for
+        topK (int): neighbors kept per song
+        batchSize (int): songs compared with all others at once
+
+    Yields:
+        tuple[list[int], list[tuple]]: sids of a batch, and their
+            (sid, rank, neighbor, score) rows
+    """
+    numpy, sparse = importArrays()
+
+    # Scale every column to unit length, so dot products are cosines
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    scale = numpy.divide(1.0, norms, out=numpy.zeros_like(norms), where=norms > 0)
+    normalized = sparse.csc_matrix(matrix @ sparse.diags(scale))
+    transposed = sparse.csr_matrix(normalized.T)
+
+    # A batch's similarities are held as a dense batch x songs array, keep it
+    # within MAX_BATCH_CELLS
+    batchSize = max(1, min(batchSize, MAX_BATCH_CELLS // max(1, len(songIds))))
+    k = min(topK, len(songIds) - 1)
+
+    for start in range(0, len(columns), batchSize):
+        batch = columns[start:start + batchSize]
+        if k <= 0:
+            yield songIds[batch].tolist(), []
+            continue
+
+        similarities = (transposed[batch] @ normalized).toarray()
+        similarities[numpy.arange(len(batch)), batch] = 0
+
+        # The k best of each song, then sorted best first, ties by sid
+        top = numpy.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        scores = numpy.take_along_axis(similarities, top, axis=1)
+        order = numpy.lexsort((songIds[top], -scores))
+        top = numpy.take_along_axis(top, order, axis=1)
+        scores = numpy.take_along_axis(scores, order, axis=1)
+
+        # Songs never played by the same users aren't neighbors
+        rows, ranks = numpy.nonzero(scores > 0)
+        yield songIds[batch].tolist(), list(zip(
+            songIds[batch[rows]].tolist(),
+            (ranks + 1).tolist(),
+            songIds[top[rows, ranks]].tolist(),
+            scores[rows, ranks].tolist(),
+        ))
+
+
+def writeNeighbors(connection: sqlite3.Connection, sids: list[int], rows: list[tuple], marks: dict[int, int]) -> None:
+    """Replace the neighbors of songs and clear their dirty marks, in one
+    transaction
+
+    Args:
+        connection (sqlite3.Connection): database connection
+        sids (list[int]): songs whose neighbors are replaced
+        rows (list[tuple]): their new (sid, rank, neighbor, score) rows
+        marks (dict[int, int]): dirty marks of songs when the refresh read
+            listen, a song marked again since stays dirty
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany("delete from song_neighbors where sid = ?", ((sid,) for sid in sids))
+        cursor.executemany("insert into song_neighbors (sid, rank, neighbor, score) values (?, ?, ?, ?)", rows)
+        cursor.executemany(
+            "delete from recommendation_dirty where sid = ? and marks = ?",
+            ((sid, marks[sid]) for sid in sids if sid in marks)
+        )
+        cursor.execute("COMMIT")
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+
+
+def refresh(connection: sqlite3.Connection, full: bool = False, topK: int = TOP_K,
+            batchSize: int = BATCH_SIZE) -> tuple[int, int]:
+    """Recompute the neighbors of the dirty songs, or of every song. The
+    whole listen table is read either way, only the similarity products and
+    writes are limited to the dirty songs.
+
+    Args:
+        connection (sqlite3.Connection): database connection
+        full (bool): recompute every song, not only the dirty ones
+        topK (int): neighbors kept per song
+        batchSize (int): songs compared with all others at once
+
+    Returns:
+        tuple[int, int]: number of songs refreshed and of neighbor rows written
+    """
+    numpy, _ = importArrays()
+
+    # Read the dirty marks and listen in one read transaction, so marks
+    # added after the matrix was read are kept for the next refresh
+    cursor = connection.cursor()
+    cursor.execute("BEGIN")
+    try:
+        cursor.execute("select sid, marks from recommendation_dirty")
+        marks = dict(cursor.fetchall())
+        if not marks and not full:
+            return 0, 0
+        matrix, songIds = loadListenMatrix(cursor)
+    finally:
+        connection.rollback()
+
+    if full:
+        columns = numpy.arange(len(songIds))
+    else:
+        dirty = numpy.array(sorted(marks), dtype=numpy.int64)
+        columns = numpy.flatnonzero(numpy.isin(songIds, dirty))
+
+    # Songs without listens any more have no neighbors
+    listened = set(songIds.tolist())
+    gone = [sid for sid in marks if sid not in listened]
+    if gone:
+        writeNeighbors(connection, gone, [], marks)
+
+    songs = len(gone)
+    written = 0
+    for sids, rows in computeNeighbors(matrix, songIds, columns, topK, batchSize):
+        writeNeighbors(connection, sids, rows, marks)
+        songs += len(sids)
+        written += len(rows)
+
+    return songs, written
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Compute co-listening song recommendations")
+    parser.add_argument("database", help="sqlite database file, updated in place")
+    parser.add_argument("--full", action="store_true", help="recompute every song, not only the ones with new listens")
+    parser.add_argument("--top-k", type=int, default=TOP_K, help="neighbors kept per song")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="songs compared with all others at once")
+    args = parser.parse_args(argv[1:])
+
+    config.connect(args.database, verbose=True)
+    try:
+        startTime = time.perf_counter()
+        songs, rows = refresh(config.getConnection(), args.full, args.top_k, args.batch_size)
+        print(f"Done: refreshed {songs} songs, {rows} neighbors in {time.perf_counter() - startTime:.2f}s")
+    finally:
+        config.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,811 @@
+import sqlite3
+
+# Whether the full-text search index could be built on the current database
+ftsEnabled = False
+
+# Tables of the application data, as in mp1.db. Used to create new
+# databases; existing ones are expected to have them already.
+BASE_TABLES = """
+    CREATE TABLE IF NOT EXISTS users (
+      uid		char(4),
+      name		text,
+      pwd		text,
+      primary key (uid)
+    );
+    CREATE TABLE IF NOT EXISTS songs (
+      sid		int,
+      title		text,
+      duration	int,
+      primary key (sid)
+    );
+    CREATE TABLE IF NOT EXISTS sessions (
+      uid		char(4),
+      sno		int,
+      start 	date,
+      end 		date,
+      primary key (uid,sno),
+      foreign key (uid) references users
+	on delete cascade
+    );
+    CREATE TABLE IF NOT EXISTS listen (
+      uid		char(4),
+      sno		int,
+      sid		int,
+      cnt		real,
+      primary key (uid,sno,sid),
+      foreign key (uid,sno) references sessions,
+      foreign key (sid) references songs
+    );
+    CREATE TABLE IF NOT EXISTS playlists (
+      pid		int,
+      title		text,
+      uid		char(4),
+      primary key (pid),
+      foreign key (uid) references users
+    );
+    CREATE TABLE IF NOT EXISTS plinclude (
+      pid		int,
+      sid		int,
+      sorder	int,
+      primary key (pid,sid),
+      foreign key (pid) references playlists,
+      foreign key (sid) references songs
+    );
+    CREATE TABLE IF NOT EXISTS artists (
+      aid		char(4),
+      name		text,
+      nationality	text,
+      pwd		text,
+      primary key (aid)
+    );
+    CREATE TABLE IF NOT EXISTS perform (
+      aid		char(4),
+      sid		int,
+      primary key (aid,sid),
+      foreign key (aid) references artists,
+      foreign key (sid) references songs
+    );
+"""
+
+# Full-text index over song and playlist titles. Songs and playlists share
+# the index, so the rowid encodes both the source table and its key:
+# songs are stored at rowid 2 * sid, playlists at rowid 2 * pid + 1.
+SEARCH_INDEX_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index
+    USING fts5(title, tokenize = 'trigram');
+"""
+
+SEARCH_INDEX_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS search_index_song_insert
+    AFTER INSERT ON songs
+    BEGIN
+        INSERT INTO search_index (rowid, title) VALUES (new.sid * 2, new.title);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_index_song_update
+    AFTER UPDATE OF sid, title ON songs
+    BEGIN
+        DELETE FROM search_index WHERE rowid = old.sid * 2;
+        INSERT INTO search_index (rowid, title) VALUES (new.sid * 2, new.title);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_index_song_delete
+    AFTER DELETE ON songs
+    BEGIN
+        DELETE FROM search_index WHERE rowid = old.sid * 2;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_index_playlist_insert
+    AFTER INSERT ON playlists
+    BEGIN
+        INSERT INTO search_index (rowid, title) VALUES (new.pid * 2 + 1, new.title);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_index_playlist_update
+    AFTER UPDATE OF pid, title ON playlists
+    BEGIN
+        DELETE FROM search_index WHERE rowid = old.pid * 2 + 1;
+        INSERT INTO search_index (rowid, title) VALUES (new.pid * 2 + 1, new.title);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_index_playlist_delete
+    AFTER DELETE ON playlists
+    BEGIN
+        DELETE FROM search_index WHERE rowid = old.pid * 2 + 1;
+    END;
+"""
+
+SEARCH_INDEX_POPULATE = """
+    INSERT INTO search_index (rowid, title)
+    SELECT songs.sid * 2, songs.title
+    FROM songs;
+
+    INSERT INTO search_index (rowid, title)
+    SELECT playlists.pid * 2 + 1, playlists.title
+    FROM playlists;
+"""
+
+# Per playlist song count, total duration and last sorder, so searches and
+# playlist appends don't need to aggregate plinclude
+PLAYLIST_STATS_TABLE = """
+    CREATE TABLE IF NOT EXISTS playlist_stats (
+      pid		int,
+      song_count	int not null default 0,
+      total_duration	int not null default 0,
+      last_sorder	int,
+      primary key (pid),
+      foreign key (pid) references playlists
+    );
+"""
+
+PLAYLIST_STATS_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS playlist_stats_plinclude_insert
+    AFTER INSERT ON plinclude
+    BEGIN
+        INSERT INTO playlist_stats (pid, song_count, total_duration, last_sorder)
+        VALUES (
+            new.pid, 1,
+            coalesce((SELECT songs.duration FROM songs WHERE songs.sid = new.sid), 0),
+            new.sorder
+        )
+        ON CONFLICT (pid) DO UPDATE
+        SET song_count = song_count + 1,
+            total_duration = total_duration + excluded.total_duration,
+            last_sorder = max(
+                coalesce(last_sorder, excluded.last_sorder),
+                coalesce(excluded.last_sorder, last_sorder)
+            );
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS playlist_stats_plinclude_delete
+    AFTER DELETE ON plinclude
+    BEGIN
+        UPDATE playlist_stats
+        SET song_count = song_count - 1,
+            total_duration = total_duration
+                - coalesce((SELECT songs.duration FROM songs WHERE songs.sid = old.sid), 0),
+            last_sorder = (SELECT max(plinclude.sorder) FROM plinclude WHERE plinclude.pid = old.pid)
+        WHERE playlist_stats.pid = old.pid;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS playlist_stats_plinclude_update
+    AFTER UPDATE ON plinclude
+    BEGIN
+        UPDATE playlist_stats
+        SET song_count = song_count - 1,
+            total_duration = total_duration
+                - coalesce((SELECT songs.duration FROM songs WHERE songs.sid = old.sid), 0),
+            last_sorder = (SELECT max(plinclude.sorder) FROM plinclude WHERE plinclude.pid = old.pid)
+        WHERE playlist_stats.pid = old.pid;
+
+        INSERT INTO playlist_stats (pid, song_count, total_duration, last_sorder)
+        VALUES (
+            new.pid, 1,
+            coalesce((SELECT songs.duration FROM songs WHERE songs.sid = new.sid), 0),
+            new.sorder
+        )
+        ON CONFLICT (pid) DO UPDATE
+        SET song_count = song_count + 1,
+            total_duration = total_duration + excluded.total_duration,
+            last_sorder = (SELECT max(plinclude.sorder) FROM plinclude WHERE plinclude.pid = new.pid);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS playlist_stats_song_update
+    AFTER UPDATE OF duration ON songs
+    BEGIN
+        UPDATE playlist_stats
+        SET total_duration = total_duration
+            + coalesce(new.duration, 0) - coalesce(old.duration, 0)
+        WHERE playlist_stats.pid IN
+            (SELECT plinclude.pid FROM plinclude WHERE plinclude.sid = new.sid);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS playlist_stats_playlist_delete
+    AFTER DELETE ON playlists
+    BEGIN
+        DELETE FROM playlist_stats WHERE playlist_stats.pid = old.pid;
+    END;
+"""
+
+PLAYLIST_STATS_POPULATE = """
+    INSERT INTO playlist_stats (pid, song_count, total_duration, last_sorder)
+    SELECT plinclude.pid, count(*), coalesce(sum(songs.duration), 0), max(plinclude.sorder)
+    FROM plinclude
+    LEFT OUTER JOIN songs ON songs.sid = plinclude.sid
+    GROUP BY plinclude.pid;
+"""
+
+# Per artist song count and total duration of their catalog, so artist
+# searches don't need to count every artist's perform rows
+ARTIST_STATS_TABLE = """
+    CREATE TABLE IF NOT EXISTS artist_stats (
+      aid		char(4),
+      song_count	int not null default 0,
+      total_duration	int not null default 0,
+      primary key (aid),
+      foreign key (aid) references artists
+    );
+"""
+
+ARTIST_STATS_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS artist_stats_perform_insert
+    AFTER INSERT ON perform
+    BEGIN
+        INSERT INTO artist_stats (aid, song_count, total_duration)
+        VALUES (
+            new.aid, 1,
+            coalesce((SELECT songs.duration FROM songs WHERE songs.sid = new.sid), 0)
+        )
+        ON CONFLICT (aid) DO UPDATE
+        SET song_count = song_count + 1,
+            total_duration = total_duration + excluded.total_duration;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_stats_perform_delete
+    AFTER DELETE ON perform
+    BEGIN
+        UPDATE artist_stats
+        SET song_count = song_count - 1,
+            total_duration = total_duration
+                - coalesce((SELECT songs.duration FROM songs WHERE songs.sid = old.sid), 0)
+        WHERE artist_stats.aid = old.aid;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_stats_perform_update
+    AFTER UPDATE ON perform
+    BEGIN
+        UPDATE artist_stats
+        SET song_count = song_count - 1,
+            total_duration = total_duration
+                - coalesce((SELECT songs.duration FROM songs WHERE songs.sid = old.sid), 0)
+        WHERE artist_stats.aid = old.aid;
+
+        INSERT INTO artist_stats (aid, song_count, total_duration)
+        VALUES (
+            new.aid, 1,
+            coalesce((SELECT songs.duration FROM songs WHERE songs.sid = new.sid), 0)
+        )
+        ON CONFLICT (aid) DO UPDATE
+        SET song_count = song_count + 1,
+            total_duration = total_duration + excluded.total_duration;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_stats_song_update
+    AFTER UPDATE OF duration ON songs
+    BEGIN
+        UPDATE artist_stats
+        SET total_duration = total_duration
+            + coalesce(new.duration, 0) - coalesce(old.duration, 0)
+        WHERE artist_stats.aid IN
+            (SELECT perform.aid FROM perform WHERE perform.sid = new.sid);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_stats_artist_delete
+    AFTER DELETE ON artists
+    BEGIN
+        DELETE FROM artist_stats WHERE artist_stats.aid = old.aid;
+    END;
+"""
+
+ARTIST_STATS_POPULATE = """
+    INSERT INTO artist_stats (aid, song_count, total_duration)
+    SELECT perform.aid, count(*), coalesce(sum(songs.duration), 0)
+    FROM perform
+    LEFT OUTER JOIN songs ON songs.sid = perform.sid
+    GROUP BY perform.aid;
+"""
+
+# Total listening time of each user per artist, so an artist's top
+# listeners can be read without aggregating the whole listen table
+ARTIST_LISTENERS_TABLE = """
+    CREATE TABLE IF NOT EXISTS artist_listeners (
+      aid		char(4),
+      uid		char(4),
+      listen_time	real not null default 0,
+      primary key (aid,uid),
+      foreign key (aid) references artists,
+      foreign key (uid) references users
+    );
+
+    CREATE INDEX IF NOT EXISTS artist_listeners_leaderboard
+    ON artist_listeners (aid, listen_time DESC);
+"""
+
+ARTIST_LISTENERS_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS artist_listeners_listen_insert
+    AFTER INSERT ON listen
+    BEGIN
+        INSERT INTO artist_listeners (aid, uid, listen_time)
+        SELECT perform.aid, new.uid, new.cnt * songs.duration
+        FROM perform, songs
+        WHERE perform.sid = new.sid
+        AND songs.sid = new.sid
+        ON CONFLICT (aid, uid) DO UPDATE
+        SET listen_time = listen_time + excluded.listen_time;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_listeners_listen_update
+    AFTER UPDATE ON listen
+    BEGIN
+        UPDATE artist_listeners
+        SET listen_time = listen_time - old.cnt *
+            (SELECT songs.duration FROM songs WHERE songs.sid = old.sid)
+        WHERE artist_listeners.uid = old.uid
+        AND artist_listeners.aid IN
+            (SELECT perform.aid FROM perform WHERE perform.sid = old.sid);
+
+        INSERT INTO artist_listeners (aid, uid, listen_time)
+        SELECT perform.aid, new.uid, new.cnt * songs.duration
+        FROM perform, songs
+        WHERE perform.sid = new.sid
+        AND songs.sid = new.sid
+        ON CONFLICT (aid, uid) DO UPDATE
+        SET listen_time = listen_time + excluded.listen_time;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_listeners_listen_delete
+    AFTER DELETE ON listen
+    BEGIN
+        UPDATE artist_listeners
+        SET listen_time = listen_time - old.cnt *
+            (SELECT songs.duration FROM songs WHERE songs.sid = old.sid)
+        WHERE artist_listeners.uid = old.uid
+        AND artist_listeners.aid IN
+            (SELECT perform.aid FROM perform WHERE perform.sid = old.sid);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_listeners_perform_insert
+    AFTER INSERT ON perform
+    BEGIN
+        INSERT INTO artist_listeners (aid, uid, listen_time)
+        SELECT new.aid, listen.uid, sum(listen.cnt * songs.duration)
+        FROM listen, songs
+        WHERE listen.sid = new.sid
+        AND songs.sid = new.sid
+        GROUP BY listen.uid
+        ON CONFLICT (aid, uid) DO UPDATE
+        SET listen_time = listen_time + excluded.listen_time;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_listeners_perform_delete
+    AFTER DELETE ON perform
+    BEGIN
+        UPDATE artist_listeners
+        SET listen_time = listen_time -
+            (SELECT sum(listen.cnt * songs.duration)
+            FROM listen, songs
+            WHERE listen.sid = old.sid
+            AND listen.uid = artist_listeners.uid
+            AND songs.sid = old.sid)
+        WHERE artist_listeners.aid = old.aid
+        AND artist_listeners.uid IN
+            (SELECT listen.uid FROM listen WHERE listen.sid = old.sid);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_listeners_perform_update
+    AFTER UPDATE ON perform
+    BEGIN
+        UPDATE artist_listeners
+        SET listen_time = listen_time -
+            (SELECT sum(listen.cnt * songs.duration)
+            FROM listen, songs
+            WHERE listen.sid = old.sid
+            AND listen.uid = artist_listeners.uid
+            AND songs.sid = old.sid)
+        WHERE artist_listeners.aid = old.aid
+        AND artist_listeners.uid IN
+            (SELECT listen.uid FROM listen WHERE listen.sid = old.sid);
+
+        INSERT INTO artist_listeners (aid, uid, listen_time)
+        SELECT new.aid, listen.uid, sum(listen.cnt * songs.duration)
+        FROM listen, songs
+        WHERE listen.sid = new.sid
+        AND songs.sid = new.sid
+        GROUP BY listen.uid
+        ON CONFLICT (aid, uid) DO UPDATE
+        SET listen_time = listen_time + excluded.listen_time;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS artist_listeners_song_update
+    AFTER UPDATE OF duration ON songs
+    BEGIN
+        UPDATE artist_listeners
+        SET listen_time = listen_time
+            + (coalesce(new.duration, 0) - coalesce(old.duration, 0)) *
+            (SELECT sum(listen.cnt)
+            FROM listen
+            WHERE listen.sid = new.sid
+            AND listen.uid = artist_listeners.uid)
+        WHERE artist_listeners.aid IN
+            (SELECT perform.aid FROM perform WHERE perform.sid = new.sid)
+        AND artist_listeners.uid IN
+            (SELECT listen.uid FROM listen WHERE listen.sid = new.sid);
+    END;
+"""
+
+ARTIST_LISTENERS_POPULATE = """
+    INSERT INTO artist_listeners (aid, uid, listen_time)
+    SELECT perform.aid, listen.uid, sum(listen.cnt * songs.duration)
+    FROM listen, songs, perform
+    WHERE listen.sid = songs.sid
+    AND songs.sid = perform.sid
+    GROUP BY perform.aid, listen.uid;
+"""
+
+# Columns holding user and artist ids. Ids are stored in one canonical form
+# (trimmed, lowercase) so lookups can compare them with '=' and use the
+# primary key indexes instead of wrapping both sides in lower()
+CANONICAL_ID_COLUMNS = [
+    ("users", "uid"),
+    ("artists", "aid"),
+    ("sessions", "uid"),
+    ("listen", "uid"),
+    ("playlists", "uid"),
+    ("perform", "aid"),
+]
+
+
+def canonicalIdTriggers() -> str:
+    """Build the triggers that reject writes of non canonical ids
+
+    Returns:
+        str: sql script creating the triggers
+    """
+    triggers = []
+    for table, column in CANONICAL_ID_COLUMNS:
+        for event in ("INSERT", f"UPDATE OF {column}"):
+            triggers.append(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_canonical_{column}_{event.split()[0].lower()}
+                BEFORE {event} ON {table}
+                WHEN new.{column} <> lower(trim(new.{column}))
+                BEGIN
+                    SELECT RAISE(ABORT, '{table}.{column} must be trimmed and lowercase');
+                END;
+                """
+            )
+
+    return "".join(triggers)
+
+# Plays per song in each hour and each day, by the start of the session they
+# were played in, so charts over a time window only read the buckets inside
+# it. Hours are 'YYYY-MM-DD HH:00:00', days 'YYYY-MM-DD'. Artist charts add
+# up the buckets of their songs, so changes of perform need no upkeep here.
+CHART_TABLES = """
+    CREATE TABLE IF NOT EXISTS song_plays_hourly (
+      hour		text,
+      sid		int,
+      plays		real not null default 0,
+      primary key (hour,sid)
+    );
+
+    CREATE TABLE IF NOT EXISTS song_plays_daily (
+      day		text,
+      sid		int,
+      plays		real not null default 0,
+      primary key (day,sid)
+    );
+"""
+
+# Hourly chart buckets before hourly_before were deleted by charts.prune, so
+# charts read whole days from the daily buckets there. No row until the first
+# prune.
+CHART_PRUNED_TABLE = """
+    CREATE TABLE IF NOT EXISTS chart_pruned (
+      id		int primary key check (id = 1),
+      hourly_before	text not null
+    );
+"""
+
+# Databases pruned before the watermark was kept: the days with daily but no
+# hourly buckets left, before the first hourly bucket, were pruned
+CHART_PRUNED_POPULATE = """
+    INSERT INTO chart_pruned (id, hourly_before)
+    SELECT 1, date(h.first) || ' 00:00:00'
+    FROM (
+        SELECT coalesce(
+            (SELECT min(hour) FROM song_plays_hourly),
+            (SELECT date(max(day), '+1 day') FROM song_plays_daily)
+        ) AS first
+    ) h
+    WHERE EXISTS (SELECT 1 FROM song_plays_daily WHERE day < date(h.first));
+"""
+
+# Chart bucket sizes: table suffix, bucket column, and the bucket of a
+# session's start
+CHART_BUCKETS = [
+    ("hourly", "hour", "strftime('%Y-%m-%d %H:00:00', sessions.start)"),
+    ("daily", "day", "date(sessions.start)"),
+]
+
+
+def chartTriggers() -> str:
+    """Build the triggers that add the plays written to listen to the chart
+    buckets
+
+    Returns:
+        str: sql script creating the triggers
+    """
+    def bucketStatements(row: str, plays: str) -> str:
+        return "".join(
+            f"""
+                INSERT INTO song_plays_{suffix} ({column}, sid, plays)
+                SELECT {bucket}, {row}.sid, {plays}
+                FROM sessions
+                WHERE sessions.uid = {row}.uid
+                AND sessions.sno = {row}.sno
+                AND {bucket} IS NOT NULL
+                ON CONFLICT ({column}, sid) DO UPDATE
+                SET plays = plays + excluded.plays;
+            """
+            for suffix, column, bucket in CHART_BUCKETS
+        )
+
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS charts_listen_insert
+        AFTER INSERT ON listen
+        BEGIN
+            {bucketStatements("new", "new.cnt")}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS charts_listen_update
+        AFTER UPDATE OF cnt ON listen
+        WHEN new.cnt IS NOT old.cnt
+        BEGIN
+            {bucketStatements("new", "coalesce(new.cnt, 0) - coalesce(old.cnt, 0)")}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS charts_listen_delete
+        AFTER DELETE ON listen
+        BEGIN
+            {bucketStatements("old", "-old.cnt")}
+        END;
+    """
+
+
+def chartPopulate() -> str:
+    """Build the script that fills the chart buckets from the whole listen
+    history
+
+    Returns:
+        str: sql script
+    """
+    return "".join(
+        f"""
+            INSERT INTO song_plays_{suffix} ({column}, sid, plays)
+            SELECT {bucket}, listen.sid, sum(listen.cnt)
+            FROM listen, sessions
+            WHERE sessions.uid = listen.uid
+            AND sessions.sno = listen.sno
+            AND {bucket} IS NOT NULL
+            GROUP BY 1, 2;
+        """
+        for suffix, column, bucket in CHART_BUCKETS
+    )
+
+# Case insensitive playlist title lookups, used when adding songs to a
+# playlist by title
+PLAYLIST_TITLE_INDEX = """
+    CREATE INDEX IF NOT EXISTS playlists_title_nocase
+    ON playlists (title COLLATE NOCASE);
+"""
+
+# Case insensitive lookups of a song by title and duration, used to avoid
+# adding a song that is already in the catalog
+SONG_TITLE_INDEX = """
+    CREATE INDEX IF NOT EXISTS songs_title_nocase_duration
+    ON songs (title COLLATE NOCASE, duration);
+"""
+
+# Lookups of the rows of a song, used by song info, top songs and playlists
+# of an artist, and by the foreign key checks when a song is changed. Also
+# the sessions of a user by start time. Playlist title lookups are covered
+# by PLAYLIST_TITLE_INDEX, every one of them is case insensitive.
+HOT_PATH_INDEXES = """
+    CREATE INDEX IF NOT EXISTS perform_sid ON perform (sid);
+    CREATE INDEX IF NOT EXISTS plinclude_sid ON plinclude (sid);
+    CREATE INDEX IF NOT EXISTS listen_sid ON listen (sid);
+    CREATE INDEX IF NOT EXISTS sessions_uid_start ON sessions (uid, start);
+"""
+
+# Most similar songs of each song by co-listening, built by recommendations.
+# neighbor has no foreign key, checking one would scan the table whenever a
+# song is added.
+SONG_NEIGHBORS_TABLE = """
+    CREATE TABLE IF NOT EXISTS song_neighbors (
+      sid		int,
+      rank		int,
+      neighbor	int,
+      score		real,
+      primary key (sid,rank),
+      foreign key (sid) references songs
+    );
+
+    CREATE TABLE IF NOT EXISTS recommendation_dirty (
+      sid		int,
+      marks		int not null default 0,
+      primary key (sid)
+    );
+"""
+
+# Songs whose listens changed since their neighbors were last computed. The
+# number of marks tells a refresh whether a song changed again while it ran.
+RECOMMENDATION_DIRTY_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS recommendation_dirty_listen_insert
+    AFTER INSERT ON listen
+    BEGIN
+        INSERT INTO recommendation_dirty (sid, marks)
+        VALUES (new.sid, 1)
+        ON CONFLICT (sid) DO UPDATE
+        SET marks = marks + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS recommendation_dirty_listen_update
+    AFTER UPDATE OF cnt ON listen
+    WHEN new.cnt IS NOT old.cnt
+    BEGIN
+        INSERT INTO recommendation_dirty (sid, marks)
+        VALUES (new.sid, 1)
+        ON CONFLICT (sid) DO UPDATE
+        SET marks = marks + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS recommendation_dirty_listen_delete
+    AFTER DELETE ON listen
+    BEGIN
+        INSERT INTO recommendation_dirty (sid, marks)
+        VALUES (old.sid, 1)
+        ON CONFLICT (sid) DO UPDATE
+        SET marks = marks + 1;
+    END;
+"""
+
+# Every song with listens needs its neighbors computed the first time
+RECOMMENDATION_DIRTY_POPULATE = """
+    INSERT INTO recommendation_dirty (sid, marks)
+    SELECT DISTINCT listen.sid, 1
+    FROM listen;
+"""
+
+
+def tableExists(cursor: sqlite3.Cursor, name: str) -> bool:
+    """Check if a table (or virtual table) exists in the database
+
+    Args:
+        cursor (sqlite3.Cursor): cursor on the database
+        name (str): table name
+
+    Returns:
+        bool: does table exist
+    """
+    cursor.execute(
+        """
+            select 1
+            from sqlite_master
+            where type = 'table'
+            and name = ?
+        """,
+        (name,)
+    )
+    return cursor.fetchone() is not None
+
+
+def triggerExists(cursor: sqlite3.Cursor, name: str) -> bool:
+    """Check if a trigger exists in the database
+
+    Args:
+        cursor (sqlite3.Cursor): cursor on the database
+        name (str): trigger name
+
+    Returns:
+        bool: does trigger exist
+    """
+    cursor.execute(
+        """
+            select 1
+            from sqlite_master
+            where type = 'trigger'
+            and name = ?
+        """,
+        (name,)
+    )
+    return cursor.fetchone() is not None
+
+
+def createTable(connection: sqlite3.Connection, *scripts: str) -> None:
+    """Run the scripts that create and populate a derived table in a single
+    transaction, so a failure part way leaves no half built table behind
+
+    Args:
+        connection (sqlite3.Connection): database connection
+        scripts (str): sql scripts to run, in order
+    """
+    connection.cursor().executescript("BEGIN;" + "".join(scripts) + "COMMIT;")
+
+
+def ensureSearchIndex(connection: sqlite3.Connection) -> bool:
+    """Create the full-text search index and its sync triggers if missing.
+    The index is populated from the existing songs and playlists the first
+    time it is created.
+
+    Args:
+        connection (sqlite3.Connection): database connection
+
+    Returns:
+        bool: whether the index is usable. False if this sqlite build lacks
+        FTS5 or the trigram tokenizer, in which case searches fall back to LIKE.
+    """
+    cursor = connection.cursor()
+    if tableExists(cursor, "search_index"):
+        return True
+
+    try:
+        createTable(
+            connection,
+            SEARCH_INDEX_TABLE,
+            SEARCH_INDEX_TRIGGERS,
+            SEARCH_INDEX_POPULATE
+        )
+    except sqlite3.OperationalError:
+        connection.rollback()
+        return False
+
+    return True
+
+
+def canonicalizeIds(connection: sqlite3.Connection) -> None:
+    """One time migration converting every stored uid/aid to its canonical
+    form, then installing the triggers that keep them canonical. Derived
+    tables keyed on aid/uid are rebuilt afterwards.
+
+    Args:
+        connection (sqlite3.Connection): database connection
+
+    Raises:
+        sqlite3.IntegrityError: two users or two artists have ids that only
+        differ by case or surrounding spaces, so they can't both be kept
+    """
+    cursor = connection.cursor()
+    if triggerExists(cursor, "users_canonical_uid_insert"):
+        return
+
+    for table, column in (("users", "uid"), ("artists", "aid")):
+        cursor.execute(
+            f"""
+                select lower(trim({column}))
+                from {table}
+                group by lower(trim({column}))
+                having count(*) > 1
+            """
+        )
+        duplicates = [row[0] for row in cursor.fetchall()]
+        if duplicates:
+            raise sqlite3.IntegrityError(
+                f"Cannot canonicalize {table}.{column}, ids differ only by case: {', '.join(duplicates)}"
+            )
+
+    updates = "".join(
+        f"UPDATE {table} SET {column} = lower(trim({column})) WHERE {column} <> lower(trim({column}));"
+        for table, column in CANONICAL_ID_COLUMNS
+    )
+
+    rebuilds = ""
+    if tableExists(cursor, "artist_stats"):
+        rebuilds += "DELETE FROM artist_stats;" + ARTIST_STATS_POPULATE
+    if tableExists(cursor, "artist_listeners"):
+        rebuilds += "DELETE FROM artist_listeners;" + ARTIST_LISTENERS_POPULATE
+
+    # Parent and child keys are rewritten in separate statements, so foreign
+    # keys can only be enforced again once every table has been converted
+    cursor.execute("PRAGMA foreign_keys")
+    foreignKeys = cursor.fetchone()[0]
+    cursor.executescript(
+        "PRAGMA foreign_keys = OFF;"
+        + "BEGIN;"
+        + updates
+        + rebuilds
+        + canonicalIdTriggers()
+        + "COMMIT;"
+        + f"PRAGMA foreign_keys = {foreignKeys};"
+    )
+
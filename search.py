@@ -1,5 +1,22 @@
 import config
-from typing import Callable
+import schema
+import searchCache
+import sqlite3
+from itertools import chain, islice
+from typing import Callable, Iterable
+
+# The trigram tokenizer cannot match terms shorter than three characters
+MIN_FTS_TERM_LENGTH = 3
+
+# Number of results shown per page by the selection menus
+PAGE_SIZE = 5
+
+# Send all search terms in one statement and rank them inside sqlite3,
+# instead of one statement per term merged in python
+singleStatementSearch = True
+
+# Ranked results of recent searches, reused until the catalog changes
+resultCache = searchCache.SearchCache()
 
 
 def addResultOccurrences(resultOccurrences: dict[tuple, int]) -> None:
@@ -9,7 +26,7 @@ def addResultOccurrences(resultOccurrences: dict[tuple, int]) -> None:
     Args:
         resultOccurrences (dict): tracks each row as a key and its number of repeats as value
     """
-    global connection, cursor
+    cursor = config.getCursor()
 
     for result in cursor.fetchall():
             if result in resultOccurrences:
@@ -19,19 +36,68 @@ def addResultOccurrences(resultOccurrences: dict[tuple, int]) -> None:
 
 def querySongsAndPlaylists(term: str) -> None:
     """Perform sqlite3 query for songs and playlists that match the given 'term'
-    by their title
+    by their title. Uses the full-text index when it is available, otherwise
+    falls back to a substring scan.
     
     Args: 
         term (str): term to match songs and playlists with
     """
+    if schema.ftsEnabled and len(term) >= MIN_FTS_TERM_LENGTH:
+        queryIndexedSongsAndPlaylists(term)
+    else:
+        queryScannedSongsAndPlaylists(term)
+
+def queryIndexedSongsAndPlaylists(term: str) -> None:
+    """Perform full-text search for songs and playlists whose title contains
+    'term', best bm25 matches first
+
+    Args:
+        term (str): term to match songs and playlists with
+    """
+    cursor = config.getCursor()
+
     cursor.execute(
         """
-            select p.pid, p.title, sum(s.duration), "playlist"
+            with hits as (
+                select f.rowid as rowid, bm25(search_index) as score
+                from search_index f
+                where search_index match :match_term
+            )
+            select id, title, duration, type
+            from (
+                select p.pid as id, p.title as title, ps.total_duration as duration,
+                    "playlist" as type, h.score as score
+                from hits h
+                inner join playlists p on p.pid = h.rowid / 2
+                inner join playlist_stats ps on ps.pid = p.pid
+                where h.rowid % 2 = 1
+                and ps.song_count > 0
+                union all
+                select s.sid, s.title, s.duration, "song", h.score
+                from hits h
+                inner join songs s on s.sid = h.rowid / 2
+                where h.rowid % 2 = 0
+            )
+            order by score
+        """,
+        {"match_term": '"' + term.replace('"', '""') + '"'}
+    )
+
+def queryScannedSongsAndPlaylists(term: str) -> None:
+    """Perform substring scan for songs and playlists whose title contains 'term'
+
+    Args:
+        term (str): term to match songs and playlists with
+    """
+    cursor = config.getCursor()
+
+    cursor.execute(
+        """
+            select p.pid, p.title, ps.total_duration, "playlist"
             from playlists p
-            inner join plinclude pl on pl.pid = p.pid
-            inner join songs s on s.sid = pl.sid
-            group by p.pid, p.title 
-            having p.title like :search_term
+            inner join playlist_stats ps on ps.pid = p.pid
+            where p.title like :search_term
+            and ps.song_count > 0
             union
             select s.sid, s.title, s.duration, "song"
             from songs s
@@ -47,60 +113,344 @@ def queryArtists(term: str) -> None:
     Args:
         term (str): 
     """
+    cursor = config.getCursor()
+
     cursor.execute(
         """
-            select temp.aid, temp.name, temp.nationality, songCount, "artist"
+            select a.aid, a.name, a.nationality, st.song_count, "artist"
+            from artists a
+            inner join artist_stats st on st.aid = a.aid
+            where a.aid in (
+                select a.aid
+                from artists a
+                where a.name like :search_term
+                union
+                select p.aid
+                from songs s
+                inner join perform p on p.sid = s.sid
+                where s.title like :search_term
+            )
+            and st.song_count > 0
+            order by a.aid
+        """,
+        {"search_term": f"%{term}%"}
+    )
+
 
+def termValues(terms: list[tuple[int, str]]) -> tuple[str, list]:
+    """Build a 'values' list of (ordinal, term) rows so all search terms can be
+    sent to sqlite3 in a single statement
+
+    Args:
+        terms (list[tuple[int, str]]): search terms and their position in the query
+
+    Returns:
+        tuple[str, list]: sql 'values' clause and its parameters
+    """
+    params = []
+    for ordinal, term in terms:
+        params.extend((ordinal, term))
+
+    return "values " + ", ".join(["(?, ?)"] * len(terms)), params
+
+def rankSongsAndPlaylists(searchTerms: list[str], cursor: sqlite3.Cursor = None) -> None:
+    """Perform a single sqlite3 query for songs and playlists matching any of
+    'searchTerms', ranked by how many terms each one matches
+
+    Args:
+        searchTerms (list[str]): terms to match songs and playlists with
+        cursor (sqlite3.Cursor): cursor to run the query on, defaults to the shared cursor
+    """
+    cursor = cursor or config.getCursor()
+
+    useIndex = lambda term: schema.ftsEnabled and len(term) >= MIN_FTS_TERM_LENGTH
+    indexedTerms = [
+        (ordinal, '"' + term.replace('"', '""') + '"')
+        for ordinal, term in enumerate(searchTerms) if useIndex(term)
+    ]
+    scannedTerms = [
+        (ordinal, term)
+        for ordinal, term in enumerate(searchTerms) if not useIndex(term)
+    ]
+
+    ctes = []
+    hits = []
+    params = []
+
+    if indexedTerms:
+        values, termParams = termValues(indexedTerms)
+        ctes.append(f"indexed_terms(ordinal, term) as ({values})")
+        hits.append(
+            """
+                select case search_index.rowid % 2 when 0 then "song" else "playlist" end,
+                    search_index.rowid / 2, t.ordinal, bm25(search_index)
+                from indexed_terms t
+                inner join search_index on search_index match t.term
+            """
+        )
+        params.extend(termParams)
+
+    if scannedTerms:
+        values, termParams = termValues(scannedTerms)
+        ctes.append(f"scanned_terms(ordinal, term) as ({values})")
+        hits.append(
+            """
+                select "playlist", p.pid, t.ordinal, 0
+                from scanned_terms t
+                inner join playlists p on p.title like '%' || t.term || '%'
+                union all
+                select "song", s.sid, t.ordinal, 0
+                from scanned_terms t
+                inner join songs s on s.title like '%' || t.term || '%'
+            """
+        )
+        params.extend(termParams)
+
+    # The position of the first matched term and the bm25 score only break
+    # ties between rows matching the same number of terms
+    cursor.execute(
+        f"""
+            with {", ".join(ctes)},
+            hits(type, id, ordinal, score) as (
+                {" union all ".join(hits)}
+            ),
+            ranked(type, id, matches, firstOrdinal, score) as (
+                select type, id, count(*), min(ordinal), min(score)
+                from hits
+                group by type, id
+            )
+            select id, title, duration, type
             from (
-                select a.aid, a.name, a.nationality, "artist"
-                from artists a
+                select p.pid as id, p.title as title, ps.total_duration as duration,
+                    "playlist" as type, r.matches as matches,
+                    r.firstOrdinal as firstOrdinal, r.score as score
+                from ranked r
+                inner join playlists p on p.pid = r.id
+                inner join playlist_stats ps on ps.pid = p.pid
+                where r.type = "playlist"
+                and ps.song_count > 0
+                union all
+                select s.sid, s.title, s.duration, "song", r.matches,
+                    r.firstOrdinal, r.score
+                from ranked r
+                inner join songs s on s.sid = r.id
+                where r.type = "song"
+            )
+            order by matches desc, firstOrdinal, score, id, title
+        """,
+        params
+    )
+
+def rankArtists(searchTerms: list[str], cursor: sqlite3.Cursor = None) -> None:
+    """Perform a single sqlite3 query for artists matching any of 'searchTerms'
+    either by their name or by their song title, ranked by how many terms
+    each artist matches
+
+    Args:
+        searchTerms (list[str]): terms to match artists with
+        cursor (sqlite3.Cursor): cursor to run the query on, defaults to the shared cursor
+    """
+    cursor = cursor or config.getCursor()
+
+    values, params = termValues(list(enumerate(searchTerms)))
+    cursor.execute(
+        f"""
+            with terms(ordinal, term) as ({values}),
+            hits(aid, ordinal) as (
+                select a.aid, t.ordinal
+                from terms t
+                inner join artists a
                 inner join perform p on p.aid = a.aid
                 inner join songs s on s.sid = p.sid
-                where a.name like :search_term
-                or s.title like :search_term
-                group by a.aid
-            ) as temp
-            left outer join
-            (
-                select a.aid, count(*) as songCount
-                from artists a
-                inner join perform p on p.aid = a.aid
-                group by a.aid
-
-            ) as temp1
-            on temp.aid = temp1.aid
+                where a.name like '%' || t.term || '%'
+                or s.title like '%' || t.term || '%'
+                group by t.ordinal, a.aid
+            ),
+            ranked(aid, matches, firstOrdinal) as (
+                select aid, count(*), min(ordinal)
+                from hits
+                group by aid
+            )
+            select a.aid, a.name, a.nationality, st.song_count, "artist"
+            from ranked r
+            inner join artists a on a.aid = r.aid
+            inner join artist_stats st on st.aid = a.aid
+            order by r.matches desc, r.firstOrdinal, a.aid
         """,
-        {"search_term": f"%{term}%"}
+        params
     )
 
+# Single statement equivalents of the per-term query functions
+RANKED_QUERIES = {
+    querySongsAndPlaylists: rankSongsAndPlaylists,
+    queryArtists: rankArtists,
+}
 
-def search(queryFunc: Callable = None, selectionFunc: Callable = None) -> tuple[str | int]:
+def rankResults(queryFunc: Callable, searchTerms: list[str]) -> list[tuple]:
+    """Get the search results for 'searchTerms', most matched terms first,
+    from the result cache if the same search was run since the last write
+
+    Args:
+        queryFunc (function): Function for getting sqlite3 queries for either artist or playlist/songs
+        searchTerms (list[str]): search terms
+
+    Returns:
+        list[tuple]: ranked search results
     """
-    Main search function for playlist/song/artist searches.
+    if not searchTerms:
+        return []
+
+    key = resultCache.key(queryFunc.__name__, searchTerms)
+    results = resultCache.get(key)
+    if results is None:
+        generation = searchCache.writeGeneration
+        results = runRankedSearch(queryFunc, searchTerms)
+        resultCache.put(key, results, generation)
+
+    return results
+
+def runRankedSearch(queryFunc: Callable, searchTerms: list[str]) -> list[tuple]:
+    """Run the search for 'searchTerms', most matched terms first.
+    Uses one statement for all terms when 'queryFunc' has a ranked
+    equivalent, otherwise runs 'queryFunc' per term and merges the results.
 
     Args:
         queryFunc (function): Function for getting sqlite3 queries for either artist or playlist/songs
-        selectionFunc (function): Function for displaying query results and allowing user to select either artist or playlist/songs
+        searchTerms (list[str]): search terms
 
     Returns:
-        tuple: The selected song and its information in tuple format
+        list[tuple]: ranked search results
     """
-    global connection, cursor
-    cursor = config.cursor
-    connection = config.connection
+    cursor = config.getCursor()
 
-    searchTerms = getSearchTerms()
+    rankFunc = RANKED_QUERIES.get(queryFunc)
+    if singleStatementSearch and rankFunc is not None:
+        rankFunc(searchTerms)
+        return cursor.fetchall()
 
     resultOccurrences = {}
     for term in searchTerms:
         queryFunc(term)
         addResultOccurrences(resultOccurrences)
 
+    return sorted(resultOccurrences, key=resultOccurrences.get, reverse=True)
+
+def pageResults(queryFunc: Callable, searchTerms: list[str]) -> "LazyResults":
+    """Get the search results for 'searchTerms' like 'rankResults', but as
+    rows fetched from their own cursor as they are displayed
+
+    Args:
+        queryFunc (function): Function for getting sqlite3 queries for either artist or playlist/songs
+        searchTerms (list[str]): search terms
+
+    Returns:
+        LazyResults: ranked search results
+    """
+    rankFunc = RANKED_QUERIES.get(queryFunc)
+    if not (singleStatementSearch and rankFunc is not None and searchTerms):
+        return LazyResults(rankResults(queryFunc, searchTerms))
+
+    key = resultCache.key(queryFunc.__name__, searchTerms)
+    results = resultCache.get(key)
+    if results is not None:
+        return LazyResults(results)
+
+    generation = searchCache.writeGeneration
+    cursor = config.getConnection().cursor()
+    rankFunc(searchTerms, cursor)
+
+    # Results that fit the cache's limit for one search are read and cached
+    # right away, so picking from the first page still caches them. Larger
+    # ones are paged from the cursor and never cached.
+    limit = resultCache.maxResultRows()
+    rows = cursor.fetchmany(limit + 1)
+    if len(rows) <= limit:
+        cursor.close()
+        resultCache.put(key, rows, generation)
+        return LazyResults(rows)
+
+    return LazyResults(chain(rows, cursor))
+
+
+class LazyResults():
+    """
+    Search results that are only fetched from their cursor (or any other
+    row iterator) when a row is first asked for. Rows already fetched are
+    kept so that listings of earlier pages can still be selected.
+    """
+    def __init__(self, rows: Iterable[tuple], pageSize: int = PAGE_SIZE) -> None:
+        self.rows = iter(rows)
+        self.pageSize = pageSize
+        self.fetched = []
+        self.exhausted = False
+
+    def fetchUpTo(self, index: int) -> None:
+        """Fetch rows, a page at a time, until the row at 'index' is fetched
+        or there are no rows left
+
+        Args:
+            index (int): listing number of the row
+        """
+        while not self.exhausted and index >= len(self.fetched):
+            missing = index + 1 - len(self.fetched)
+            pages = -(-missing // self.pageSize)
+            page = list(islice(self.rows, pages * self.pageSize))
+            self.fetched.extend(page)
+            if len(page) < pages * self.pageSize:
+                self.exhausted = True
+
+    def hasIndex(self, index: int) -> bool:
+        """Check if there is a row with listing number 'index'
+
+        Args:
+            index (int): listing number of the row
+
+        Returns:
+            bool: does the row exist
+        """
+        if index < 0:
+            return False
+
+        self.fetchUpTo(index)
+        return index < len(self.fetched)
+
+    def page(self, start: int) -> list[tuple]:
+        """Get the page of rows starting at listing number 'start'
+
+        Args:
+            start (int): listing number of the first row of the page
+
+        Returns:
+            list[tuple]: up to 'pageSize' rows
+        """
+        self.fetchUpTo(start + self.pageSize - 1)
+        return self.fetched[start:start + self.pageSize]
+
+    def __getitem__(self, index: int) -> tuple:
+        if not self.hasIndex(index):
+            raise IndexError(f"No result with listing number {index}")
+
+        return self.fetched[index]
+
+
+def search(queryFunc: Callable = None, selectionFunc: Callable = None) -> tuple[str | int]:
+    """
+    Main search function for playlist/song/artist searches.
+
+    Args:
+        queryFunc (function): Function for getting sqlite3 queries for either artist or playlist/songs
+        selectionFunc (function): Function for displaying query results and allowing user to select either artist or playlist/songs
+
+    Returns:
+        tuple: The selected song and its information in tuple format
+    """
+    searchTerms = getSearchTerms()
+
+    results = pageResults(queryFunc, searchTerms)
+
     config.dispMessage(f"""Search results for: '{"', '".join(searchTerms)}'""")
 
-    selection = selectionFunc(
-        sorted(resultOccurrences, key=resultOccurrences.get, reverse=True)
-    )
+    selection = selectionFunc(results)
     
     
     if len(selection) == 0:
@@ -128,7 +478,7 @@ def getArtistSongs(aid) -> tuple[str | int]:
     Returns:
         tuple: User selected song
     """
-    global cursor, connection
+    cursor = config.getConnection().cursor()
 
     cursor.execute(
         """
@@ -141,7 +491,7 @@ def getArtistSongs(aid) -> tuple[str | int]:
     )
 
     return selectSongOrPlaylist(
-        cursor.fetchall()
+        LazyResults(cursor)
     )
 
 
@@ -155,9 +505,25 @@ def getPlaylistSongs(pid: int) -> tuple[str | int]:
     Returns:
         tuple: user selected song
     """
-    global cursor, connection
+    cursor = config.getCursor()
 
     cursor.execute(
+        """
+        select ps.song_count, ps.total_duration
+        from playlist_stats ps
+        where ps.pid = ?
+        """,
+        (pid,)
+    )
+    stats = cursor.fetchone()
+    if stats is None or stats[0] == 0:
+        config.dispMessage(f"Playlist '{pid}' has no songs")
+        return tuple()
+
+    config.dispMessage(f"Playlist '{pid}' has {stats[0]} songs with a total duration of {stats[1]}")
+
+    songsCursor = config.getConnection().cursor()
+    songsCursor.execute(
         """
         select s.sid, s.title, s.duration, "song"
         from songs s
@@ -168,16 +534,16 @@ def getPlaylistSongs(pid: int) -> tuple[str | int]:
     )
 
     return selectSongOrPlaylist(
-        cursor.fetchall(),
+        LazyResults(songsCursor),
     )
 
-def handleSelection(selection: str, numResults: int, i: int) -> tuple[str, int]:
+def handleSelection(selection: str, results: LazyResults, i: int) -> tuple[str, int]:
     """Handles user selection for the search results menu
     User can go to next page, select a song/artist/playlist, exit to main menu 
 
     Args:
         selection (str): User entered char
-        numResults (int): Number of search results
+        results (LazyResults): Search results
         i (int): iterator
 
     Returns:
@@ -189,22 +555,22 @@ def handleSelection(selection: str, numResults: int, i: int) -> tuple[str, int]:
             selection = "n" 
 
     elif selection == "n":
-        if (i + 5 >= numResults):
+        if not results.hasIndex(i + results.pageSize):
             print("No more pages to display")
         else:
-            i = i + 5
+            i = i + results.pageSize
 
-    elif selection.isnumeric() and (int(selection) >= numResults or int(selection) < 0):
+    elif selection.isnumeric() and not results.hasIndex(int(selection)):
         print("Selected listing number does not exist")
         selection = "n"
 
     return selection, i
         
-def selectSongOrPlaylist(results: list) -> tuple[str | int]:
+def selectSongOrPlaylist(results: LazyResults) -> tuple[str | int]:
     """Selection menu for song/playlists where user can select a song/playlist
 
     Args:
-        results (list): Search results containing songs/playlists
+        results (LazyResults): Search results containing songs/playlists
 
     Returns:
         tuple[str | int]: The selected song/playlist
@@ -215,10 +581,8 @@ def selectSongOrPlaylist(results: list) -> tuple[str | int]:
         config.dispHeader("Listing number\tId\t\tTitle\t\t\t\t\t\tDuration\t\tType")
 
         # Display 5 songs/playlists at a time
-        for j in range(i, i + 5):
-            if j >= len(results):
-                break
-            id, title, duration, type = results[j]
+        for j, result in enumerate(results.page(i), start=i):
+            id, title, duration, type = result
             print(f"[{j}]\t\t{id}\t\t{title:<50}{duration:<10}\t\t{type:<15}")
 
         # Get user action
@@ -227,18 +591,18 @@ def selectSongOrPlaylist(results: list) -> tuple[str | int]:
         # Exit to menu
         if selection == "m":
             return tuple()
-        selection, i = handleSelection(selection, len(results), i)
+        selection, i = handleSelection(selection, results, i)
         
     songOrPlaylist = results[int(selection)]
     config.dispMessage(f"Selected {songOrPlaylist[-1]} '{songOrPlaylist[1]}' with id '{songOrPlaylist[0]}'")
 
     return songOrPlaylist
 
-def selectArtist(results: list) -> tuple[str | int]:
+def selectArtist(results: LazyResults) -> tuple[str | int]:
     """Selection menu for user to select artist
 
     Args:
-        results (list): Search results for matching artists
+        results (LazyResults): Search results for matching artists
 
     Returns:
         tuple[str | int]: The selected artist
@@ -249,10 +613,8 @@ def selectArtist(results: list) -> tuple[str | int]:
         config.dispHeader("Listing number\tId\t\tName\t\t\tNationality\t\t\tNumber of songs")
 
         # Display 5 songs/playlists at a time
-        for j in range(i, i + 5):
-            if j >= len(results):
-                break
-            id, name, nationality, numSongs, _ = results[j]
+        for j, result in enumerate(results.page(i), start=i):
+            id, name, nationality, numSongs, _ = result
             print(f"[{j}]\t\t{id}\t\t{name:<25}{nationality:<30}\t\t{numSongs:<15}")
 
         # Get user action
@@ -261,7 +623,7 @@ def selectArtist(results: list) -> tuple[str | int]:
         # Exit to menu
         if selection == "m":
             return tuple()
-        selection, i = handleSelection(selection, len(results), i)
+        selection, i = handleSelection(selection, results, i)
         
     songOrPlaylist = results[int(selection)]
     config.dispMessage(f"Selected {songOrPlaylist[-1]} '{songOrPlaylist[1]}' with id '{songOrPlaylist[0]}'")
@@ -278,15 +640,12 @@ def getSearchTerms() -> list[str]:
     
 
 def main():
-    global connection, cursor
     path = "mp1.db"
     config.connect(path)
-    connection = config.connection
-    cursor = config.cursor
 
     search()
 
-    connection.close()
+    config.close()
 
 
 if __name__ == "__main__":
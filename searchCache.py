@@ -0,0 +1,167 @@
+import threading
+from collections import OrderedDict
+
+# Default limits: number of cached searches, and total number of result rows
+# held by all of them
+MAX_ENTRIES = 256
+MAX_ROWS = 50000
+
+# Incremented after every committed write to songs, playlists or their
+# performers, making every cached result older than it stale
+writeGeneration = 0
+generationLock = threading.Lock()
+
+# sqlite's LIKE and NOCASE only fold ascii letters, terms are folded the same way
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def bumpWriteGeneration() -> None:
+    """
+    Mark all cached search results as stale, called by the writers after
+    they commit a change to the catalog
+    """
+    global writeGeneration
+
+    with generationLock:
+        writeGeneration += 1
+
+
+def normalizeTerms(searchTerms: list[str]) -> tuple[str, ...]:
+    """Get the cache key part of 'searchTerms'. Case is folded, but the order
+    and repeats of the terms are kept since they change the ranking.
+
+    Args:
+        searchTerms (list[str]): search terms
+
+    Returns:
+        tuple[str, ...]: normalized terms
+    """
+    return tuple(term.translate(ASCII_LOWER) for term in searchTerms)
+
+
+class SearchCache():
+    """
+    Bounded LRU cache of ranked search results, keyed on the search type and
+    the normalized search terms. Results are dropped once the write generation
+    moves past the one they were computed in.
+    """
+    def __init__(self, maxEntries: int = MAX_ENTRIES, maxRows: int = MAX_ROWS) -> None:
+        self.maxEntries = maxEntries
+        self.maxRows = maxRows
+
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.generation = writeGeneration
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def key(self, searchType: str, searchTerms: list[str]) -> tuple:
+        """Get the cache key of a search
+
+        Args:
+            searchType (str): kind of search, e.g. the query function name
+            searchTerms (list[str]): search terms
+
+        Returns:
+            tuple: cache key
+        """
+        return (searchType, normalizeTerms(searchTerms))
+
+    def checkGeneration(self) -> None:
+        """
+        Drop every entry if a write happened since they were cached, must be
+        called with the lock held
+        """
+        if self.generation != writeGeneration:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.rows = 0
+            self.generation = writeGeneration
+
+    def maxResultRows(self) -> int:
+        """Get the size of the largest result set that is cached, a single
+        result set may use at most a quarter of the row budget
+
+        Returns:
+            int: number of rows
+        """
+        return self.maxRows // 4
+
+    def get(self, key: tuple) -> list[tuple] | None:
+        """Get the cached results of a search, counting a hit or a miss
+
+        Args:
+            key (tuple): cache key
+
+        Returns:
+            list[tuple] | None: the results, or None if they aren't cached
+        """
+        with self.lock:
+            self.checkGeneration()
+
+            results = self.entries.get(key)
+            if results is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return results
+
+    def put(self, key: tuple, results: list[tuple], generation: int) -> None:
+        """Cache the results of a search, evicting the least recently used
+        searches to stay within the limits
+
+        Args:
+            key (tuple): cache key
+            results (list[tuple]): search results
+            generation (int): write generation when the search was run, the
+                results aren't cached if a write happened since
+        """
+        if len(results) > self.maxResultRows():
+            return
+
+        with self.lock:
+            self.checkGeneration()
+            if generation != self.generation:
+                return
+
+            if key in self.entries:
+                self.rows -= len(self.entries.pop(key))
+
+            self.entries[key] = results
+            self.rows += len(results)
+
+            while len(self.entries) > self.maxEntries or self.rows > self.maxRows:
+                _, evicted = self.entries.popitem(last=False)
+                self.rows -= len(evicted)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Drop every entry, keeping the counters
+        """
+        with self.lock:
+            self.entries.clear()
+            self.rows = 0
+
+    def stats(self) -> dict:
+        """Get the cache counters
+
+        Returns:
+            dict: hits, misses, evictions, invalidations, and current entries and rows
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+                "rows": self.rows,
+            }
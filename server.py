@@ -0,0 +1,385 @@
+"""
+Network front end serving many users at once.
+
+Run as:
+`server.py <database.db> [--host HOST] [--port PORT] [--workers N]`
+
+Clients connect over TCP and send one JSON request per line, for example
+`{"id": 1, "action": "search", "type": "songs", "terms": ["love"]}`.
+Every request gets one JSON response line with the same id, either
+`{"id": 1, "ok": true, "result": ...}` or `{"id": 1, "ok": false, "error": "..."}`.
+
+Actions: login (uid, pwd, optional as), logout, startSession, endSession,
+search (type "songs" or "artists", terms, optional limit), listen (sid),
+info (sid) and addToPlaylist (title, sid).
+
+Each connection has its own SessionManager. Blocking sqlite3 work runs on a
+thread pool, where each worker thread uses its own connection from config.
+A background task flushes the clients' buffered plays once they are old
+enough, so plays of idle clients don't wait for their next request.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import config
+import listenBuffer
+import mini_project_1
+import queryMetrics
+import search
+import session
+import slowQueryLog
+import songFunctions
+import songProfile
+
+HOST = "127.0.0.1"
+PORT = 8765
+WORKERS = 32
+
+# Most search results returned when the request doesn't give a limit
+SEARCH_LIMIT = 50
+
+SEARCH_QUERIES = {
+    "songs": search.querySongsAndPlaylists,
+    "artists": search.queryArtists,
+}
+
+
+def callWithRollback(func, *args):
+    """Call a function that uses the calling thread's connection, rolling
+    back whatever it left uncommitted if it fails. Otherwise the worker
+    thread's connection would keep holding the write lock.
+
+    Args:
+        func (function): function to call
+        args: arguments of the function
+
+    Returns:
+        Any: the function's return value
+    """
+    try:
+        return func(*args)
+    except sqlite3.Error:
+        config.getConnection().rollback()
+        raise
+
+
+class RequestError(Exception):
+    """
+    A request that can't be served, reported back to the client
+    """
+
+
+class ClientState():
+    """
+    Login and session state of one client connection
+    """
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget the login and session, as after a logout
+        """
+        self.uid = None
+        self.loginClass = None
+        self.sessionManager = None
+
+
+class Server():
+    """
+    Serves JSON line requests from many clients, pushing the sqlite3 work of
+    each request to a thread pool.
+    """
+    def __init__(self, workers: int = WORKERS) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.clients = set()
+
+        self.handlers = {
+            "login": self.login,
+            "logout": self.logout,
+            "startSession": self.startSession,
+            "endSession": self.endSession,
+            "search": self.search,
+            "listen": self.listen,
+            "info": self.info,
+            "addToPlaylist": self.addToPlaylist,
+        }
+
+    async def run(self, func, *args):
+        """Run a blocking function on the thread pool
+
+        Args:
+            func (function): function to run
+            args: arguments of the function
+
+        Returns:
+            Any: the function's return value
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(callWithRollback, func, *args))
+
+    async def handleClient(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve the requests of one client until it disconnects. Requests of
+        a client are handled one at a time, in order.
+
+        Args:
+            reader (asyncio.StreamReader): client input
+            writer (asyncio.StreamWriter): client output
+        """
+        state = ClientState()
+        self.clients.add(state)
+        try:
+            while line := await reader.readline():
+                response = await self.handleRequest(state, line)
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except (ValueError, asyncio.LimitOverrunError) as error:
+            # a line longer than the stream limit, the rest of the stream
+            # can't be split into requests any more
+            response = {"id": None, "ok": False, "error": f"Bad request: {error}"}
+            try:
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+            except ConnectionError:
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            await self.dropSession(state)
+            self.clients.discard(state)
+            writer.close()
+
+    async def handleRequest(self, state: ClientState, line: bytes) -> dict:
+        """Decode, dispatch and answer a single request
+
+        Args:
+            state (ClientState): state of the requesting client
+            line (bytes): JSON encoded request
+
+        Returns:
+            dict: response
+        """
+        requestId = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise RequestError("Request must be a JSON object")
+
+            requestId = request.get("id")
+            handler = self.handlers.get(request.get("action"))
+            if handler is None:
+                raise RequestError(f"Unknown action '{request.get('action')}'")
+
+            result = await handler(state, request)
+        except RequestError as error:
+            return {"id": requestId, "ok": False, "error": str(error)}
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as error:
+            return {"id": requestId, "ok": False, "error": f"Bad request: {error!r}"}
+        except sqlite3.Error as error:
+            return {"id": requestId, "ok": False, "error": f"Database error: {error}"}
+
+        return {"id": requestId, "ok": True, "result": result}
+
+    def requireUser(self, state: ClientState) -> session.SessionManager:
+        """Check that the client is logged in as a user
+
+        Args:
+            state (ClientState): client state
+
+        Returns:
+            session.SessionManager: the client's session manager
+        """
+        if state.loginClass != "user":
+            raise RequestError("Must be logged in as a user")
+
+        return state.sessionManager
+
+    async def closeSession(self, state: ClientState) -> None:
+        """End the client's session, if one is in progress
+
+        Args:
+            state (ClientState): client state
+        """
+        if state.sessionManager is not None and state.sessionManager.isSessionStarted():
+            await self.run(state.sessionManager.endSession)
+
+    async def dropSession(self, state: ClientState) -> None:
+        """End the session of a client that is going away. The client can't
+        be told about a failure any more, so it is only reported here.
+
+        Args:
+            state (ClientState): client state
+        """
+        try:
+            await self.closeSession(state)
+        except sqlite3.Error as error:
+            config.dispMessage(f"Could not end the session of '{state.uid}': {error}")
+
+    async def login(self, state: ClientState, request: dict) -> dict:
+        uid = config.canonicalId(str(request["uid"]))
+        usersCheck, artistsCheck = await self.run(mini_project_1.check_login, uid, str(request["pwd"]))
+
+        classes = []
+        if usersCheck is not None:
+            classes.append("user")
+        if artistsCheck is not None:
+            classes.append("artist")
+
+        if not classes:
+            raise RequestError("Invalid id or password")
+
+        loginClass = request.get("as", classes[0] if len(classes) == 1 else None)
+        if loginClass not in classes:
+            raise RequestError(f"Id can log in as {' or '.join(classes)}, choose one with 'as'")
+
+        await self.closeSession(state)
+        state.uid = uid
+        state.loginClass = loginClass
+        state.sessionManager = session.SessionManager(uid, verbose=False) if loginClass == "user" else None
+
+        return {"uid": uid, "class": loginClass}
+
+    async def logout(self, state: ClientState, request: dict) -> None:
+        await self.closeSession(state)
+        state.reset()
+
+    async def startSession(self, state: ClientState, request: dict) -> dict:
+        sessionManager = self.requireUser(state)
+        if sessionManager.isSessionStarted():
+            raise RequestError(f"Session '{sessionManager.getSessionNumber()}' is already in progress")
+
+        await self.run(sessionManager.startSession)
+        return {"sno": sessionManager.getSessionNumber()}
+
+    async def endSession(self, state: ClientState, request: dict) -> dict:
+        sessionManager = self.requireUser(state)
+        if not sessionManager.isSessionStarted():
+            raise RequestError("No session in progress")
+
+        sno = sessionManager.getSessionNumber()
+        await self.run(sessionManager.endSession)
+        return {"sno": sno}
+
+    async def search(self, state: ClientState, request: dict) -> list:
+        self.requireUser(state)
+        queryFunc = SEARCH_QUERIES.get(request.get("type", "songs"))
+        if queryFunc is None:
+            raise RequestError(f"Search type must be one of {', '.join(SEARCH_QUERIES)}")
+
+        terms = request["terms"]
+        if isinstance(terms, str):
+            terms = terms.split()
+
+        results = await self.run(search.rankResults, queryFunc, [str(term) for term in terms])
+        return [list(row) for row in results[:int(request.get("limit", SEARCH_LIMIT))]]
+
+    async def listen(self, state: ClientState, request: dict) -> dict:
+        sessionManager = self.requireUser(state)
+        sid = int(request["sid"])
+        # the play is only written at the next flush, an unknown song must be
+        # refused now. The song profile cache answers for the songs being
+        # played without a query.
+        if await self.run(songProfile.getProfile, sid) is None:
+            raise RequestError(f"Song '{sid}' does not exist")
+
+        await self.run(songFunctions.listen, state.uid, sid, sessionManager)
+        return {"sno": sessionManager.getSessionNumber()}
+
+    async def info(self, state: ClientState, request: dict) -> dict:
+        self.requireUser(state)
+        profile = await self.run(songProfile.getProfile, int(request["sid"]))
+        if profile is None:
+            return {"song": None, "artists": [], "playlists": [], "plays": 0}
+
+        return {
+            "song": {"sid": profile["sid"], "title": profile["title"], "duration": profile["duration"]},
+            "artists": [artist["name"] for artist in profile["artists"]],
+            "playlists": profile["playlists"],
+            "plays": profile["plays"],
+        }
+
+    async def addToPlaylist(self, state: ClientState, request: dict) -> dict:
+        self.requireUser(state)
+        pid = await self.run(
+            songFunctions.add_song_to_playlist, str(request["title"]), int(request["sid"]), state.uid
+        )
+        return {"pid": pid}
+
+    async def flushListens(self, interval: float = listenBuffer.FLUSH_CHECK_SECONDS) -> None:
+        """Flush the buffered plays of every client that reached the time
+        threshold, every interval seconds, until cancelled
+
+        Args:
+            interval (float): seconds between checks
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for state in list(self.clients):
+                sessionManager = state.sessionManager
+                if sessionManager is None or not sessionManager.listenBuffer.isFlushDue():
+                    continue
+                try:
+                    await self.run(sessionManager.listenBuffer.flushIfDue)
+                except sqlite3.Error:
+                    # the plays stay buffered and the next check retries
+                    pass
+
+    async def shutdown(self) -> None:
+        """
+        End every client's session and stop the thread pool
+        """
+        for state in list(self.clients):
+            await self.dropSession(state)
+        self.executor.shutdown(wait=True)
+
+
+async def serve(host: str, port: int, workers: int) -> None:
+    """Serve clients until cancelled
+
+    Args:
+        host (str): address to listen on
+        port (int): port to listen on
+        workers (int): size of the thread pool running sqlite3 work
+    """
+    server = Server(workers)
+    listener = await asyncio.start_server(server.handleClient, host, port)
+    config.dispMessage(f"Serving on {host}:{port} with {workers} workers")
+    flusher = asyncio.create_task(server.flushListens())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        flusher.cancel()
+        await server.shutdown()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serve the Spotify emulator over TCP")
+    parser.add_argument("database", help="sqlite database file")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--metrics", help="export per-statement metrics to this file on shutdown (.prom for Prometheus text, otherwise JSON)")
+    parser.add_argument("--slow-query-log", help="log statements slower than --slow-query-ms to this file")
+    parser.add_argument("--slow-query-ms", type=float, default=slowQueryLog.THRESHOLD_MS)
+    args = parser.parse_args(argv[1:])
+
+    if args.metrics:
+        queryMetrics.enable(args.metrics)
+    if args.slow_query_log:
+        slowQueryLog.enable(args.slow_query_log, args.slow_query_ms)
+    config.connect(args.database, verbose=True)
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        config.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,4 +1,7 @@
+import sqlite3
+import charts
 import config
+import listenBuffer
 import search
 import songFunctions
 from datetime import datetime
@@ -7,12 +10,15 @@ class SessionManager():
     """
     Manages the current session. There is at most one active session at a time.
     """
-    def __init__(self, uid, cursor, connection) -> None:
-        self.uid = uid
+    def __init__(self, uid, verbose: bool = True) -> None:
+        self.uid = config.canonicalId(uid)
         self.sessionNum = None
 
-        self.cursor = cursor
-        self.connection = connection
+        # Print session start/end messages, off when not driven from the menu
+        self.verbose = verbose
+
+        # Plays are written to the listen table in batches, see listenBuffer
+        self.listenBuffer = listenBuffer.ListenBuffer()
 
 
     def isSessionStarted(self) -> bool:
@@ -29,27 +35,41 @@ class SessionManager():
     def getSessionNumber(self) -> int | None:
         return self.sessionNum
 
+    def recordListen(self, sid: int) -> None:
+        """Record a play of a song in the current session. The play is
+        buffered and written to the listen table with the next flush.
+
+        Args:
+            sid (int): song id
+        """
+        self.listenBuffer.add(self.uid, self.sessionNum, sid)
+
     def startSession(self):
         """
         Begin session
         """
-        newSessionNum = self.generateSessionNum()
         currDatetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        self.addNewSession(newSessionNum, currDatetime)
+        newSessionNum = self.addNewSession(currDatetime)
         self.sessionNum = newSessionNum
-        config.dispMessage(f"Started session '{newSessionNum}' for user '{self.uid}' at '{currDatetime}'.")
+        if self.verbose:
+            config.dispMessage(f"Started session '{newSessionNum}' for user '{self.uid}' at '{currDatetime}'.")
 
     def endSession(self) -> None:
         """
         Ends current session
         """
         if self.sessionNum is None:
-            config.dispMessage(f"Error: No session in progress, cannot end nonexistant session!")
+            if self.verbose:
+                config.dispMessage(f"Error: No session in progress, cannot end nonexistant session!")
             return
 
+        # Write any buffered plays before the session is closed
+        self.listenBuffer.flush()
+
         currDatetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute(
+        connection = config.getConnection()
+        connection.execute(
             """
                 update sessions
                 set end = ?
@@ -58,52 +78,44 @@ class SessionManager():
             """,
             (currDatetime, self.uid, self.sessionNum)
         )
-        self.connection.commit()
+        connection.commit()
 
-        config.dispMessage(f"Ended session '{self.sessionNum}' for user '{self.uid}' at '{currDatetime}'.")
+        if self.verbose:
+            config.dispMessage(f"Ended session '{self.sessionNum}' for user '{self.uid}' at '{currDatetime}'.")
         self.sessionNum = None
 
 
-    def generateSessionNum(self) -> int:
-        """
-        Generate unique session number for user
+    def addNewSession(self, start: str) -> int:
+        """Insert a new session for the user, numbered one past the user's
+        last session. The number is computed and inserted by a single
+        statement, so concurrent logins of the same user can't be given the
+        same session number.
+
+        Args:
+            start (str): session start time
 
         Returns:
             int: New user unique session number
         """
-    
-        self.cursor.execute(
-            """
-                select s.sno
-                from sessions s
-                where s.uid = ?
-                order by s.sno desc
-                limit 1
-            """,
-            (self.uid,)
-        )
-
-        contents = self.cursor.fetchall()
-        if not contents:
-            lastSessionNum = 0
-        else:
-            lastSessionNum = contents[0][0]
-        
-        return lastSessionNum + 1
-
-
-
-    def addNewSession(self, sno: int, start: str):
-        """
-        """
-        self.cursor.execute(
-            """
-                insert into sessions (uid, sno, start)
-                values(?, ?, ?)
-            """,
-            (self.uid, sno, start)
-        )
-        self.connection.commit()
+        connection = config.getConnection()
+        try:
+            cursor = connection.execute(
+                """
+                    insert into sessions (uid, sno, start)
+                    select ?, coalesce(max(s.sno), 0) + 1, ?
+                    from sessions s
+                    where s.uid = ?
+                    returning sno
+                """,
+                (self.uid, start, self.uid)
+            )
+            sno = cursor.fetchall()[0][0]
+            connection.commit()
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+
+        return sno
 
 def getAction(uid: str) -> int:
     """
@@ -126,11 +138,12 @@ def getAction(uid: str) -> int:
             [3] End current session
             [4] Logout
             [5] Quit
+            [6] Trending charts
             """
         )
         action = input("Enter action: ")
         
-        if action.isnumeric() and int(action) in range(6):
+        if action.isnumeric() and int(action) in range(7):
             return int(action)
         else:
             config.dispMessage("Invalid action selection.")
@@ -145,13 +158,27 @@ def handleFunctionality(uid: str) -> str:
     Returns:
         str: Returns whether program quits or logs out
     """
-    global cursor, connection
+    sessionManager = SessionManager(uid)
+
+    # The menu blocks on input, buffered plays are flushed in the background
+    flushTimer = listenBuffer.FlushTimer(sessionManager.listenBuffer)
+    flushTimer.start()
+    try:
+        return handleActions(uid, sessionManager)
+    finally:
+        flushTimer.stop()
 
-    cursor = config.cursor
-    connection = config.connection
 
-    sessionManager = SessionManager(uid, cursor, connection)
+def handleActions(uid: str, sessionManager: SessionManager) -> str:
+    """Prompt for actions until the user logs out or quits
+
+    Args:
+        uid (str): user id
+        sessionManager (SessionManager): class for managing current session
 
+    Returns:
+        str: Returns whether program quits or logs out
+    """
     action = None
     while action != 4 and action != 5:
         action = getAction(uid)
@@ -165,6 +192,9 @@ def handleFunctionality(uid: str) -> str:
         elif action == 3:
             sessionManager.endSession()
 
+        elif action == 6:
+            handleCharts()
+
         else:
             if sessionManager.isSessionStarted():
                 sessionManager.endSession()
@@ -177,6 +207,32 @@ def handleFunctionality(uid: str) -> str:
                 return "quit"
 
 
+def handleCharts() -> None:
+    """
+    Prompt for a chart and time window, and show the most played songs or
+    artists of that window
+    """
+    kind = None
+    while kind is None:
+        selection = input("Top [s]ongs or [a]rtists: ").strip().lower()
+        kind = {"s": "songs", "a": "artists"}.get(selection[:1])
+        if kind is None:
+            config.dispMessage("Invalid chart selection.")
+
+    options = ", ".join(f"[{i}] {window}" for i, window in enumerate(charts.WINDOWS))
+    while True:
+        selection = input(f"Window ({options}, or e.g. 12h, 2w): ").strip()
+        if selection.isnumeric() and int(selection) in range(len(charts.WINDOWS)):
+            window = charts.WINDOWS[int(selection)]
+        else:
+            window = selection
+        try:
+            charts.printChart(kind, window)
+            return
+        except ValueError as error:
+            config.dispMessage(str(error))
+
+
 def handleSongAction(action: int, uid: str, sessionManager: SessionManager) -> None:
     """Handle when user selects a song from search
 
@@ -185,8 +241,6 @@ def handleSongAction(action: int, uid: str, sessionManager: SessionManager) -> N
         userType (str): user id
         sessionManager (SessionManager): class for managing current session
     """
-    global connection, cursor
-
     if action == 1:
         song = search.search(search.querySongsAndPlaylists, search.selectSongOrPlaylist)
     else:
@@ -196,24 +250,18 @@ def handleSongAction(action: int, uid: str, sessionManager: SessionManager) -> N
     if len(song) == 0:
         return 
     else:
-        songFunctions.conn = connection
-        songFunctions.cursor = cursor
-
         songFunctions.userActions(uid, song[0], sessionManager)
 
     
 
 def main():
-    global connection, cursor
     path = "mp1.db"
     config.connect(path)
-    connection = config.connection
-    cursor = config.cursor
 
     # startSession("u23")
     handleFunctionality("u23")
 
-    connection.close()
+    config.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
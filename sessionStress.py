@@ -0,0 +1,108 @@
+"""
+Stress test for session number allocation.
+
+Run as:
+`sessionStress.py <database.db> [--threads N] [--sessions N] [--users N]`
+
+Copies the database to a temporary file, then starts sessions for a few
+users from many threads at once. Fails (exit status 1) if any session
+could not be started or if a user's session numbers are not exactly
+1..n without gaps or duplicates.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+import config
+import session
+import toolHelpers
+
+THREADS = 32
+SESSIONS = 4000
+USERS = 4
+
+
+def startSessions(uids: list[str], count: int, errors: list) -> None:
+    """Start and end 'count' sessions, cycling through 'uids'
+
+    Args:
+        uids (list[str]): users to start sessions for
+        count (int): number of sessions to start
+        errors (list): collects the errors raised
+    """
+    managers = {uid: session.SessionManager(uid, verbose=False) for uid in uids}
+    for i in range(count):
+        sessionManager = managers[uids[i % len(uids)]]
+        try:
+            sessionManager.startSession()
+            sessionManager.endSession()
+        except sqlite3.Error as error:
+            errors.append(error)
+            sessionManager.sessionNum = None
+
+
+def checkSessionNumbers(uids: list[str]) -> list[str]:
+    """Check that every user's session numbers run from 1 without gaps
+
+    Args:
+        uids (list[str]): users to check
+
+    Returns:
+        list[str]: description of each problem found
+    """
+    cursor = config.getCursor()
+    problems = []
+    for uid in uids:
+        cursor.execute("select sno from sessions where uid = ? order by sno", (uid,))
+        numbers = [row[0] for row in cursor.fetchall()]
+        if numbers != list(range(1, len(numbers) + 1)):
+            problems.append(f"user '{uid}' has session numbers {numbers[:10]}...")
+
+    return problems
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Start sessions concurrently and check their numbering")
+    parser.add_argument("database", help="sqlite database file, it is copied and left unchanged")
+    parser.add_argument("--threads", type=int, default=THREADS)
+    parser.add_argument("--sessions", type=int, default=SESSIONS, help="total sessions to start")
+    parser.add_argument("--users", type=int, default=USERS, help="number of users sharing the sessions")
+    args = parser.parse_args(argv[1:])
+
+    with toolHelpers.databaseCopy(args.database, "stress.db") as path:
+        try:
+            config.connect(path)
+            cursor = config.getCursor()
+            cursor.execute("select uid from users order by uid limit ?", (args.users,))
+            uids = [row[0] for row in cursor.fetchall()]
+
+            errors = []
+            # the first threads take one more session each when they don't divide evenly
+            perThread, extra = divmod(args.sessions, args.threads)
+            threads = [
+                threading.Thread(target=startSessions, args=(uids, perThread + (i < extra), errors))
+                for i in range(args.threads)
+            ]
+
+            startTime = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - startTime
+
+            problems = [repr(error) for error in errors[:10]] + checkSessionNumbers(uids)
+            total = args.sessions
+            print(f"Started {total - len(errors)}/{total} sessions from {args.threads} threads in {elapsed:.2f}s")
+            for problem in problems:
+                print(problem)
+        finally:
+            config.close()
+
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,149 @@
+"""
+Log of the sqlite3 statements that take longer than a threshold.
+
+The log is off unless enabled, either with enable() before config.connect
+or by setting the SLOW_QUERY_LOG environment variable to the log file
+(and optionally SLOW_QUERY_MS to the threshold). It uses the instrumented
+connections of queryMetrics, so when both are off nothing is measured.
+
+A statement's time is the time of its execute plus the fetching of all its
+rows, it is checked once the statement is done: its rows ran out, the cursor
+ran another statement or was closed. Each slow statement is written to a
+rotating log file as one JSON line with its name (see queryMetrics), sql,
+bound parameters with passwords redacted, elapsed time, rows returned and
+the EXPLAIN QUERY PLAN output at that moment.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+from logging.handlers import RotatingFileHandler
+
+# Environment variables naming the log file, which enables the log, and the threshold
+ENVIRONMENT_VARIABLE = "SLOW_QUERY_LOG"
+THRESHOLD_VARIABLE = "SLOW_QUERY_MS"
+
+THRESHOLD_MS = 100.0
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# Named parameters whose values are never logged
+REDACTED_PARAMETER = re.compile(r"^(pw|pwd|passw(or)?d)$", re.I)
+
+# Statements using a password column, including inserts into the tables
+# with one that don't name their columns. None of their positional
+# parameters are logged as there's no telling which one is the password.
+REDACTED_STATEMENT = re.compile(r"\b(pw|pwd|passw(or)?d)\b|\binto\s+(users|artists)\b", re.I)
+REDACTED = "***"
+
+# Logger of the slow statements, None while the log is off
+logger = None
+
+# Statements taking at least this many seconds are logged
+threshold = THRESHOLD_MS / 1000
+
+
+def redact(sql: str, parameters):
+    """Replace the values of password parameters
+
+    Args:
+        sql (str): the statement
+        parameters (dict | Sequence): its bound parameters
+
+    Returns:
+        dict | list: parameters that can be logged
+    """
+    if isinstance(parameters, dict):
+        return {
+            name: REDACTED if REDACTED_PARAMETER.match(name) else value
+            for name, value in parameters.items()
+        }
+
+    if REDACTED_STATEMENT.search(sql):
+        return [REDACTED] * len(parameters)
+
+    return list(parameters)
+
+
+def queryPlan(connection: sqlite3.Connection, sql: str, parameters) -> list[str]:
+    """Get the current query plan of a statement
+
+    Args:
+        connection (sqlite3.Connection): connection the statement ran on
+        sql (str): the statement
+        parameters (dict | Sequence): its bound parameters
+
+    Returns:
+        list[str]: the plan lines, or the error if there is no plan
+    """
+    try:
+        # A plain cursor, so the plan query itself isn't timed or logged
+        cursor = sqlite3.Cursor(connection)
+        cursor.execute("explain query plan " + sql, parameters)
+        return [row[3] for row in cursor.fetchall()]
+    except sqlite3.Error as error:
+        return [f"no plan: {error}"]
+
+
+def logStatement(connection: sqlite3.Connection, name: str, sql: str, parameters,
+                 elapsed: float, rows: int) -> None:
+    """Write a statement to the log if it took at least the threshold
+
+    Args:
+        connection (sqlite3.Connection): connection the statement ran on
+        name (str): statement name
+        sql (str): the statement
+        parameters (dict | Sequence): its bound parameters
+        elapsed (float): time of the execute and fetches in seconds
+        rows (int): rows returned
+    """
+    if logger is None or elapsed < threshold:
+        return
+
+    entry = {
+        "statement": name,
+        "elapsed_ms": round(elapsed * 1000, 3),
+        "rows": rows,
+        "sql": " ".join(sql.split()),
+        "parameters": redact(sql, parameters),
+        "plan": queryPlan(connection, sql, parameters),
+    }
+    logger.warning(json.dumps(entry, default=str))
+
+
+def enable(path: str, thresholdMs: float = THRESHOLD_MS, maxBytes: int = MAX_BYTES,
+           backupCount: int = BACKUP_COUNT) -> logging.Logger:
+    """Turn the slow query log on for the connections opened from now on
+
+    Args:
+        path (str): log file
+        thresholdMs (float): statements taking at least this many milliseconds are logged
+        maxBytes (int): size at which the log file is rotated
+        backupCount (int): number of rotated files kept
+
+    Returns:
+        logging.Logger: the slow query logger
+    """
+    global logger, threshold
+
+    threshold = thresholdMs / 1000
+    if logger is None:
+        handler = RotatingFileHandler(path, maxBytes=maxBytes, backupCount=backupCount)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger = logging.getLogger("slowQueries")
+        logger.addHandler(handler)
+        logger.setLevel(logging.WARNING)
+        logger.propagate = False
+
+    return logger
+
+
+def enableFromEnvironment() -> None:
+    """
+    Turn the log on if the SLOW_QUERY_LOG environment variable names a log
+    file, with the threshold from SLOW_QUERY_MS
+    """
+    path = os.environ.get(ENVIRONMENT_VARIABLE)
+    if path:
+        enable(path, float(os.environ.get(THRESHOLD_VARIABLE, THRESHOLD_MS)))
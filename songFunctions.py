@@ -1,10 +1,10 @@
 from distutils.file_util import move_file
 from distutils.util import execute
 import sqlite3
-import time
-
-conn = None
-cursor = None
+import config
+import recommendations
+import searchCache
+import songProfile
 
 def connect(path):
     '''
@@ -12,12 +12,7 @@ def connect(path):
 
     takes in the path address of the database.
     '''
-    global conn, cursor
-
-    conn = sqlite3.connect(path)
-    cursor = conn.cursor()
-    cursor.execute(' PRAGMA foreign_keys=ON; ')
-    conn.commit()
+    config.connect(path)
 
     return
 
@@ -28,123 +23,83 @@ def listen(user_uid, song_sid, sessionManager):
     of the user (if a session has already started for the user)
     or within a new session (if not).  A listening event is recorded
     by either inserting a row to table listen or increasing the listen
-    count in this table by 1.
+    count in this table by 1. Listening events are buffered by the session
+    manager and written in batches, at the latest when the session ends.
 
     takes in user.uid of the current user, song.sid of the current song
     and current session.sno(can be None if user not in session).
     '''
 
-    global conn, cursor
-
-    t =  time.localtime()
-    t1 = str(time.strftime("%Y-%m-%d %H:%M:%S", t))
-
-    # add new session to database if user not in session
-    add_session_query = '''
-                        INSERT INTO sessions
-                        SELECT :uid, :sno, :start, NULL;
-                        '''
-    
-
-    # return the last session sno that the user was in
-    new_sno_query = '''
-                    SELECT sessions.sno
-                    FROM sessions
-                    WHERE sessions.uid =:uid
-                    ORDER BY sessions.sno DESC
-                    LIMIT 1;
-                    '''
-
-    # create new row in listen
-    add_listen_query = '''
-                        INSERT INTO listen
-                        SELECT :uid, :sno, :sid, 1.0;
-                        '''
-    
-    # check to see if song have been played in session
-    check_query = '''
-                SELECT *
-                FROM listen
-                WHERE listen.uid =:uid
-                AND listen.sno =:sno
-                AND listen.sid =:sid;
-                '''
-    
-    # update listen cnt by increasing it by 1
-    update_cnt_query = '''
-                        UPDATE listen
-                        SET cnt = cnt + 1
-                        WHERE listen.uid =:uid
-                        AND listen.sno =:sno
-                        AND listen.sid =:sid;
-                        '''
-
-
     # if user not in session, create new session
     if not sessionManager.isSessionStarted():
         sessionManager.startSession()
-        session_sno = sessionManager.getSessionNumber()
 
-        # add song to the listen table
-        cursor.execute(add_listen_query, {"uid":user_uid, "sno":session_sno, "sid":song_sid})
-        conn.commit()
-    else:
-        # check to see if song is already played during session
-        cursor.execute(check_query, {"uid":user_uid, "sno":session_sno, "sid":song_sid})
-        if cursor.fetchone() is None:
-            # add new row to listen if it is not
-            cursor.execute(add_listen_query, {"uid":user_uid, "sno":session_sno, "sid":song_sid})
-            conn.commit()
-        else:
-            # update listen cnt if it is
-            cursor.execute(update_cnt_query, {"uid":user_uid, "sno":session_sno, "sid":song_sid})
-            conn.commit()
-
-    print("Done\n")
+    # the play is buffered by the session and added to the listen table in batches
+    sessionManager.recordListen(song_sid)
 
     return
 
+def get_info(song_sid):
+    '''
+    get detail information about song when give song ID.
+
+    takes in song.sid of the desired song, returns a list of
+    (artist name, sid, title, duration) rows and a list of
+    (playlist title, pid) rows of the playlists the song is in.
+    both come from the song profile, see songProfile.getProfile.
+    '''
+    profile = songProfile.getProfile(song_sid)
+    if profile is None:
+        return [], []
+
+    song_rows = [
+        (artist["name"], profile["sid"], profile["title"], profile["duration"])
+        for artist in profile["artists"]
+    ]
+    playlist_rows = [(playlist["title"], playlist["pid"]) for playlist in profile["playlists"]]
+
+    return song_rows, playlist_rows
+
 def info(song_sid):
     '''
     shows detail information about song when give song ID.
 
     takes in song.sid of the desired song for more info.
     '''
-    global conn, cursor
-
-    # Query to find the artistis name who perform the given song, the songs ID, Title, and Duration
-    info_query1 ='''
-                SELECT artists.name, songs.sid, songs.title, songs.duration
-                FROM artists, songs, perform
-                WHERE songs.sid =?
-                AND lower(artists.aid) = lower(perform.aid)
-                AND perform.sid = songs.sid;
-                '''
-    
-    # Query to find the playlists the given song is in
-    info_query2 ='''
-                SELECT playlists.title, playlists.pid
-                FROM songs, playlists, plinclude
-                WHERE songs.sid =?
-                AND plinclude.sid = songs.sid
-                AND lower(plinclude.pid) = playlists.pid;
-                '''
-    
-    # Print out the resurt of the first query
-    conn.row_factory = sqlite3.Row
-    cursor.execute(info_query1, (song_sid,))
-    rows = cursor.fetchall()
+    profile = songProfile.getProfile(song_sid)
+    if profile is None:
+        print(f"Song '{song_sid}' does not exist")
+        return
+
+    # Print out the artists, title and duration of the song
     print("Song Infomation:")
-    for each in rows:
-        print(f"| {each[0]} | {each[1]} | {each[2]} | {each[3]} |")
+    for artist in profile["artists"]:
+        print(f"| {artist['name']} | {profile['sid']} | {profile['title']} | {profile['duration']} |")
+    print(f"Total plays: {profile['plays']:g}")
     print("\n")
 
-    # Print out the result of the second query
+    # Print out the playlists the song is in
     print("Playlists Song is in:")
-    cursor.execute(info_query2, (song_sid,))
-    rows = cursor.fetchall()
-    for each in rows:
-        print(f"| {each[0]} | {each[1]} |")
+    for playlist in profile["playlists"]:
+        print(f"| {playlist['title']} | {playlist['pid']} |")
+
+    return
+
+def recommend(song_sid):
+    '''
+    shows the songs most played by the users who played the given song,
+    as last computed by recommendations.py.
+
+    takes in song.sid of the song to recommend from.
+    '''
+    neighbor_rows = recommendations.getNeighbors(song_sid)
+    if not neighbor_rows:
+        print("No recommendations for this song yet")
+        return
+
+    print("Users who played this also played:")
+    for each in neighbor_rows:
+        print(f"| {each[0]} | {each[1]} | {each[2]} | {each[3]:.2f} |")
 
     return
 
@@ -155,92 +110,114 @@ def add_song_to_playlist(playlist_title, song_sid, user_uid):
 
     takes in the playlist.title that the user want to add the song to,
     song.sid of the selected song, and user.uid of the current user.
+    returns the pid of the playlist.
     '''
-    global conn, cursor
+    playlist_pid, _ = add_songs_to_playlist(playlist_title, [song_sid], user_uid)
 
-    # create playlist if it doesn't exist
-    add_playlist_query ='''
-                        INSERT INTO playlists
-                        SELECT :pid, :title, :uid
-                        WHERE NOT EXISTS
-                                (SELECT 1
-                                FROM playlists
-                                WHERE lower(playlists.title) =lower(:title));
-                        '''
+    return playlist_pid
 
-    # return the largest pid
+def add_songs_to_playlist(playlist, song_sids, user_uid):
+    '''
+    add many songs to a playlist in one transaction. the playlist is given
+    by its title (created for the user if no playlist has that title) or by
+    its pid. songs already in the playlist are skipped, the others are
+    appended in the given order.
+
+    takes in the playlist.title or playlist.pid, a list of song.sid and
+    user.uid of the current user. returns the pid of the playlist and the
+    number of songs added to it.
+    '''
+    conn = config.getConnection()
+    cursor = conn.cursor()
+
+    user_uid = config.canonicalId(user_uid)
+
+    # return the pid of the playlist with the given title, case insensitive (uses playlists_title_nocase)
+    title_pid_query = '''
+                    SELECT playlists.pid
+                    FROM playlists
+                    WHERE playlists.title =:title COLLATE NOCASE
+                    LIMIT 1;
+                    '''
+
+    # check that a playlist with the given pid exists
     pid_query = '''
                 SELECT playlists.pid
                 FROM playlists
-                ORDER BY playlists.pid DESC
-                LIMIT 1;
+                WHERE playlists.pid =:pid;
                 '''
-    
+
+    # create the playlist with the next free pid
+    add_playlist_query = '''
+                        INSERT INTO playlists (pid, title, uid)
+                        SELECT coalesce(max(playlists.pid), 0) + 1, :title, :uid
+                        FROM playlists
+                        RETURNING pid;
+                        '''
+
     # return the largest sorder
     sorder_query = '''
-                    SELECT plinclude.sorder
-                    FROM plinclude, playlists
-                    WHERE playlists.pid =:pid
-                    AND playlists.pid = plinclude.pid
-                    ORDER BY plinclude.sorder DESC
-                    LIMIT 1;
+                    SELECT playlist_stats.last_sorder
+                    FROM playlist_stats
+                    WHERE playlist_stats.pid =:pid;
                     '''
-    
-    # add song into playlist
-    add_song_query ='''
-                    INSERT INTO plinclude
-                    SELECT :playlist_pid, :song_sid, :plinclude_sorder
-                    WHERE NOT EXISTS
-                                (SELECT 1
-                                FROM plinclude
-                                WHERE plinclude.pid =:pid
-                                AND plinclude.sid =:sid);
-
-                    '''
-    
-    # return the playlist pid that match with the playlist title given
-    title_pid_query ='''
-                    SELECT playlists.pid
-                    FROM playlists
-                    WHERE lower(playlists.title) =lower(:title);
-                    '''
-    
-    plinclude_sorder = 1
-
 
-    # find the last pid in playlists and add one to use as new pid, unless there are no playlists in database
-    cursor.execute(pid_query)
-    if cursor.fetchone() is None:
-        playlist_pid = 1
-    else:
-        cursor.execute(pid_query)
-        playlist_pid = cursor.fetchone()[0] + 1
-    conn.commit()
+    # return the songs already in the playlist
+    playlist_sids_query = '''
+                        SELECT plinclude.sid
+                        FROM plinclude
+                        WHERE plinclude.pid =:pid;
+                        '''
 
-    # create the new playlists if it doesn't exist
-    cursor.execute(add_playlist_query, {"pid":playlist_pid, "title":playlist_title, "uid":user_uid, "title":playlist_title})
-    conn.commit()
+    # add song into playlist
+    add_song_query = '''
+                    INSERT INTO plinclude (pid, sid, sorder)
+                    VALUES (:pid, :sid, :sorder);
+                    '''
 
-    # set the playlist pid to the pid that match with playlist title given
-    cursor.execute(title_pid_query, {"title":playlist_title})
-    playlist_pid = cursor.fetchone()[0]
-    conn.commit()
+    try:
+        # take the write lock up front so the playlist lookup and creation can't race
+        cursor.execute('BEGIN IMMEDIATE;')
 
-    # find the last sorder in plinclude and add one to use as new sorder, unless there are no sorder in database
-    cursor.execute(sorder_query, {"pid":playlist_pid})
-    if cursor.fetchone() is None:
-        plinclude_sorder = 1
-    else:
+        if isinstance(playlist, int):
+            cursor.execute(pid_query, {"pid":playlist})
+            if cursor.fetchone() is None:
+                raise ValueError(f"Playlist '{playlist}' does not exist")
+            playlist_pid = playlist
+        else:
+            # set the playlist pid to the pid that match with playlist title given, create the playlist if there is none
+            cursor.execute(title_pid_query, {"title":playlist})
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute(add_playlist_query, {"title":playlist, "uid":user_uid})
+                row = cursor.fetchall()[0]
+            playlist_pid = row[0]
+
+        # find the last sorder of the playlist and number the new songs after it
         cursor.execute(sorder_query, {"pid":playlist_pid})
-        plinclude_sorder = cursor.fetchone()[0] + 1
-    conn.commit()
+        row = cursor.fetchone()
+        last_sorder = row[0] if row is not None and row[0] is not None else 0
+
+        # skip songs that are already in the playlist or repeated in song_sids
+        cursor.execute(playlist_sids_query, {"pid":playlist_pid})
+        existing_sids = {row[0] for row in cursor.fetchall()}
+        new_sids = [sid for sid in dict.fromkeys(song_sids) if sid not in existing_sids]
+
+        cursor.executemany(add_song_query, [
+            {"pid":playlist_pid, "sid":sid, "sorder":last_sorder + i}
+            for i, sid in enumerate(new_sids, start=1)
+        ])
+        conn.commit()
+    except (sqlite3.Error, ValueError):
+        conn.rollback()
+        raise
 
-    # add the song to the playlist
-    cursor.execute(add_song_query, {"playlist_pid":playlist_pid, "song_sid":song_sid, "plinclude_sorder":plinclude_sorder, "pid":playlist_pid, "sid": song_sid})
-    conn.commit()
+    # cached search results may show the old playlist length, and cached
+    # song profiles the old playlists
+    searchCache.bumpWriteGeneration()
+    songProfile.invalidate(new_sids)
 
-    print("Done\n")
-    return
+    return playlist_pid, len(new_sids)
 
 def add_song(song_title, song_duration, artist_aid):
     '''
@@ -248,7 +225,10 @@ def add_song(song_title, song_duration, artist_aid):
     
     takes in song.title of the new song, and song.duration of the new song.
     '''
-    global conn, cursor
+    conn = config.getConnection()
+    cursor = config.getCursor()
+
+    artist_aid = config.canonicalId(artist_aid)
 
     # add the given title and duration to the database with new sid if not already in database
     add_song_query ='''
@@ -257,18 +237,25 @@ def add_song(song_title, song_duration, artist_aid):
                     WHERE NOT EXISTS
                             (SELECT 1
                             FROM songs
-                            WHERE lower(songs.title) =lower(:title)
+                            WHERE songs.title =:title COLLATE NOCASE
                             AND songs.duration =:duration);
                     '''
 
     # return the song sid of the last song sid
     sid_query = '''
-                SELECT songs.sid
-                FROM songs
-                ORDER BY songs.sid DESC
-                LIMIT 1;
+                SELECT max(songs.sid)
+                FROM songs;
                 '''
 
+    # return the sid of a song already in the database with the given title and duration (uses songs_title_nocase_duration)
+    existing_sid_query = '''
+                        SELECT songs.sid
+                        FROM songs
+                        WHERE songs.title =:title COLLATE NOCASE
+                        AND songs.duration =:duration
+                        LIMIT 1;
+                        '''
+
     # add the song and artist to the performed table
     add_perform_query = '''
                         INSERT INTO perform
@@ -276,27 +263,43 @@ def add_song(song_title, song_duration, artist_aid):
                         WHERE NOT EXISTS
                                 (SELECT 1
                                 FROM perform
-                                WHERE lower(perform.aid) = lower(:aid)
+                                WHERE perform.aid = :aid
                                 AND perform.sid = :sid);
                         '''
     
 
-    # find the last sid in songs and add one to use as new sid, unless there are no songs in database
-    cursor.execute(sid_query)
-    if cursor.fetchone() is None:
-        songs_sid = 1
-    else:
-        cursor.execute(sid_query)
-        songs_sid = cursor.fetchone()[0] + 1
-    conn.commit()
-
-    # add song to database if the title and duration is not already in the database
-    cursor.execute(add_song_query, {"sid":songs_sid, "title":song_title, "duration":song_duration, "title":song_title, "duration":song_duration})
-    conn.commit()
+    # the song, perform row and artist_stats update (done by trigger on perform) are written in one transaction
+    try:
+        # take the write lock up front so concurrent calls can't pick the same new sid
+        cursor.execute('BEGIN IMMEDIATE;')
 
-    # add new perform row
-    cursor.execute(add_perform_query, {"aid":artist_aid, "sid":songs_sid, "aid":artist_aid, "sid":songs_sid})
+        # reuse the sid of the song if the title and duration is already in the database
+        cursor.execute(existing_sid_query, {"title":song_title, "duration":song_duration})
+        existing_sid = cursor.fetchone()
+        if existing_sid is not None:
+            songs_sid = existing_sid[0]
+        else:
+            # find the last sid in songs and add one to use as new sid, unless there are no songs in database
+            cursor.execute(sid_query)
+            last_sid = cursor.fetchone()
+            if last_sid[0] is None:
+                songs_sid = 1
+            else:
+                songs_sid = last_sid[0] + 1
+
+            # add song to database
+            cursor.execute(add_song_query, {"sid":songs_sid, "title":song_title, "duration":song_duration})
+
+        # add new perform row
+        cursor.execute(add_perform_query, {"aid":artist_aid, "sid":songs_sid})
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
 
+    # cached search results may be missing the new song, and its cached profile the artist
+    searchCache.bumpWriteGeneration()
+    songProfile.invalidate([songs_sid])
 
     return
 
@@ -309,13 +312,15 @@ def find_top(artists_aid):
     takes in artists.aid of the current artists.
     '''
 
-    global conn, cursor
+    cursor = config.getCursor()
+
+    artists_aid = config.canonicalId(artists_aid)
 
     # list the top 3 playlists that contains the most of artists songs
     top_playlist_query = '''
                         SELECT playlists.title, playlists.pid, count(playlists.pid)
                         FROM playlists, artists, perform, plinclude
-                        WHERE lower(artists.aid) =lower(:aid)
+                        WHERE artists.aid =:aid
                         AND artists.aid = perform.aid
                         AND perform.sid = plinclude.sid
                         AND plinclude.pid = playlists.pid
@@ -324,28 +329,17 @@ def find_top(artists_aid):
                         LIMIT 3;
                         '''
 
-    # select the top 3 users uid that listen to the artists songs the longest
+    # select the names of the top 3 users that listen to the artists songs the longest
     top_user_query = '''
-                    SELECT uid
-                    FROM 
-                        (select l.uid, p.aid, sum(l.cnt*s.duration)
-                        from listen l, songs s, perform p
-                        where l.sid=s.sid and s.sid=p.sid
-                        group by l.uid, p.aid
-                        order by sum(l.cnt*s.duration) DESC)
-                    WHERE lower(aid) =lower(:aid)
+                    SELECT users.name
+                    FROM artist_listeners, users
+                    WHERE artist_listeners.aid =:aid
+                    AND users.uid = artist_listeners.uid
+                    ORDER BY artist_listeners.listen_time DESC
                     LIMIT 3;
                     '''
-    
-    # given the uid of a user change it to the name of the user
-    uid_to_name_query = '''
-                        SELECT users.name
-                        FROM users
-                        WHERE lower(users.uid) =lower(:uid)
-                        '''
 
     # print out the title, pid and how many songs of the artists it contains
-    conn.row_factory = sqlite3.Row
     cursor.execute(top_playlist_query, {"aid":artists_aid})
     rows = cursor.fetchall()
     print("Playlists that include the largest number of your songs:")
@@ -356,17 +350,13 @@ def find_top(artists_aid):
     print("\n")
     
 
-    # get the uid of the top 3 listeners
-    conn.row_factory = sqlite3.Row
+    # get the names of the top 3 listeners
     cursor.execute(top_user_query, {"aid":artists_aid})
     rows = cursor.fetchall()
     print("Users that listen to your songs the longest are:")
     print("-" * 40)
-    # converts all the uid to names
     for each in rows:
-        user_uid = each[0]
-        cursor.execute(uid_to_name_query, {"uid":user_uid})
-        print(cursor.fetchone()[0])
+        print(each[0])
 
     return
 
@@ -441,7 +431,7 @@ def find_top(artists_aid):
 #             print("*" * 10, "\nInvalid action selection.\n", "*" * 10)
 
 def userActions(user_uid, song_sid, sessionManager):
-    global conn, cursor
+    conn = config.getConnection()
 
     # user menu
     # until user input vaild action
@@ -453,12 +443,14 @@ def userActions(user_uid, song_sid, sessionManager):
                 [0] Listen to Song
                 [1] More Infomation
                 [2] Add Song to Playlist
+                [3] Recommended Songs
                 """)
 
         action_type = input("your action: ")
         # handle different type of user actions
         if action_type == "0":
             listen(user_uid, song_sid, sessionManager)
+            print("Done\n")
             x = False
         elif action_type == "1":
             info(song_sid)
@@ -466,6 +458,10 @@ def userActions(user_uid, song_sid, sessionManager):
         elif action_type == "2":
             playlist_title = input("title of the playlist you want to add the song to: ")
             add_song_to_playlist(playlist_title, song_sid, user_uid)
+            print("Done\n")
+            x = False
+        elif action_type == "3":
+            recommend(song_sid)
             x = False
 
     conn.commit()
@@ -473,7 +469,7 @@ def userActions(user_uid, song_sid, sessionManager):
 
 
 def artistActions(artist_aid):
-    global conn, cursor
+    conn = config.getConnection()
 
     # artist menu
     # until user input vaild action
@@ -0,0 +1,202 @@
+"""
+Song profile: everything the song detail view shows, in one statement.
+
+A profile is a dict with the song's sid, title and duration, its artists
+(aid and name, by name), the playlists it is in (pid and title, by pid) and
+its total play count from listen. It is built by a single query that
+aggregates the artists and playlists as JSON, and kept in a bounded LRU
+cache per sid.
+
+The writers of perform, plinclude and listen call invalidate with the sids
+they changed after they commit. Like the search result cache, only writes
+made by this process are seen, so a database shared with other processes
+may show their changes late.
+"""
+import json
+import threading
+from collections import OrderedDict
+import config
+
+# Default number of cached profiles
+MAX_ENTRIES = 4096
+
+PROFILE_QUERY = """
+    select json_object(
+        'sid', s.sid,
+        'title', s.title,
+        'duration', s.duration,
+        'artists', (
+            select json_group_array(json_object('aid', aid, 'name', name))
+            from (
+                select a.aid, a.name
+                from perform p
+                inner join artists a on a.aid = p.aid
+                where p.sid = s.sid
+                order by a.name, a.aid
+            )
+        ),
+        'playlists', (
+            select json_group_array(json_object('pid', pid, 'title', title))
+            from (
+                select pl.pid, pl.title
+                from plinclude i
+                inner join playlists pl on pl.pid = i.pid
+                where i.sid = s.sid
+                order by pl.pid
+            )
+        ),
+        'plays', (
+            select coalesce(sum(l.cnt), 0)
+            from listen l
+            where l.sid = s.sid
+        )
+    )
+    from songs s
+    where s.sid = ?
+"""
+
+
+class ProfileCache():
+    """
+    Bounded LRU cache of song profiles by sid. Every invalidation moves the
+    cache's generation, and a profile is only stored if no invalidation
+    happened while it was being read, so a profile read before a write is
+    never cached after it.
+    """
+    def __init__(self, maxEntries: int = MAX_ENTRIES) -> None:
+        self.maxEntries = maxEntries
+
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, sid: int) -> dict | None:
+        """Get the cached profile of a song, counting a hit or a miss
+
+        Args:
+            sid (int): song id
+
+        Returns:
+            dict | None: the profile, or None if it isn't cached
+        """
+        with self.lock:
+            profile = self.entries.get(sid)
+            if profile is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(sid)
+            self.hits += 1
+            return profile
+
+    def put(self, sid: int, profile: dict, generation: int) -> None:
+        """Cache the profile of a song, evicting the least recently used
+        profiles to stay within the limit
+
+        Args:
+            sid (int): song id
+            profile (dict): the profile
+            generation (int): cache generation when the profile was read, it
+                isn't cached if an invalidation happened since
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.entries[sid] = profile
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, sids) -> None:
+        """Drop the profiles of songs whose artists, playlists or plays changed
+
+        Args:
+            sids (Iterable[int]): song ids
+        """
+        with self.lock:
+            self.generation += 1
+            for sid in sids:
+                if self.entries.pop(sid, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        """
+        Drop every entry, keeping the counters
+        """
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """Get the cache counters
+
+        Returns:
+            dict: hits, misses, evictions, invalidations and current entries
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+            }
+
+
+# Profiles of the songs viewed by this process
+profileCache = ProfileCache()
+
+
+def readProfile(sid: int) -> dict | None:
+    """Read the profile of a song from the database
+
+    Args:
+        sid (int): song id
+
+    Returns:
+        dict | None: the profile, or None if there is no such song
+    """
+    cursor = config.getConnection().cursor()
+    cursor.execute(PROFILE_QUERY, (sid,))
+    row = cursor.fetchone()
+    cursor.close()
+
+    return None if row is None else json.loads(row[0])
+
+
+def getProfile(sid: int) -> dict | None:
+    """Get the profile of a song, from the cache if it is there. The profile
+    is shared with the cache and must not be modified.
+
+    Args:
+        sid (int): song id
+
+    Returns:
+        dict | None: sid, title, duration, artists, playlists and plays, or
+            None if there is no such song
+    """
+    profile = profileCache.get(sid)
+    if profile is None:
+        generation = profileCache.generation
+        profile = readProfile(sid)
+        if profile is not None:
+            profileCache.put(sid, profile, generation)
+
+    return profile
+
+
+def invalidate(sids) -> None:
+    """Drop the cached profiles of songs, called by the writers of perform,
+    plinclude and listen after they commit
+
+    Args:
+        sids (Iterable[int]): song ids
+    """
+    profileCache.invalidate(sids)
@@ -0,0 +1,39 @@
+import os
+import sys
+import pytest
+
+# The modules live at the top of the repository, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import generateDatabase
+
+# A database small enough to generate in a fraction of a second, with every
+# table and derived table filled
+SIZES = {"users": 40, "artists": 20, "songs": 300, "playlists": 30, "listens": 3000}
+
+
+@pytest.fixture
+def databasePath(tmp_path) -> str:
+    """Generate a small database, see SIZES
+
+    Returns:
+        str: path of the database file
+    """
+    path = str(tmp_path / "test.db")
+    generateDatabase.generateDatabase(path, seed=0, exponent=generateDatabase.ZIPF_EXPONENT, **SIZES)
+    return path
+
+
+@pytest.fixture
+def connection(databasePath):
+    """Open the generated database through config, closed after the test
+
+    Yields:
+        sqlite3.Connection: the test thread's connection
+    """
+    config.connect(databasePath)
+    try:
+        yield config.getConnection()
+    finally:
+        config.close()
@@ -0,0 +1,158 @@
+"""
+The trigger maintained tables of schema must always hold what a full
+aggregation of their base tables gives, after any insert, update or delete.
+Rows whose counts went back to zero may stay, so only non-zero rows are
+compared.
+"""
+import random
+import pytest
+
+# Brute force contents of each derived table: its key columns and values
+PLAYLIST_STATS = """
+    select plinclude.pid, count(*), coalesce(sum(songs.duration), 0), max(plinclude.sorder)
+    from plinclude
+    left outer join songs on songs.sid = plinclude.sid
+    group by plinclude.pid
+"""
+
+ARTIST_STATS = """
+    select perform.aid, count(*), coalesce(sum(songs.duration), 0)
+    from perform
+    left outer join songs on songs.sid = perform.sid
+    group by perform.aid
+"""
+
+ARTIST_LISTENERS = """
+    select perform.aid, listen.uid, sum(listen.cnt * songs.duration)
+    from listen, songs, perform
+    where listen.sid = songs.sid
+    and songs.sid = perform.sid
+    group by perform.aid, listen.uid
+"""
+
+SONG_PLAYS_HOURLY = """
+    select strftime('%Y-%m-%d %H:00:00', sessions.start), listen.sid, sum(listen.cnt)
+    from listen, sessions
+    where sessions.uid = listen.uid
+    and sessions.sno = listen.sno
+    group by 1, 2
+"""
+
+SONG_PLAYS_DAILY = """
+    select date(sessions.start), listen.sid, sum(listen.cnt)
+    from listen, sessions
+    where sessions.uid = listen.uid
+    and sessions.sno = listen.sno
+    group by 1, 2
+"""
+
+
+def rowsByKey(connection, sql: str, keyColumns: int) -> dict:
+    """Read rows into a dict by their leading key columns, dropping rows
+    whose values are all zero and rounding away float error
+
+    Returns:
+        dict: values tuple by key tuple
+    """
+    rows = {}
+    for row in connection.execute(sql):
+        key, values = row[:keyColumns], row[keyColumns:]
+        if values[0] == 0 or values[0] is None or abs(values[0]) < 1e-6:
+            continue
+        rows[key] = tuple(round(value, 6) if isinstance(value, float) else value for value in values)
+
+    return rows
+
+
+def assertMatches(connection, table: str, keyColumns: int, bruteForce: str) -> None:
+    derived = rowsByKey(connection, f"select * from {table}", keyColumns)
+    expected = rowsByKey(connection, bruteForce, keyColumns)
+    assert derived == expected
+
+
+def changePlinclude(connection, rng: random.Random) -> None:
+    pids = [row[0] for row in connection.execute("select pid from playlists")]
+    sids = [row[0] for row in connection.execute("select sid from songs")]
+    for _ in range(50):
+        connection.execute(
+            "insert or ignore into plinclude values (?, ?, ?)",
+            (rng.choice(pids), rng.choice(sids), rng.randint(1, 1000))
+        )
+    rows = connection.execute("select pid, sid from plinclude order by random() limit 40").fetchall()
+    for pid, sid in rows[:20]:
+        connection.execute("delete from plinclude where pid = ? and sid = ?", (pid, sid))
+    for pid, sid in rows[20:]:
+        connection.execute(
+            "update or ignore plinclude set pid = ?, sid = ?, sorder = ? where pid = ? and sid = ?",
+            (rng.choice(pids), rng.choice(sids), rng.randint(1, 1000), pid, sid)
+        )
+    connection.commit()
+
+
+def changePerform(connection, rng: random.Random) -> None:
+    aids = [row[0] for row in connection.execute("select aid from artists")]
+    sids = [row[0] for row in connection.execute("select sid from songs")]
+    for _ in range(50):
+        connection.execute("insert or ignore into perform values (?, ?)", (rng.choice(aids), rng.choice(sids)))
+    rows = connection.execute("select aid, sid from perform order by random() limit 40").fetchall()
+    for aid, sid in rows[:20]:
+        connection.execute("delete from perform where aid = ? and sid = ?", (aid, sid))
+    for aid, sid in rows[20:]:
+        connection.execute(
+            "update or ignore perform set aid = ?, sid = ? where aid = ? and sid = ?",
+            (rng.choice(aids), rng.choice(sids), aid, sid)
+        )
+    connection.commit()
+
+
+def changeListen(connection, rng: random.Random) -> None:
+    sessions = connection.execute("select uid, sno from sessions").fetchall()
+    sids = [row[0] for row in connection.execute("select sid from songs")]
+    for _ in range(50):
+        uid, sno = rng.choice(sessions)
+        connection.execute(
+            """
+                insert into listen values (?, ?, ?, ?)
+                on conflict (uid, sno, sid) do update set cnt = cnt + excluded.cnt
+            """,
+            (uid, sno, rng.choice(sids), float(rng.randint(1, 5)))
+        )
+    rows = connection.execute("select uid, sno, sid from listen order by random() limit 40").fetchall()
+    for key in rows[:20]:
+        connection.execute("delete from listen where uid = ? and sno = ? and sid = ?", key)
+    for key in rows[20:]:
+        connection.execute(
+            "update listen set cnt = ? where uid = ? and sno = ? and sid = ?",
+            (float(rng.randint(1, 9)), *key)
+        )
+    connection.commit()
+
+
+def changeDurations(connection, rng: random.Random) -> None:
+    for (sid,) in connection.execute("select sid from songs order by random() limit 20").fetchall():
+        connection.execute("update songs set duration = ? where sid = ?", (rng.randint(60, 600), sid))
+    connection.commit()
+
+
+# Derived table, its key columns, brute force query and the changes that
+# affect it
+DERIVED_TABLES = [
+    ("playlist_stats", 1, PLAYLIST_STATS, [changePlinclude, changeDurations]),
+    ("artist_stats", 1, ARTIST_STATS, [changePerform, changeDurations]),
+    ("artist_listeners", 2, ARTIST_LISTENERS, [changeListen, changePerform, changeDurations]),
+    ("song_plays_hourly", 2, SONG_PLAYS_HOURLY, [changeListen]),
+    ("song_plays_daily", 2, SONG_PLAYS_DAILY, [changeListen]),
+]
+
+
+@pytest.mark.parametrize("table, keyColumns, bruteForce, changes", DERIVED_TABLES, ids=[t[0] for t in DERIVED_TABLES])
+def test_derived_table_matches_base_tables(connection, table, keyColumns, bruteForce, changes):
+    # populated by the migration
+    assertMatches(connection, table, keyColumns, bruteForce)
+
+    # kept up to date by the triggers
+    rng = random.Random(0)
+    for _ in range(3):
+        for change in changes:
+            change(connection, rng)
+            assertMatches(connection, table, keyColumns, bruteForce)
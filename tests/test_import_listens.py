@@ -0,0 +1,25 @@
+import importListens
+
+
+def writeRecords(path, lines: list[str]) -> str:
+    path.write_text("uid,sno,sid,start,end\n" + "\n".join(lines) + "\n")
+    return str(path)
+
+
+def test_plays_of_a_listen_row_are_summed_across_the_file(connection, tmp_path):
+    uid = connection.execute("select uid from users order by uid limit 1").fetchone()[0]
+    path = writeRecords(tmp_path / "plays.csv", [
+        f"{uid},9001,1,2022-01-01 10:00:00,2022-01-01 11:00:00",
+        f"{uid},9001,2,,",
+        f"{uid},9001,1,,",
+        f"{uid},9001,1,,",
+    ])
+
+    # re-importing the same file sets the same totals
+    for _ in range(2):
+        assert importListens.import_listens(connection, path, batch_size=1) == 4
+        rows = connection.execute("select sid, cnt from listen where uid = ? and sno = 9001", (uid,)).fetchall()
+        assert dict(rows) == {1: 3.0, 2: 1.0}
+
+    session = connection.execute("select start, end from sessions where uid = ? and sno = 9001", (uid,)).fetchone()
+    assert session == ("2022-01-01 10:00:00", "2022-01-01 11:00:00")
@@ -0,0 +1,39 @@
+import session
+
+
+def sessionManager(connection) -> session.SessionManager:
+    uid = connection.execute("select uid from users order by uid limit 1").fetchone()[0]
+    manager = session.SessionManager(uid, verbose=False)
+    manager.startSession()
+    return manager
+
+
+def plays(connection, manager, sno) -> dict:
+    rows = connection.execute("select sid, cnt from listen where uid = ? and sno = ?", (manager.uid, sno))
+    return dict(rows.fetchall())
+
+
+def test_plays_are_coalesced_and_written_on_flush(connection):
+    manager = sessionManager(connection)
+    sno = manager.getSessionNumber()
+    for sid in [1, 2, 1]:
+        manager.recordListen(sid)
+    assert plays(connection, manager, sno) == {}
+
+    assert manager.listenBuffer.flush() == (2, 0)
+    assert plays(connection, manager, sno) == {1: 2.0, 2: 1.0}
+
+
+def test_unknown_song_is_dropped_without_blocking_the_session(connection):
+    manager = sessionManager(connection)
+    sno = manager.getSessionNumber()
+    manager.recordListen(1)
+    manager.recordListen(999999)
+
+    assert manager.listenBuffer.flush() == (1, 1)
+    assert plays(connection, manager, sno) == {1: 1.0}
+
+    manager.endSession()
+    end = connection.execute("select end from sessions where uid = ? and sno = ?", (manager.uid, sno)).fetchone()[0]
+    assert end is not None
+    assert manager.listenBuffer.pending == {}
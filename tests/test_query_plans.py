@@ -0,0 +1,13 @@
+import queryPlans
+
+
+def test_no_unexpected_table_scans(databasePath):
+    plans = queryPlans.collectPlans(databasePath)
+    assert plans
+
+    failures = {
+        caller: (" ".join(sql.split()), plan)
+        for caller, sql, plan, scans, knownScans in plans
+        if scans
+    }
+    assert failures == {}
@@ -0,0 +1,32 @@
+import search
+import searchCache
+
+
+def commonTerm(connection) -> str:
+    # the first word of the most common song title word, so the search has
+    # more than one page of results
+    titles = [row[0] for row in connection.execute("select title from songs")]
+    words = [title.split()[0] for title in titles]
+    return max(set(words), key=words.count)
+
+
+def test_first_page_of_a_search_is_enough_to_cache_it(connection, monkeypatch):
+    monkeypatch.setattr(search, "resultCache", searchCache.SearchCache())
+    terms = [commonTerm(connection)]
+
+    results = search.pageResults(search.querySongsAndPlaylists, terms)
+    assert results.hasIndex(search.PAGE_SIZE)
+    firstPage = results.page(0)
+
+    hits = search.resultCache.stats()["hits"]
+    assert search.pageResults(search.querySongsAndPlaylists, terms).page(0) == firstPage
+    assert search.resultCache.stats()["hits"] == hits + 1
+
+
+def test_results_over_the_budget_are_paged_but_not_cached(connection, monkeypatch):
+    monkeypatch.setattr(search, "resultCache", searchCache.SearchCache(maxRows=4 * search.PAGE_SIZE))
+    terms = [commonTerm(connection)]
+
+    results = search.pageResults(search.querySongsAndPlaylists, terms)
+    assert results.hasIndex(2 * search.PAGE_SIZE)
+    assert search.resultCache.stats()["entries"] == 0
@@ -0,0 +1,67 @@
+"""
+Helpers shared by the command line tools: benchmark, loadSimulator,
+queryPlans and sessionStress.
+"""
+import contextlib
+import os
+import random
+import shutil
+import tempfile
+import config
+
+
+@contextlib.contextmanager
+def databaseCopy(path: str, name: str = "copy.db"):
+    """Copy a database to a temporary directory, removed on exit, so a tool
+    can write to it and leave the original unchanged
+
+    Args:
+        path (str): sqlite database file
+        name (str): file name of the copy
+
+    Yields:
+        str: path of the copy
+    """
+    directory = tempfile.mkdtemp()
+    copy = os.path.join(directory, name)
+    try:
+        shutil.copyfile(path, copy)
+        yield copy
+    finally:
+        shutil.rmtree(directory)
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Get the nearest-rank percentile of sorted values
+
+    Args:
+        values (list[float]): sorted values
+        p (float): percentile, between 0 and 100
+
+    Returns:
+        float: the value below which p percent of the values are, 0 if
+            there are no values
+    """
+    if not values:
+        return 0.0
+
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def searchTerms(rng: random.Random, count: int) -> list[list[str]]:
+    """Pick search terms from the words of the song titles of the open
+    database
+
+    Args:
+        rng (random.Random): random number generator
+        count (int): number of searches
+
+    Returns:
+        list[list[str]]: the terms of each search, one or two words
+    """
+    cursor = config.getCursor()
+    cursor.execute("select title from songs")
+    words = sorted({word.lower() for (title,) in cursor.fetchall() for word in title.split() if word.isalpha()})
+
+    return [rng.sample(words, min(len(words), rng.randint(1, 2))) for _ in range(count)]